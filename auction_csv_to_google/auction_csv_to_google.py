@@ -29,45 +29,33 @@
 #   - get's two files from S3 (triggered by SNS-topic):
 #       - s3://bdm-auction-exports/clean_csv/latest.csv
 #       - s3://bdm-auction-exports/clean_csv/diff.csv
-#   - uploads them to Google Drive as spreadsheets
+#   - uploads them to Google Drive as spreadsheets: streamed from S3,
+#     with type hints per column, in a chunked resumable upload
 #
 #   That's all...
 #
 #######################################################################
 
 from __future__ import print_function
-PY_3 = False
-import httplib2
-try:
-    from urllib.parse import unquote_plus   # Python 3
-    PY_3 = True
-except ImportError:    
-    from urllib import unquote_plus         # Python 2
+import io
 import os
 import logging
 import json
 from pprint import pprint
 # Third party
-import pytz
 import unicodecsv as csv
-from apiclient import discovery
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.http import MediaFileUpload
+# The Google client libraries (httplib2, apiclient, oauth2client) are
+# imported where they're used: they take most of the cold start.
 # pip install google-cloud for storage
 #~ from google.cloud import storage
-# Boto3
-import boto3
-from botocore.client import Config
-
-try:
-    import argparse
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-except ImportError:
-    flags = None
-    
+# Own
+from lambda_common import auction_schema
+from lambda_common import aws_clients
+from lambda_common import events
+from lambda_common import idempotency
+from lambda_common import metrics
+from lambda_common import s3_reader
+
 # Get logger
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -81,9 +69,9 @@ ch.setFormatter(formatter)
 # add ch to logger
 log.addHandler(ch)
 
-# Initialize boto3-clients per container
+# boto3-clients per container (created on first use)
 region_name = 'eu-central-1'
-s3_client   = boto3.client('s3', config=Config(signature_version='s3v4'))
+s3_client   = aws_clients.lazy_client('s3', signature_version='s3v4')
 
 GOOGLE_PROJECT_ID = os.environ['GOOGLE_PROJECT_ID']
 GOOGLE_LOGIN_EMAIL = os.environ['GOOGLE_LOGIN_EMAIL']
@@ -93,99 +81,147 @@ descriptions_by_filename = {
     'latest.csv': 'Laatste CSV-export',
     'diff.csv'  : 'Delta (verschil) tussen laatste CSV-export en CSV van gisteren.'
 }
-header_list_clean = (
-    'ogm',
-    'pa_title',
-    'auc_title',
-    'auc_id',
-    'auc_link',
-    'high_bid',
-    'admin_cost',
-    'garant_price',
-    'date_high_bid',
-    'pay_date',
-    'annul_ins',
-    'full_option',
-    'annul_date',
-    'collect_date',
-    'extra_info',
-    'clang_id',
-    'cust_fname',
-    'cust_lname',
-    'cust_email',
-    'cust_street',
-    'cust_housenr',
-    'cust_hnr_suff',
-    'cust_post_code',
-    'cust_town',
-    'cust_phone',
-    'bid_is_suspicious',
-)
-#~ event_path = lambda: 
-evt_src_switcher = {
-    # TODO: the following code is Py2 only.
-    # Py3 would be: unquote_plus(quoted_string, encoding='utf-8')
-    # S3-event is normal
-    'aws:s3'    : lambda rcd: unquote_plus(
-        rcd['s3']['object']['key'].encode('utf8')),
-    # SNS-event has the S3-event in it's Message-attribute
-    'aws:sns'   : lambda rcd: unquote_plus(json.loads(
-        rcd['Sns']['Message'])['Records'][0]['s3']['object']['key'].encode('utf8')),
-}
-
-def get_s3_record(event):
-    if event['Records'][0]['EventSource'] == 'aws:s3':
-        return event['Records'][0]['s3']
-    elif event['Records'][0]['EventSource'] == 'aws:sns':
-        return json.loads(event['Records'][0]['Sns']['Message'])['Records'][0]['s3']
-
-def get_key_from_event(event):
-    quoted_key = get_s3_record(event)['object']['key']
-    if PY_3:
-        return unquote_plus(quoted_key, encoding='utf8')
-    else:
-        return unquote_plus(quoted_key.encode('utf8'))
-        #~ return evt_src_switcher[event['Records'][0]['EventSource']](event['Records'][0])
-
-def get_bucket_from_event(event):
-    quoted_bucket = get_s3_record(event)['bucket']['name']
-    if PY_3:
-        return unquote_plus(quoted_bucket, encoding='utf8')
-    else:
-        return unquote_plus(quoted_bucket.encode('utf8'))
-
+# The clean csv's columns (see lambda_common/auction_schema.py)
+header_list_clean = auction_schema.CLEAN_HEADER
 def get_delegated_credentials(email):
+    from oauth2client.service_account import ServiceAccountCredentials
     log.debug('Authenticating with delegated user creds...')
     json_file = os.environ['JSON_FILE']
     scopes = ['https://www.googleapis.com/auth/drive', ]
     creds = ServiceAccountCredentials.from_json_keyfile_name(json_file, scopes)
     return creds.create_delegated(email)
 
-def csv_to_list_of_tuples(csvfile_path):
-    """Read in a csv file (from path) and return a list of tuples.
-       Header line is skipped."""
-    with open(csvfile_path, 'rb') as f:
-        rdr = csv.reader(f, delimiter=',', quotechar='"')
-        # Skip header line
-        #~ header = rdr.next()
-        return list(map(tuple, rdr))
-
-def lot_to_csv_file(lot, file_path, quoting=csv.QUOTE_ALL):
-    with open(file_path, 'wb') as f:
-        wrt = csv.writer(f, delimiter=',', quotechar='"', quoting=quoting)
-        # Insert header row again
-        #~ wrt.writerow(header_list_clean)
-        for line in lot:
-            l = ["'"+field for field in line]
-            wrt.writerow(tuple(l))
-
-def prepare_csv_for_google(csvfile_path):
-    # Read to tuples
-    lot = csv_to_list_of_tuples(csvfile_path)
-    # Change date timezone?
-    # not for now: keep UTC
-    # Save back to file_path
-    lot_to_csv_file(lot, csvfile_path)
+def get_drive_service(credentials):
+    import httplib2
+    from apiclient import discovery
+    http = credentials.authorize(httplib2.Http())
+    return discovery.build('drive', 'v3', http=http)
+
+# Bytes per request of the resumable upload (a multiple of 256 KB)
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# Locale of GOOGLE_LOGIN_EMAIL's account: Drive converts the csv with it
+SHEET_LOCALE = os.environ.get('SHEET_LOCALE') or 'en_US'
+# Locales that write 1234.50; the others (nl_BE, fr_BE, ...) 1234,50
+DECIMAL_POINT_LANGUAGES = ('en', 'ja', 'ko', 'zh', 'th', 'he', 'iw', 'hi')
+DECIMAL_POINT_LOCALES = ('de_CH', 'fr_CH', 'it_CH')
+
+def decimal_comma(locale):
+    return not (locale.split('_')[0] in DECIMAL_POINT_LANGUAGES
+                or locale in DECIMAL_POINT_LOCALES)
+
+# Sheets converts a csv cell that looks like a number, date, boolean or
+# formula: a leading ' keeps it text (and is not shown)
+def as_text(value):
+    if value and (value[0] in u"=+-@'" or value[0].isdigit()
+                  or value.upper() in (u'TRUE', u'FALSE')):
+        return u"'" + value
+    return value
+
+def as_number(value):
+    """An amount ('12.50') as the account's locale writes it."""
+    if DECIMAL_COMMA:
+        return value.replace(u'.', u',')
+    return value
+
+def as_datetime(value):
+    """'2017-05-01T10:00:00Z' (not a date to Sheets): '2017-05-01 10:00:00'."""
+    return value.replace(u'T', u' ').rstrip(u'Z')
+
+def type_hint(mysql_type):
+    t = mysql_type.split('(')[0].upper()
+    if t in ('INTEGER', 'INT', 'DECIMAL', 'BOOLEAN'):
+        return as_number
+    if t == 'DATETIME':
+        return as_datetime
+    return as_text
+
+DECIMAL_COMMA = decimal_comma(SHEET_LOCALE)
+
+# Column name: function that makes its value what Sheets should import
+COLUMN_HINTS = dict((c.name, type_hint(c.mysql))
+                    for c in auction_schema.CLEAN_COLUMNS)
+
+def sheet_rows(rows):
+    """The rows of a clean csv (header first) as Sheets should import
+       them: numbers and dates as such, the rest as text. Unknown columns
+       are text."""
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    yield header
+    hints = [COLUMN_HINTS.get(name, as_text) for name in header]
+    for row in rows:
+        yield [hint(value) for hint, value in zip(hints, row)]
+
+
+class CsvRowsStream(object):
+    """The csv (bytes) of `rows`, written as a resumable upload asks for
+       it: getbytes() only goes forward, so only the current chunk is kept
+       in memory. The size is unknown until the last (short) chunk."""
+
+    def __init__(self, rows, chunk_size=UPLOAD_CHUNK_SIZE):
+        self._rows      = iter(rows)
+        self._chunk_size = chunk_size
+        self._buf       = io.BytesIO()
+        self._wrt       = csv.writer(self._buf, delimiter=',', quotechar='"',
+                                     quoting=csv.QUOTE_MINIMAL)
+        # The bytes from `_offset` on that were written
+        self._data      = b''
+        self._offset    = 0
+        self._done      = False
+        self.rows       = 0
+
+    def chunksize(self):
+        return self._chunk_size
+
+    def mimetype(self):
+        return 'text/csv'
+
+    def size(self):
+        return None
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def _fill(self, end):
+        written = self._offset + len(self._data)
+        for row in self._rows:
+            self._wrt.writerow(row)
+            self.rows += 1
+            if written + self._buf.tell() >= end:
+                break
+        else:
+            self._done = True
+        self._data += self._buf.getvalue()
+        self._buf.seek(0)
+        self._buf.truncate()
+
+    def getbytes(self, begin, length):
+        if begin < self._offset:
+            raise IOError('Upload went back to byte %s, only %s and later '
+                          'is kept.' % (begin, self._offset))
+        # A byte more: is this the last chunk?
+        if not self._done and self._offset + len(self._data) <= begin + length:
+            self._fill(begin + length + 1)
+        # Everything before `begin` is uploaded
+        self._data = self._data[begin - self._offset:]
+        self._offset = begin
+        if self._done and len(self._data) == length and length:
+            # Only a short read ends the upload: the last line ends in
+            # \n instead of \r\n
+            return self._data[:-2] + b'\n'
+        return self._data[:length]
+
+def csv_media_upload(rows, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Resumable upload, in chunks, of the csv of `rows`."""
+    from googleapiclient.http import MediaUpload
+    class CsvRowsUpload(CsvRowsStream, MediaUpload):
+        pass
+    return CsvRowsUpload(rows, chunk_size)
 
 def delete_previous_sheets(service, folder_id, list_of_names=[]):
     query = "'" + folder_id + "'" + " in parents"
@@ -196,36 +232,54 @@ def delete_previous_sheets(service, folder_id, list_of_names=[]):
         response = service.files().delete(fileId=sh_id).execute()
 
 
-def lambda_handler(event, context):
-    if context:
-        bucket   = get_bucket_from_event(event)
-        key      = get_key_from_event(event)
-        filename = key.split('/')[-1:][0]
-        log.info("Handling key %s in bucket %s.", key, bucket)
-        log.debug("Filename is: %s.", filename)
-        # Get object from S3
-        with open('/tmp/tmp.csv', 'wb') as f:
-            s3_client.download_fileobj(bucket, key, f)
-    # Read in csv and prepare for Google Sheets
-    prepare_csv_for_google('/tmp/tmp.csv')
+def upload_to_google(bucket, key, size=None, etag=None):
+    filename = key.split('/')[-1:][0]
+    log.info("Handling key %s in bucket %s.", key, bucket)
+    log.debug("Filename is: %s.", filename)
+    # Straight from S3 to Google, a chunk at a time: no file, no list
+    with s3_reader.open_stream(s3_client, bucket, key, size,
+                               etag=etag) as f:
+        rdr = csv.reader(f, delimiter=',', quotechar='"')
+        file_id = upload_sheet(rdr, filename)
+    log.info('File ID: %s', file_id)
+    # Upload to Google Cloud Storage
+    #~ storage_service = storage.Client(project=GOOGLE_PROJECT_ID)
+
+def upload_sheet(rows, filename):
+    """Replace sheet `filename` in FOLDER_ID by the clean csv `rows`
+       (header first). Returns the file ID."""
     # Google Auth
-    credentials = get_delegated_credentials(google_login_email)
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
+    with metrics.timer('google_auth'):
+        credentials = get_delegated_credentials(GOOGLE_LOGIN_EMAIL)
+        service = get_drive_service(credentials)
     # Find and delete previous sheets in folder
-    delete_previous_sheets(service, FOLDER_ID, [filename, ])
+    with metrics.timer('google_delete'):
+        delete_previous_sheets(service, FOLDER_ID, [filename, ])
     file_metadata = {
       'name' : filename,
       'description': descriptions_by_filename.get(filename),
       'parents': [ FOLDER_ID ],
       'mimeType' : 'application/vnd.google-apps.spreadsheet',
     }
-    media = MediaFileUpload('/tmp/tmp.csv', mimetype='text/csv', resumable=True)
-    f = service.files().create(body=file_metadata, media_body=media,
-                               fields='id').execute()
-    log.info('File ID: %s', f.get('id'))
-    # Upload to Google Cloud Storage
-    #~ storage_service = storage.Client(project=GOOGLE_PROJECT_ID)
+    media = csv_media_upload(sheet_rows(rows))
+    # Reading, hinting and uploading in one go: this times all three
+    with metrics.timer('google_upload'):
+        request = service.files().create(body=file_metadata,
+                                         media_body=media, fields='id')
+        f = None
+        while f is None:
+            status, f = request.next_chunk(num_retries=3)
+    # Not the header
+    metrics.count('Rows', max(media.rows - 1, 0), stage='google_upload')
+    return f.get('id')
+
+@metrics.instrumented
+def lambda_handler(event, context):
+    # S3, SNS(S3), SQS(S3) or EventBridge: every record
+    for obj in events.iter_s3_objects(event):
+        with idempotency.once_object('auction_csv_to_google', obj) as first:
+            if first:
+                upload_to_google(obj.bucket, obj.key, obj.size, obj.etag)
 
 def main():
     from mock_event import event
@@ -24,8 +24,11 @@
 # This AWS λ-function:
 #
 #   - downloads /clean_csv/diff.csv from s3://bdm-auction-export
-#   - adds (via REPLACE) these records to `AuctionsRaw`-table on
-#     MySQL RDS
+#   - adds these records to `AuctionsRaw`-table on MySQL RDS (INSERT ...
+#     ON DUPLICATE KEY UPDATE on auc_id); a row whose OGM belongs to
+#     another auc_id is left out (with a warning)
+#   - updates the summary tables of `AuctionsRaw` (per day and partner)
+#     in the same transaction, see summary_tables.py
 #   - is triggered by the arrival of the diff.csv file on S3
 #     (via SNS fan-out)
 # 
@@ -39,19 +42,21 @@ from __future__ import print_function
 import os
 import logging
 import json
-PY_3 = False
-try:                    
-    from urllib.parse import unquote_plus   # Python 3
-    PY_3 = True
-except ImportError:    
-    from urllib import unquote_plus         # Python 2
 import pymysql
 from pymysql.err import IntegrityError
-from base64 import b64decode
 # 3th party
 import unicodecsv as csv
-import boto3
-from botocore.client import Config
+# Own
+from lambda_common import alerts
+from lambda_common import auction_schema
+from lambda_common import aws_clients
+from lambda_common import events
+from lambda_common import idempotency
+from lambda_common import kms_secrets
+from lambda_common import metrics
+from lambda_common import s3_reader
+from lambda_common.mysql_conn import ConnectionManager
+import summary_tables
 
 
 # Logging
@@ -63,17 +68,9 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno
 ch.setFormatter(formatter)
 log.addHandler(ch)
 
-# Decrypt function to retrieve sensitive key-value pairs from AWS KMS
-def decrypt(env_var):
-    ENCRYPTED = os.environ[env_var]
-    return boto3.client('kms').decrypt(CiphertextBlob=b64decode(ENCRYPTED))['Plaintext']
-
 def make_fields_list(header_list):
     return ', '.join(['`{}`'.format(f[1]) for f in header_list])
 
-def make_create_fields_list(header_list):
-    return ', '.join(['`{}` {}'.format(f[1], f[2]) for f in header_list])
-
 # Some constants
 MYSQL = {
     'type'        : 'mysql',
@@ -81,115 +78,188 @@ MYSQL = {
     'port'        : 3306,
     'db_name'     : os.environ['MYSQL_DB_NAME'],
     'db_username' : os.environ['MYSQL_DB_USERNAME'],
-    'db_password' : decrypt('MYSQL_DB_PASSWORD'),
     'table_name'  : os.environ['MYSQL_TABLE_NAME'],
 }
 
-HEADER_LIST = [
-    ('OGM_code', 'ogm', 'VARCHAR(12) UNIQUE NOT NULL'),
-    ('Partner_Titel', 'pa_title', 'VARCHAR(255)'),
-    ('Veiling_Titel', 'auc_title', 'VARCHAR(255)'),
-    ('Veiling_ID', 'auc_id', 'INTEGER UNIQUE NOT NULL'),
-    ('Veiling_link', 'auc_link', 'VARCHAR(255)'),
-    ('Hoogste_bod', 'high_bid', 'DECIMAL(5,2)'),
-    ('Administratiekost', 'admin_cost', 'DECIMAL(5,2)'),
-    ('Garante_prijs', 'garant_price', 'DECIMAL(5,2)'),
-    ('Datum_Hoogste_bod', 'date_high_bid', 'DATETIME'),
-    ('Betaal_datum', 'pay_date', 'DATETIME'),
-    ('Annuleringsverzekering', 'annul_ins', 'DECIMAL(5,2)'),
-    ('Full_option', 'full_option', 'DECIMAL(5,2)'),
-    ('Annulatie_datum', 'annul_date', 'DATETIME'),
-    ('Inningsdatum', 'collect_date', 'DATETIME'),
-    ('Extra_informatie', 'extra_info', 'TEXT'),
-    ('Clang_ID', 'clang_id', 'INTEGER'),
-    ('Klant_Voornaam', 'cust_fname', 'VARCHAR(255)'),
-    ('Klant_Achternaam', 'cust_lname', 'VARCHAR(255)'),
-    ('Klant_Email', 'cust_email', 'VARCHAR(255)'),
-    ('Klant_Straat', 'cust_street', 'VARCHAR(255)'),
-    ('Klant_Nummer', 'cust_housenr', 'VARCHAR(255)'),
-    ('Klant_Toevoeging', 'cust_hnr_suff', 'VARCHAR(255)'),
-    ('Klant_Postcode', 'cust_post_code', 'VARCHAR(255)'),
-    ('Klant_Gemeente', 'cust_town', 'VARCHAR(255)'),
-    ('Klant_Telefoon', 'cust_phone', 'VARCHAR(255)'),
-    ('bid_is_suspicious', 'bid_is_suspicious', 'BOOLEAN'),
-]
+# The columns of the clean csv, with their MySQL types: see
+# lambda_common/auction_schema.py
+HEADER_LIST = [(c.export, c.name, c.mysql)
+               for c in auction_schema.CLEAN_COLUMNS]
 
 IS_SUSP_FIELD = ()
 
-CREATE_SQL = """CREATE TABLE `{table_name}` (
-    {field_list}, PRIMARY KEY ( auc_id )
-) DEFAULT CHARSET=utf8;""".format(table_name=MYSQL['table_name'],
-             field_list=make_create_fields_list(HEADER_LIST))
+# With the indexes: created on the first load, migrations with
+# migrate_table.py
+CREATE_SQL = auction_schema.create_sql(MYSQL['table_name'])
+
+# The key of an auction: never updated. OGM is unique too, but an auction
+# can get a new one (ogm_conflicts leaves out an OGM of another auc_id)
+KEY_FIELDS = ('auc_id', )
 
-INSERT_SQL = """REPLACE INTO `{table_name}` ({field_list}) VALUES (
+def make_update_list(header_list):
+    return ', '.join(['`{0}`=VALUES(`{0}`)'.format(f[1]) for f in header_list
+                      if f[1] not in KEY_FIELDS])
+
+# clean_auction_csv hands over unique auc_id's and OGM's: update the
+# existing row in place (instead of REPLACE's delete + insert). Unchanged
+# rows aren't written at all.
+INSERT_SQL = """INSERT INTO `{table_name}` ({field_list}) VALUES (
     {plcs}
-);""".format(table_name=MYSQL['table_name'],
+) ON DUPLICATE KEY UPDATE {update_list};""".format(
+            table_name=MYSQL['table_name'],
             field_list=make_fields_list(HEADER_LIST),
-            plcs=','.join(['%s' for i in range(len(HEADER_LIST))]))
+            plcs=','.join(['%s' for i in range(len(HEADER_LIST))]),
+            update_list=make_update_list(HEADER_LIST))
+
+# Position of auc_id and OGM in the rows of the diff
+AUC_ID = [f[1] for f in HEADER_LIST].index('auc_id')
+OGM = [f[1] for f in HEADER_LIST].index('ogm')
+
+# OGM conflicts go where the corrupt exports go
+CORRUPT_CSV_TOPIC_ARN = 'arn:aws:sns:eu-central-1:625469223576:Corrupt_Auction_CSV'
 
-tmp_file = '/tmp/diff.csv'
+# Summary tables (see summary_tables.py), SUMMARY_TABLES=0 to turn off
+SUMMARY_TABLES = os.environ.get('SUMMARY_TABLES', '1') != '0'
+# The tables are checked (and created if needed) once per container
+_tables_checked = False
 
-# Initialize boto3-clients per container
+# boto3-clients per container (created on first use)
 region_name = 'eu-central-1'
-s3_client   = boto3.client('s3', config=Config(signature_version='s3v4'))
+s3_client   = aws_clients.lazy_client('s3', signature_version='s3v4')
 
-# Init MySQL conn
-db_conn = pymysql.connect(MYSQL['host'],
+# MySQL conn (checked before use, reconnects if needed)
+db = ConnectionManager(MYSQL['host'],
     port=MYSQL['port'],
     user=MYSQL['db_username'],
-    passwd=MYSQL['db_password'],
+    password=lambda: kms_secrets.decrypt('MYSQL_DB_PASSWORD'),
     db=MYSQL['db_name'],
     charset='utf8',
     connect_timeout=5)
 
-def get_s3_record(event):
-    if event['Records'][0]['EventSource'] == 'aws:s3':
-        return event['Records'][0]['s3']
-    elif event['Records'][0]['EventSource'] == 'aws:sns':
-        return json.loads(event['Records'][0]['Sns']['Message'])['Records'][0]['s3']
-
-def get_key_from_event(event):
-    quoted_key = get_s3_record(event)['object']['key']
-    if PY_3:
-        return unquote_plus(quoted_key, encoding='utf8')
-    else:
-        return unquote_plus(quoted_key.encode('utf8'))
-        #~ return evt_src_switcher[event['Records'][0]['EventSource']](event['Records'][0])
-
-def get_bucket_from_event(event):
-    quoted_bucket = get_s3_record(event)['bucket']['name']
-    if PY_3:
-        return unquote_plus(quoted_bucket, encoding='utf8')
-    else:
-        return unquote_plus(quoted_bucket.encode('utf8'))
-
-def csv_to_list_of_tuples(csvfile_path):
-    """Read in a csv file and return a list of tuples."""
-    with open(csvfile_path, 'rb') as f:
-        rdr = csv.reader(f, delimiter=',', quotechar='"')
-        # Skip header line
-        header = rdr.next()
-        return list(map(tuple, rdr))
+def csv_to_list_of_tuples(f):
+    """Read in a csv file (object) and return a list of tuples."""
+    rdr = csv.reader(f, delimiter=',', quotechar='"')
+    # Skip header line
+    header = rdr.next()
+    return list(map(tuple, rdr))
+
+def load_diff(bucket, key, size=None, etag=None):
+    # Get today's diff file: parsed while the rest is being downloaded
+    log.info('Get %s from %s.', key, bucket)
+    with metrics.timer('download_parse'):
+        with s3_reader.open_stream(s3_client, bucket, key, size,
+                                   etag=etag) as f:
+            diff_lot = csv_to_list_of_tuples(f)
+    metrics.count('Rows', len(diff_lot), stage='parse')
+    upsert_diff(diff_lot)
+
+def prepare_tables():
+    """Create the table and the summary tables (filled from it) that don't
+       exist yet: before a load, CREATE TABLE ends a transaction. A table
+       that differs from the schema is only reported: a type change
+       copies the table, which can take longer than a λ may run."""
+    global _tables_checked
+    if _tables_checked:
+        return
+    table = MYSQL['table_name']
+    def prepare(cursor):
+        described = auction_schema.describe(cursor, table)
+        if described is None:
+            log.info('Creating table %s.', table)
+            cursor.execute(CREATE_SQL)
+        else:
+            pending = auction_schema.plan_migration(table, *described)
+            if pending:
+                log.warn('Table %s differs from the schema, run '
+                         'migrate_table.py: %s', table, ' '.join(pending))
+        if SUMMARY_TABLES:
+            created = summary_tables.create(cursor, table)
+            if created:
+                log.info('Summary tables created: %s', ', '.join(created))
+    db.run(prepare)
+    _tables_checked = True
+
+def ogm_conflicts(cursor, table, diff_lot):
+    """[(row, auc_id)] of the rows of `diff_lot` whose OGM belongs to
+       another auc_id in `table`: ON DUPLICATE KEY would update that row
+       (UNIQUE ogm) instead. Locks the rows found till the commit."""
+    owners = dict()
+    ogms = sorted(set(row[OGM] for row in diff_lot))
+    for i in range(0, len(ogms), summary_tables.BATCH_SIZE):
+        batch = ogms[i:i + summary_tables.BATCH_SIZE]
+        cursor.execute('SELECT `ogm`, `auc_id` FROM `%s` WHERE `ogm` IN (%s) '
+                       'FOR UPDATE' % (table, ','.join(['%s'] * len(batch))),
+                       batch)
+        owners.update((ogm, u'%s' % auc_id)
+                      for ogm, auc_id in cursor.fetchall())
+    return [(row, owners[row[OGM]]) for row in diff_lot
+            if row[OGM] in owners and owners[row[OGM]] != row[AUC_ID]]
+
+def send_conflicts_warning(conflicts):
+    """Send out a warning about the rows left out: their OGM belongs to
+       another auc_id."""
+    msg = '\n'.join(['auc_id %s: OGM %s is van auc_id %s' % (
+                      row[AUC_ID], row[OGM], auc_id)
+                      for row, auc_id in conflicts])
+    alerts.send(CORRUPT_CSV_TOPIC_ARN,
+                'OPGELET: OGM conflict: %s rijen niet geladen in %s.' % (
+                    len(conflicts), MYSQL['table_name']),
+                msg)
+    log.warn('%s rows not loaded: their OGM belongs to another auc_id.' %
+             len(conflicts))
+
+def upsert_diff(diff_lot):
+    """Upsert the rows of the diff (clean csv columns, as text), and
+       apply them to the summary tables in the same transaction. Rows
+       whose OGM belongs to another auc_id are left out."""
+    log.debug(diff_lot[0] if diff_lot else None)
+    log.debug(INSERT_SQL)
+    table = MYSQL['table_name']
+    if diff_lot:
+        prepare_tables()
+    def upsert_rows(cursor):
+        conflicts = ogm_conflicts(cursor, table, diff_lot)
+        skip = set(row[AUC_ID] for row, _ in conflicts)
+        rows = [row for row in diff_lot if row[AUC_ID] not in skip]
+        auc_ids = [row[AUC_ID] for row in rows]
+        summaries = SUMMARY_TABLES and bool(rows)
+        if summaries:
+            # Out with the rows as they were...
+            summary_tables.apply(cursor, table, auc_ids, -1)
+        # pymysql turns this into multi-row INSERTs; the text of the csv
+        # as MySQL values ('True' -> 1, '' -> NULL, ...)
+        affected = cursor.executemany(
+            INSERT_SQL, [auction_schema.mysql_row(row) for row in rows])
+        if summaries:
+            # ...and in as they are now
+            summary_tables.apply(cursor, table, auc_ids, +1)
+            summary_tables.prune(cursor, table)
+        return affected, conflicts
+    # The upsert is idempotent: the whole batch can be run again
+    with metrics.timer('db_load'):
+        affected, conflicts = db.run(upsert_rows, idempotent=True)
+    metrics.count('Conflicts', len(conflicts), stage='db_load')
+    if conflicts:
+        send_conflicts_warning(conflicts)
+    # Affected rows: 1 per insert, 2 per update, 0 per unchanged row
+    log.info('%s rows upserted in %s (%s affected). MySQL stats: %s',
+             len(diff_lot) - len(conflicts), MYSQL['table_name'], affected,
+             db.stats)
 
+@metrics.instrumented
+@alerts.instrumented
 def lambda_handler(event, context):
-    bucket   = get_bucket_from_event(event)
-    key      = get_key_from_event(event)
-    log.debug("Bucket is: %s", bucket)
-    log.debug("Key is: %s", key)
-    if key != 'clean_csv/diff.csv':
-        log.info("Exiting: not diff.csv")
-    else:
-        # Get today's diff file
-        log.info('Get %s from %s.', key, bucket)
-        with open(tmp_file, 'wb') as f:
-            s3_client.download_fileobj(bucket, key, f)
-        diff_lot = csv_to_list_of_tuples(tmp_file)
-        log.debug(diff_lot[0])
-        log.debug(INSERT_SQL)
-        with db_conn.cursor() as cursor:
-            for row in diff_lot:
-                cursor.execute(INSERT_SQL, row)
-        db_conn.commit()
+    # S3, SNS(S3), SQS(S3) or EventBridge: every record
+    for obj in events.iter_s3_objects(event):
+        log.debug("Bucket is: %s", obj.bucket)
+        log.debug("Key is: %s", obj.key)
+        if obj.key != 'clean_csv/diff.csv':
+            log.info("Skipping %s: not diff.csv", obj.key)
+            continue
+        with idempotency.once_object('auction_csv_to_raw_mysql', obj) as first:
+            if first:
+                load_diff(obj.bucket, obj.key, obj.size, obj.etag)
+    db.report(metrics)
 
 def main():
     from mock_event import event
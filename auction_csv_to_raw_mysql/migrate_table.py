@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  migrate_table.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Bring `AuctionsRaw` (MYSQL_TABLE_NAME) up to the schema in
+#  lambda_common/auction_schema.py, with the loader's connection (the
+#  MYSQL_* environment variables):
+#
+#   $ python migrate_table.py               # print the ALTER TABLEs
+#   $ python migrate_table.py --apply       # ...and run them
+#
+#  Not run by the λ itself: a type change copies the table.
+#
+###############################################################################
+
+from __future__ import print_function
+import sys
+import argparse
+
+from lambda_common import auction_schema
+import auction_csv_to_raw_mysql as loader
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Migrate the AuctionsRaw table to the auction schema.')
+    parser.add_argument('--apply', action='store_true',
+                        help='run the statements (default: only print them)')
+    args = parser.parse_args(argv)
+    table = loader.MYSQL['table_name']
+    statements = loader.db.run(lambda cursor: auction_schema.migrate(
+        cursor, table, dry_run=not args.apply))
+    for sql in statements:
+        print(sql)
+    if not statements:
+        print('%s is up to date.' % table)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  summary_tables.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Pre-aggregated tables next to AuctionsRaw, kept up to date by every load
+#  (in its transaction) instead of scanning AuctionsRaw for every report:
+#
+#   <table>_partner_day: per day of the highest bid and partner: auctions,
+#       sum of the highest bids, paid, annulled, collected and suspicious
+#   <table>_revenue_day: per pay day and partner: paid, annulled and the
+#       revenue (bid + costs + options) of what's paid and not annulled
+#
+#  The dates in AuctionsRaw are UTC (as in the clean csv); a day is a
+#  day in Brussels (TIME_ZONE), the business day: CONVERT_TZ needs the
+#  server's time zone tables (RDS has them, else mysql_tzinfo_to_sql).
+#
+#  A load subtracts the groups of the auc_ids of the diff as they are in
+#  AuctionsRaw, upserts the diff and adds them again:
+#
+#   summary_tables.apply(cursor, table, auc_ids, -1)
+#   cursor.executemany(INSERT_SQL, diff_lot)
+#   summary_tables.apply(cursor, table, auc_ids, +1)
+#   summary_tables.prune(cursor, table)
+#
+#  Both deltas and the full rebuild are the same GROUP BY on the server,
+#  so they always agree. Check (or redo) them from scratch:
+#
+#   $ python summary_tables.py verify
+#   $ python summary_tables.py rebuild
+#
+###############################################################################
+
+from __future__ import print_function
+import sys
+import logging
+import argparse
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+# auc_ids per delta query
+BATCH_SIZE      = 1000
+
+# `keys`: [(column, type, expression)] grouped on, `measures`: [(column,
+# type, expression)] summed, the first one a count (a group is gone at 0),
+# of the AuctionsRaw rows `where` holds
+Summary = namedtuple('Summary', ['name', 'keys', 'measures', 'where'])
+
+# The business day; `day` columns are dates there
+TIME_ZONE       = 'Europe/Brussels'
+
+def local_day(column):
+    return "DATE(CONVERT_TZ(%s, '+00:00', '%s'))" % (column, TIME_ZONE)
+
+PARTNER = ('pa_title', 'VARCHAR(255) NOT NULL', "COALESCE(pa_title, '')")
+PAID_AMOUNT = ('COALESCE(high_bid, 0) + COALESCE(admin_cost, 0) + '
+               'COALESCE(annul_ins, 0) + COALESCE(full_option, 0)')
+
+SUMMARIES = [
+    Summary('partner_day',
+        keys=[('day', 'DATE NOT NULL', local_day('date_high_bid')),
+              PARTNER],
+        measures=[
+            ('auctions',    'INTEGER',          '1'),
+            ('high_bids',   'DECIMAL(14,2)',    'COALESCE(high_bid, 0)'),
+            ('paid',        'INTEGER',          'pay_date IS NOT NULL'),
+            ('annulled',    'INTEGER',          'annul_date IS NOT NULL'),
+            ('collected',   'INTEGER',          'collect_date IS NOT NULL'),
+            ('suspicious',  'INTEGER',          'COALESCE(bid_is_suspicious, 0)'),
+        ],
+        where='date_high_bid IS NOT NULL'),
+    Summary('revenue_day',
+        keys=[('day', 'DATE NOT NULL', local_day('pay_date')), PARTNER],
+        measures=[
+            ('paid',        'INTEGER',          '1'),
+            ('annulled',    'INTEGER',          'annul_date IS NOT NULL'),
+            ('revenue',     'DECIMAL(14,2)',
+             'IF(annul_date IS NULL, %s, 0)' % PAID_AMOUNT),
+        ],
+        where='pay_date IS NOT NULL'),
+]
+
+
+def table_name(table, summary):
+    return '%s_%s' % (table, summary.name)
+
+def _columns(summary):
+    return [c[0] for c in summary.keys + summary.measures]
+
+def create_sql(table, summary):
+    fields = ['`%s` %s' % (c, t) for c, t, _ in summary.keys] + \
+             ['`%s` %s NOT NULL DEFAULT 0' % (c, t)
+              for c, t, _ in summary.measures]
+    return """CREATE TABLE IF NOT EXISTS `{name}` (
+    {fields}, PRIMARY KEY ( {keys} )
+) DEFAULT CHARSET=utf8;""".format(name=table_name(table, summary),
+            fields=', '.join(fields),
+            keys=', '.join('`%s`' % c[0] for c in summary.keys))
+
+def select_sql(table, summary, sign='', condition=''):
+    """The groups of `table` (AuctionsRaw), `sign` '-' for negative sums,
+       of the rows that match `condition` too."""
+    exprs = ['%s AS `%s`' % (e, c) for c, _, e in summary.keys] + \
+            ['%sSUM(%s) AS `%s`' % (sign, e, c) for c, _, e in summary.measures]
+    where = summary.where + (' AND ' + condition if condition else '')
+    return 'SELECT {exprs} FROM `{table}` WHERE {where} GROUP BY {groups}'.format(
+            exprs=', '.join(exprs), table=table, where=where,
+            groups=', '.join(str(n + 1) for n in range(len(summary.keys))))
+
+def delta_sql(table, summary, sign, count):
+    """Add (`sign` +1) or subtract (-1) the groups of `count` auc_ids."""
+    columns = ', '.join('`%s`' % c for c in _columns(summary))
+    updates = ', '.join('`{0}`=`{0}`+VALUES(`{0}`)'.format(c)
+                        for c, _, _ in summary.measures)
+    condition = 'auc_id IN (%s)' % ','.join(['%s'] * count)
+    # A derived table: VALUES() of a GROUP BY isn't allowed directly
+    return """INSERT INTO `{name}` ({columns}) SELECT * FROM (
+    {select}
+) AS delta ON DUPLICATE KEY UPDATE {updates};""".format(
+            name=table_name(table, summary), columns=columns,
+            select=select_sql(table, summary, '-' if sign < 0 else '',
+                              condition),
+            updates=updates)
+
+def prune_sql(table, summary):
+    return 'DELETE FROM `%s` WHERE `%s` = 0;' % (table_name(table, summary),
+                                                 summary.measures[0][0])
+
+
+def check_time_zone(cursor):
+    """Raises ValueError if the server doesn't know TIME_ZONE: every day
+       would be NULL."""
+    cursor.execute("SELECT CONVERT_TZ('2017-01-01 12:00:00', '+00:00', %s)",
+                   (TIME_ZONE, ))
+    if cursor.fetchone()[0] is None:
+        raise ValueError('MySQL has no time zone %s: load its time zone '
+                         'tables (mysql_tzinfo_to_sql).' % TIME_ZONE)
+
+def create(cursor, table):
+    """Create the summary tables that don't exist yet, filled from
+       `table`. Not in a load's transaction: CREATE TABLE commits."""
+    check_time_zone(cursor)
+    created = list()
+    for summary in SUMMARIES:
+        name = table_name(table, summary)
+        if cursor.execute("SHOW TABLES LIKE %s", (name.replace('_', r'\_'), )):
+            continue
+        cursor.execute(create_sql(table, summary))
+        cursor.execute('INSERT INTO `%s` %s;' % (name,
+                                                 select_sql(table, summary)))
+        log.info('Created summary table %s.', name)
+        created.append(name)
+    return created
+
+def apply(cursor, table, auc_ids, sign):
+    """Add (`sign` +1) or subtract (-1) the rows of `auc_ids`, as they are
+       in `table` now, to the summary tables."""
+    auc_ids = list(auc_ids)
+    for summary in SUMMARIES:
+        for i in range(0, len(auc_ids), BATCH_SIZE):
+            batch = auc_ids[i:i + BATCH_SIZE]
+            cursor.execute(delta_sql(table, summary, sign, len(batch)), batch)
+
+def prune(cursor, table):
+    """Remove the groups that have no rows anymore."""
+    for summary in SUMMARIES:
+        cursor.execute(prune_sql(table, summary))
+
+def rebuild(cursor, table):
+    """Refill the summary tables from all of `table`."""
+    for summary in SUMMARIES:
+        name = table_name(table, summary)
+        # Not TRUNCATE: that would commit halfway
+        cursor.execute('DELETE FROM `%s`;' % name)
+        cursor.execute('INSERT INTO `%s` %s;' % (name,
+                                                 select_sql(table, summary)))
+        log.info('Rebuilt %s: %s groups.', name, cursor.rowcount)
+
+def verify(cursor, table):
+    """{summary table: [(group, stored, from scratch)]} of the groups
+       that differ from a full rebuild."""
+    differences = dict()
+    for summary in SUMMARIES:
+        n = len(summary.keys)
+        cursor.execute('SELECT %s FROM `%s`' % (
+            ', '.join('`%s`' % c for c in _columns(summary)),
+            table_name(table, summary)))
+        stored = dict((row[:n], row[n:]) for row in cursor.fetchall())
+        cursor.execute(select_sql(table, summary))
+        fresh = dict((row[:n], row[n:]) for row in cursor.fetchall())
+        differences[table_name(table, summary)] = [
+            (key, stored.get(key), fresh.get(key))
+            for key in sorted(set(stored) | set(fresh))
+            if stored.get(key) != fresh.get(key)]
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Verify or rebuild the summary tables of AuctionsRaw.')
+    parser.add_argument('command', choices=['verify', 'rebuild'])
+    args = parser.parse_args(argv)
+    # Its connection and table (the MYSQL_* environment variables)
+    import auction_csv_to_raw_mysql as loader
+    table = loader.MYSQL['table_name']
+    loader.db.run(lambda cursor: create(cursor, table))
+    if args.command == 'rebuild':
+        loader.db.run(lambda cursor: rebuild(cursor, table), idempotent=True)
+        return 0
+    differences = loader.db.run(lambda cursor: verify(cursor, table))
+    for name, diffs in sorted(differences.items()):
+        print('%s: %s groups differ' % (name, len(diffs)))
+        for key, stored, fresh in diffs:
+            print('  %s: %s, from scratch %s' % (key, stored, fresh))
+    return 1 if any(differences.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
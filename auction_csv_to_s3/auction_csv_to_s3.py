@@ -38,13 +38,17 @@
 ###############################################################################
 
 
+import io
+import os
 import logging
+import urllib
 from datetime import datetime
-from os.path import getsize
 # 3th party
 import requests
-import boto3
-from botocore.client import Config
+# Own
+from lambda_common import alerts
+from lambda_common import aws_clients
+from lambda_common import metrics
 
 # Logging
 log = logging.getLogger('auction_csv_to_s3')
@@ -63,62 +67,47 @@ auction_export_url = os.environ['AUCTION_EXPORT_URL']
 DEFAULT_ERR_SUBJ = 'Error in: auction_csv_to_s3.py'
 DEFAULT_ERR_MSG  = 'Error in: auction_csv_to_s3.py'
 
-# Download CSV as file to /tmp: easier for the csv-module
-# instead of: csv_string = response['Body'].read()
-tmp_file = '/tmp/tmp.csv'
-
 # Bucket & path to ship to
 bucket      = 'bdm-auction-exports'
 s3_key_fmt  = 'raw_csv/{y}/{m}/auctions-{y}-{m}-{d}.csv'
 s3_path_fmt = 's3://bdm-auction-exports/raw_csv/{y}/{m}/auctions-{y}-{m}-{d}.csv'
 
-# Initialize boto3-clients per container
+# boto3-clients per container (created on first use)
 region_name = 'eu-central-1'
-s3_client   = boto3.client('s3', config=Config(signature_version='s3v4'))
+s3_client   = aws_clients.lazy_client('s3', signature_version='s3v4')
 
 
 def send_out_warning(subject=DEFAULT_ERR_SUBJ,
                      msg=DEFAULT_ERR_MSG,
                      short_msg=''):
-    """Send out a warning through AWS SNS."""
-    client = boto3.client('sns', region_name='eu-west-1')
-    response = client.publish(
-        TopicArn            = os.environ['TOPIC_ARN'],
-        #~ MessageStructure    = 'json',
-        Subject             = subject,
-        Message             = msg,
-    )
+    """Send out a warning through AWS SNS (queued, see alerts)."""
+    alerts.send(os.environ['TOPIC_ARN'], subject, msg)
 
 def check_response(response):
     if not response.status_code in (200, 201):
         raise Exception
 
-def check_csv(csv_file_path):
-    size = getsize(csv_file_path)
+def check_csv(f):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
     if size < 100*1000:
         raise Exception('File size unusually small: %s bytes' % size)
 
-def add_object_to_S3(file_path, key, tag_dict=None):
+def add_object_to_S3(f, key, tag_dict=None):
+    func_params = {
+        'Key' : key,
+        'Bucket': bucket,
+        'ContentType' : 'text/csv',
+        'ContentEncoding' : 'utf-8',
+        'Body' : f,
+    }
     if tag_dict:
         func_params['Tagging'] = urllib.urlencode(tag_dict)
-    with open(tmp_file, 'rb') as f:
-        func_params = {
-            'Key' : key,
-            'Bucket': bucket,
-            'ContentType' : 'text/csv',
-            'ContentEncoding' : 'utf-8',
-            'Body' : f,
-        }
-        res = s3_client.put_object(**func_params)
-    return res
+    return s3_client.put_object(**func_params)
 
-def lambda_handler(event, context):
-    log.debug(event)
-    log.debug(context)
-    if not context:
-        today_str = event.today
-    else:
-        today_str = datetime.today().strftime('%Y-%m-%d')
+def export_url_and_key(today_str):
+    """The export's URL and S3-key for date `today_str` (yyyy-mm-dd)."""
     y = today_str.split('-')[0:1][0]
     m = today_str.split('-')[1:2][0]
     d = today_str.split('-')[2:3][0]
@@ -128,32 +117,57 @@ def lambda_handler(event, context):
     s3_path = s3_path_fmt.format(y=y, m=m, d=d)
     s3_key  = s3_key_fmt.format(y=y, m=m, d=d)
     log.debug('S3 path is: %s.', s3_path)
+    return url, s3_key
+
+def fetch_export(url):
+    """The export's content, or None (a warning is sent out)."""
     try:
-        response = requests.get(url)
+        with metrics.timer('download'):
+            response = requests.get(url)
     except requests.exceptions.ConnectionError as e:
         log.error(e)
         send_out_warning(msg='Request failed: %s' % e)
+        return None
+    try:
+        check_response(response)
+    except Exception as e:
+        log.error(e)
+        send_out_warning(msg='Error in response: %s' % response.text)
+        return None
+    metrics.put('Bytes', len(response.content), 'Bytes', stage='download')
+    return response.content
+
+def check_export(f, url):
+    """check_csv, with a warning (and the exception raised again)."""
+    try:
+        check_csv(f)
+    except Exception as e:
+        log.error(e)
+        send_out_warning(msg='CSV not ok.\n%s\nExport URL is: "%s"' % (e, url))
+        raise
+    log.info("All good...")
+
+@metrics.instrumented
+@alerts.instrumented
+def lambda_handler(event, context):
+    log.debug(event)
+    log.debug(context)
+    if not context:
+        today_str = event.today
     else:
-        try:
-            check_response(response)
-        except Exception as e:
-            log.error(e)
-            send_out_warning(msg='Error in response: %s' % response.text)
-        else:
-            with open(tmp_file, 'wb') as f:
-                s = f.write(response.content)
-            try:
-                check_csv(tmp_file)
-            except Exception as e:
-                log.error(e)
-                send_out_warning(msg='CSV not ok.\n%s\nExport URL is: "%s"' % (e, url))
-                # Raise the exception again to Lambda
-                raise
-            else:
-                log.info("All good...")
-                # Upload to S3
-                r = add_object_to_S3(tmp_file, s3_key)
-                log.debug(r)
+        today_str = datetime.today().strftime('%Y-%m-%d')
+    url, s3_key = export_url_and_key(today_str)
+    content = fetch_export(url)
+    if content is None:
+        return
+    # Already in memory: a file object on it, not a spooled copy
+    f = io.BytesIO(content)
+    # Raises the exception again to Lambda
+    check_export(f, url)
+    # Upload to S3
+    with metrics.timer('upload'):
+        r = add_object_to_S3(f, s3_key)
+    log.debug(r)
 
 def main():
     class event(object):
@@ -0,0 +1 @@
+../auction_csv_to_google/auction_csv_to_google.py
\ No newline at end of file
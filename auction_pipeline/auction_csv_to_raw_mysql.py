@@ -0,0 +1 @@
+../auction_csv_to_raw_mysql/auction_csv_to_raw_mysql.py
\ No newline at end of file
@@ -0,0 +1 @@
+../auction_csv_to_s3/auction_csv_to_s3.py
\ No newline at end of file
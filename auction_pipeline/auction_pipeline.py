@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  auction_pipeline.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  auction_pipeline.py
+#
+#  AWS λ-function (and local command) that runs the whole auction chain in
+#  one process, instead of S3 notifications and SNS fan-out between
+#  functions:
+#
+#   fetch (auction_csv_to_s3) -> clean (clean_auction_csv) -> diff
+#       -> sinks, concurrently:
+#           - s3:     raw export, quality report, latest.csv (rotated),
+#                     diff.csv, history
+#           - events: change events
+#           - mysql:  diff upserted (auction_csv_to_raw_mysql)
+#           - google: latest.csv and diff.csv as sheets
+#                     (auction_csv_to_google)
+#
+#  The rows are handed over in memory: the previous export is read once,
+#  latest.csv and diff.csv aren't downloaded again by their consumers.
+#  The function modules are symlinked in this directory; they're only
+#  imported for the stages and sinks that run.
+#
+#  Triggered by the daily CloudWatch rule (today's export), or by raw
+#  exports arriving on S3 (reprocessed). Don't keep the notifications on
+#  raw_csv/ and clean_csv/ next to it: they'd run the chain again.
+#
+#   $ python auction_pipeline.py --date 2017-08-21
+#   $ python auction_pipeline.py --s3 raw_csv/2017/08/auctions-2017-08-21.csv
+#   $ python auction_pipeline.py --file auctions-2017-08-21.csv --dry-run
+#
+#   That's all...
+#
+###############################################################################
+
+from __future__ import print_function
+import io
+import os
+import sys
+import json
+import logging
+import argparse
+import itertools
+import importlib
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+# 3th party
+import unicodecsv as csv
+# Own
+from lambda_common import alerts
+from lambda_common import events
+from lambda_common import idempotency
+from lambda_common import metrics
+from lambda_common import s3_reader
+from lambda_common import scratch
+
+# Logging
+log = logging.getLogger('auction_pipeline')
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(message)s')
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+# Sink name: (modules it needs, function)
+SINKS = OrderedDict()
+# Comma separated, default: all
+PIPELINE_SINKS = os.environ.get('PIPELINE_SINKS') or ''
+
+DIFF_KEY = 'clean_csv/diff.csv'
+
+
+class SinkError(Exception):
+    pass
+
+
+def module(name):
+    """Function module `name`, imported on first use."""
+    return importlib.import_module(name)
+
+
+class Export(object):
+    """What the stages hand over to each other (and the sinks)."""
+
+    def __init__(self, bucket, filename):
+        self.bucket     = bucket
+        self.filename   = filename
+        # The raw export as fetched, with its S3-key (None if on S3)
+        self.raw        = None
+        self.raw_key    = None
+        # Clean rows (typed), their profile, as text (as in the csv)
+        self.rows       = None
+        self.profile    = None
+        self.text_rows  = None
+        # Rows of the previous export (None if there's none), whether
+        # latest.csv still has to be rotated, diff
+        self.previous   = None
+        self.rotate     = False
+        self.diff       = None
+
+
+# Stages
+
+def fetch(day_str):
+    """Download the export of `day_str` from the URL. Returns (S3-key,
+       content) or None."""
+    fetch_fn = module('auction_csv_to_s3')
+    url, key = fetch_fn.export_url_and_key(day_str)
+    content = fetch_fn.fetch_export(url)
+    if content is None:
+        return None
+    fetch_fn.check_export(io.BytesIO(content), url)
+    return key, content
+
+def clean(export, f=None, data=None):
+    """Parse the raw export (file object `f` or bytes `data`) and clean
+       it. A big `data` is cleaned in chunks over all CPUs."""
+    clean_fn = module('clean_auction_csv')
+    if data is not None and clean_fn.use_parallel(len(data)):
+        export.rows, export.profile = clean_fn.clean_rows_parallel(
+            data, export.filename)
+    else:
+        with metrics.timer('parse'):
+            lot = clean_fn.read_export(f or io.BytesIO(data))
+        export.rows, export.profile = clean_fn.clean_rows(lot, export.filename)
+    as_text = module('change_events').as_text
+    export.text_rows = [row.text() +
+                        (as_text(clean_fn.bid_is_suspicious(row)), )
+                        for row in export.rows]
+
+def _is_missing(e):
+    code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+    return type(e).__name__ == 'NoSuchKey' or code in ('404', 'NoSuchKey')
+
+def load_previous(export):
+    """The rows of the previous export: latest.csv, or yesterday.csv on a
+       retry after the s3 sink rotated it."""
+    clean_fn = module('clean_auction_csv')
+    key, export.rotate = clean_fn.previous_export(export.bucket,
+                                                  export.filename)
+    if key is None:
+        log.info('No previous export: everything is new.')
+        return
+    try:
+        with metrics.timer('previous'):
+            with s3_reader.open_stream(clean_fn.s3_client, export.bucket,
+                                       key) as f:
+                export.previous = list(clean_fn.clean_csv_rows(f))
+    except Exception as e:
+        if not _is_missing(e):
+            raise
+        log.info('No previous export (%s): everything is new.', key)
+
+def diff(export):
+    """The rows of which a RELFIELD changed since the previous export."""
+    clean_fn = module('clean_auction_csv')
+    with metrics.timer('diff'):
+        changed = clean_fn.lot_to_set_of_reltuples(export.text_rows,
+                                                   clean_fn.RELFIELDS)
+        if export.previous:
+            changed -= clean_fn.lot_to_set_of_reltuples(export.previous,
+                                                        clean_fn.RELFIELDS)
+        export.diff = clean_fn.get_diff_lot(changed, export.text_rows)
+    metrics.count('Rows', len(export.diff), stage='diff')
+
+
+# Sinks: run concurrently, each with its own scratch files
+
+def write_csv(rows, file_path, header):
+    with open(file_path, 'wb') as f:
+        wrt = csv.writer(f, delimiter=',', quotechar='"')
+        wrt.writerow(header)
+        wrt.writerows(rows)
+
+def sink_s3(export, scr):
+    clean_fn = module('clean_auction_csv')
+    if export.raw is not None:
+        with metrics.timer('archive'):
+            module('auction_csv_to_s3').add_object_to_S3(
+                io.BytesIO(export.raw), export.raw_key)
+    try:
+        clean_fn.publish_quality_report(export.bucket, export.filename,
+                                        export.profile)
+    except Exception as e:
+        # The report is no reason to stop the export
+        log.exception('Quality report failed: %s', e)
+    clean_fn.rotate_and_upload(export.bucket, export.filename, export.rows,
+                               scr.path('latest.csv'), True,
+                               rotate=export.rotate)
+    diff_path = scr.path('diff.csv')
+    write_csv(export.diff, diff_path, clean_fn.CLEAN_HEADER)
+    clean_fn.add_object_to_S3(diff_path, DIFF_KEY, export.bucket,
+                              tag_dict={'raw_object': export.filename})
+    if module('clean_history').is_available():
+        clean_fn.add_to_history(export.bucket, export.filename, export.rows,
+                                scr)
+
+def sink_events(export, scr):
+    clean_fn = module('clean_auction_csv')
+    if export.previous is None or clean_fn.CHANGE_EVENTS_SINK == 'none':
+        return
+    count = clean_fn.send_change_events(export.filename, export.rows,
+                                        export.previous)
+    metrics.count('ChangeEvents', count, stage='sink_events')
+
+def sink_mysql(export, scr):
+    mysql_fn = module('auction_csv_to_raw_mysql')
+    mysql_fn.upsert_diff(export.diff)
+    mysql_fn.db.report(metrics)
+
+def sink_google(export, scr):
+    google_fn = module('auction_csv_to_google')
+    header = module('clean_auction_csv').CLEAN_HEADER
+    for filename, rows in (('latest.csv', export.text_rows),
+                           ('diff.csv', export.diff)):
+        # Streamed to the upload: no csv file in between
+        sheet_id = google_fn.upload_sheet(itertools.chain([header], rows),
+                                          filename)
+        log.info('%s: sheet %s.', filename, sheet_id)
+
+SINKS['s3']     = (('clean_auction_csv', 'auction_csv_to_s3', 'clean_history'),
+                   sink_s3)
+SINKS['events'] = (('clean_auction_csv', ), sink_events)
+SINKS['mysql']  = (('auction_csv_to_raw_mysql', ), sink_mysql)
+SINKS['google'] = (('auction_csv_to_google', ), sink_google)
+
+def run_sinks(export, names, scr):
+    """Run the sinks `names` concurrently. Raises SinkError (after all of
+       them are done) if any failed."""
+    # Imported here, not in the threads
+    for name in names:
+        for module_name in SINKS[name][0]:
+            module(module_name)
+    def run_sink(name):
+        with metrics.timer('sink_' + name):
+            SINKS[name][1](export, scr)
+    results = OrderedDict()
+    with ThreadPoolExecutor(max_workers=max(1, len(names))) as executor:
+        futures = [(name, executor.submit(run_sink, name)) for name in names]
+        for name, future in futures:
+            try:
+                future.result()
+                results[name] = 'ok'
+            except Exception as e:
+                log.exception('Sink %s failed: %s', name, e)
+                results[name] = 'failed: %s' % (e, )
+    failed = [name for name, result in results.items() if result != 'ok']
+    if failed:
+        raise SinkError('Sinks failed: %s' % ', '.join(failed))
+    return results
+
+
+def sink_names(names=None):
+    names = names or [n for n in PIPELINE_SINKS.split(',') if n] or list(SINKS)
+    unknown = [n for n in names if n not in SINKS]
+    if unknown:
+        raise ValueError('Unknown sinks: %s' % ', '.join(unknown))
+    return names
+
+def run(day=None, key=None, file_path=None, bucket=None, sinks=None):
+    """Run the pipeline for one export: today's (or `day`'s, yyyy-mm-dd)
+       from the URL, raw export `key` on S3, or local file `file_path`
+       (named auctions-yyyy-mm-dd.csv). `sinks`: names, [] for none.
+       Returns a summary."""
+    clean_fn = module('clean_auction_csv')
+    # Before the sinks, alerts and s3_reader start threads
+    clean_fn.start_workers()
+    bucket = bucket or clean_fn.bucket
+    names = sink_names(sinks) if sinks != [] else []
+    with scratch.task('auction_pipeline') as scr:
+        if key:
+            export = Export(bucket, key.split('/')[-1])
+            log.info('Get %s from %s.', key, bucket)
+            with s3_reader.open_stream(clean_fn.s3_client, bucket, key) as f:
+                clean(export, f)
+        elif file_path:
+            export = Export(bucket, os.path.basename(file_path))
+            with open(file_path, 'rb') as f:
+                clean(export, f)
+        else:
+            day = day or datetime.today().strftime('%Y-%m-%d')
+            fetched = fetch(day)
+            if fetched is None:
+                return None
+            export = Export(bucket, fetched[0].split('/')[-1])
+            export.raw_key, export.raw = fetched
+            clean(export, data=export.raw)
+        load_previous(export)
+        diff(export)
+        log.info('%s: %s rows, %s in the diff.', export.filename,
+                 len(export.rows), len(export.diff))
+        results = run_sinks(export, names, scr) if names else {}
+    return OrderedDict([
+        ('export',  export.filename),
+        ('rows',    len(export.rows)),
+        ('diff',    len(export.diff)),
+        ('sinks',   results),
+    ])
+
+@metrics.instrumented
+@alerts.instrumented
+def lambda_handler(event, context):
+    # Raw exports on S3 (S3, SNS(S3), SQS(S3) or EventBridge)...
+    objects = events.s3_objects(event)
+    for obj in objects:
+        with idempotency.once_object('auction_pipeline', obj) as first:
+            if first:
+                log.info(json.dumps(run(key=obj.key, bucket=obj.bucket)))
+    # ...or the daily schedule: once per day
+    if not objects:
+        day = datetime.today().strftime('%Y-%m-%d')
+        with idempotency.once('auction_pipeline', 'export:' + day) as first:
+            if first:
+                log.info(json.dumps(run(day)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the auction pipeline for one export.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--date', help="export of yyyy-mm-dd from the URL "
+                        "(default: today's)")
+    source.add_argument('--s3', metavar='KEY', help='raw export on S3')
+    source.add_argument('--file', help='local raw export '
+                        '(auctions-yyyy-mm-dd.csv)')
+    parser.add_argument('--bucket', help='default: $BUCKET')
+    parser.add_argument('--sinks', help='comma separated (default: %s)'
+                        % ','.join(SINKS))
+    parser.add_argument('--dry-run', action='store_true',
+                        help='no sinks: fetch, clean and diff only')
+    args = parser.parse_args(argv)
+    sinks = [] if args.dry_run else (args.sinks.split(',') if args.sinks
+                                     else None)
+    summary = run(args.date, args.s3, args.file, args.bucket, sinks)
+    alerts.flush(final=True)
+    metrics.flush()
+    print(json.dumps(summary, indent=1))
+    return 0 if summary else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1 @@
+../clean_auction_csv/auction_record.py
\ No newline at end of file
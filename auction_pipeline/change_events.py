@@ -0,0 +1 @@
+../clean_auction_csv/change_events.py
\ No newline at end of file
@@ -0,0 +1 @@
+../clean_auction_csv/chunked_csv.py
\ No newline at end of file
@@ -0,0 +1 @@
+../clean_auction_csv/clean_auction_csv.py
\ No newline at end of file
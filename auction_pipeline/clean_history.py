@@ -0,0 +1 @@
+../clean_auction_csv/clean_history.py
\ No newline at end of file
@@ -0,0 +1 @@
+../clean_auction_csv/data_profile.py
\ No newline at end of file
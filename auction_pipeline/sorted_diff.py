@@ -0,0 +1 @@
+../clean_auction_csv/sorted_diff.py
\ No newline at end of file
@@ -0,0 +1 @@
+../auction_csv_to_raw_mysql/summary_tables.py
\ No newline at end of file
@@ -39,17 +39,21 @@ from __future__ import print_function
 import os
 import logging
 import json
-import urllib
 import uuid
 import random
-import pymysql
 from datetime import datetime
-from pymysql.err import IntegrityError
-from base64 import b64decode
-
-import boto3
-from botocore.client import Config
-from mailjet_rest import Client
+# Third party (mysql_conn imports pymysql anyway)
+from pymysql.constants import CLIENT
+# Own
+from lambda_common import alerts
+from lambda_common import aws_clients
+from lambda_common import events
+from lambda_common import idempotency
+from lambda_common import kms_secrets
+from lambda_common import metrics
+from lambda_common.mysql_conn import ConnectionManager
+from lambda_common.bloom import BloomFilter
+from lambda_common.emails import split_email
 
 
 # Logging
@@ -61,11 +65,6 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno
 ch.setFormatter(formatter)
 log.addHandler(ch)
 
-# Decrypt function to retrieve sensitive key-value pairs from AWS KMS
-def decrypt(env_var):
-    ENCRYPTED = os.environ[env_var]
-    return boto3.client('kms').decrypt(CiphertextBlob=b64decode(ENCRYPTED))['Plaintext']
-
 # Some constants
 MYSQL = {
     'type'        : 'mysql',
@@ -73,93 +72,98 @@ MYSQL = {
     'port'        : 3306,
     'db_name'     : 'mmgmysqldb',
     'db_username' : 'mmgmysqluser',
-    'db_password' : decrypt('MYSQL_DB_PASSWORD'),
     'table_name'  : 'Contacts',
 }
 
-# Initialize boto3-clients per container
+# Contact uuids:
+#   - 'uuid4' (default): random uuid for new contacts, every lead looks up
+#     the uuid in RDS
+#   - 'uuid5': uuid5(CONTACT_UUID_NAMESPACE, email_cleaned) for new
+#     contacts. Contacts that are not in the LEGACY_CONTACTS_BLOOM (older
+#     contacts with a random uuid) then don't need a lookup at all.
+#     See build_legacy_contacts_bloom.py for the migration.
+CONTACT_UUID_MODE       = os.environ.get('CONTACT_UUID_MODE', 'uuid4')
+# Never change this: it would change the uuid of every (new) contact
+CONTACT_UUID_NAMESPACE  = uuid.UUID('a2573c5f-e20b-4c25-86b0-471b4da0e97d')
+# 's3://bucket/key' of the serialized Bloom filter (optional)
+LEGACY_CONTACTS_BLOOM   = os.environ.get('LEGACY_CONTACTS_BLOOM')
+
+# KMS-encrypted environment variables: decrypted (all at once) on the
+# first invocation, not at import
+SECRETS = (
+    'MYSQL_DB_PASSWORD',
+    # Mailjet ADD
+    'MJ_ADD_APIKEY_PUBLIC',
+    'MJ_ADD_APIKEY_PRIVATE',
+    # Mailjet TRANSACTIONAL (welcome mail)
+    'MJ_TRANS_APIKEY_PUBLIC',
+    'MJ_TRANS_APIKEY_PRIVATE',
+)
+
+# boto3-clients per container (created on first use)
 region_name = 'eu-central-1'
-s3_client   = boto3.client('s3',
-                config=Config(signature_version='s3v4'))
-ddb_client  = boto3.client('dynamodb',
-                region_name=region_name, 
+s3_client   = aws_clients.lazy_client('s3', signature_version='s3v4')
+ddb_client  = aws_clients.lazy_client('dynamodb',
+                region_name=region_name,
                 endpoint_url="https://dynamodb.eu-central-1.amazonaws.com")
 
-# Init MySQL conn
-db_conn = pymysql.connect(MYSQL['host'],
+# MySQL conn (checked before use, reconnects if needed)
+db = ConnectionManager(MYSQL['host'],
     port=MYSQL['port'],
     user=MYSQL['db_username'],
-    passwd=MYSQL['db_password'],
+    password=lambda: kms_secrets.decrypt('MYSQL_DB_PASSWORD'),
     db=MYSQL['db_name'],
-    connect_timeout=5)
+    connect_timeout=5,
+    # A new contact and its contact-campaign go in one round trip
+    client_flag=CLIENT.MULTI_STATEMENTS)
 
-# Get and decrypt environment variables (store globally)
-# Mailjet ADD
-MJ_ADD_APIKEY_PUBLIC    = decrypt('MJ_ADD_APIKEY_PUBLIC')
-MJ_ADD_APIKEY_PRIVATE   = decrypt('MJ_ADD_APIKEY_PRIVATE')
-# Mailjet TRANSACTIONAL (welcome mail)
-MJ_TRANS_APIKEY_PUBLIC    = decrypt('MJ_TRANS_APIKEY_PUBLIC')
-MJ_TRANS_APIKEY_PRIVATE   = decrypt('MJ_TRANS_APIKEY_PRIVATE')
+# Mailjet clients (and mailjet_rest/requests) are created on first use
+# (per container)
+Mailjet_Main    = None
+Mailjet_Trans   = None
 
-# Init MJ API for Main Account
-Mailjet_Main = Client(auth=(MJ_ADD_APIKEY_PUBLIC, MJ_ADD_APIKEY_PRIVATE))
+def get_mailjet_main():
+    """Mailjet API for Main Account"""
+    global Mailjet_Main
+    if Mailjet_Main is None:
+        from mailjet_rest import Client
+        Mailjet_Main = Client(auth=(kms_secrets.decrypt('MJ_ADD_APIKEY_PUBLIC'),
+                                    kms_secrets.decrypt('MJ_ADD_APIKEY_PRIVATE')))
+    return Mailjet_Main
 
+def get_mailjet_trans():
+    """Mailjet API for Transactional Account"""
+    global Mailjet_Trans
+    if Mailjet_Trans is None:
+        from mailjet_rest import Client
+        Mailjet_Trans = Client(auth=(kms_secrets.decrypt('MJ_TRANS_APIKEY_PUBLIC'),
+                                     kms_secrets.decrypt('MJ_TRANS_APIKEY_PRIVATE')))
+    return Mailjet_Trans
 
-def send_out_warning(subject, msg, short_msg=''):
-    """Send out a warning through AWS SNS."""
-    client = boto3.client('sns', region_name='eu-west-1')
-    response = client.publish(
-        TopicArn            = os.environ['TOPIC_ARN'],
-        #~ MessageStructure    = 'json',
-        Subject             = subject,
-        Message             = msg,
-    )
 
-def split_email(email):
-    email_cleaned   = None
-    email_local     = None
-    email_domain    = None
-    email_tld       = None
-    err_msg         = None
-    email_cleaned   = email.strip().lower()
-    # First, check for multiple '@' and issue warning
-    parts = email_cleaned.split('@')
-    if len(parts) == 2:
-        email_local = parts[0]
-        email_domain = parts[1]
-        email_domains = email_domain.split('.')
-        if len(email_domains) > 1:
-            email_tld = email_domains[-1:][0]
-        else:
-            err_msg = 'No domain'
-    elif len(parts) == 1:
-        err_msg = 'No @-character'
-        email_local = None
-        email_domain = None
-    elif len(parts) > 2:
-        err_msg = 'More then one @-character'
-        email_local = None
-        email_domain = None
-    return email_cleaned, email_local, email_domain, email_tld, err_msg
+def send_out_warning(subject, msg, short_msg=''):
+    """Send out a warning through AWS SNS (queued, see alerts)."""
+    alerts.send(os.environ['TOPIC_ARN'], subject, msg)
 
 def mailjet_get(contact_id_or_email, with_data=True,
                 with_subscriptions=True, with_msg_stats=True):
     """Get the contact data for this ID or email.
     Defaults to getting ALL the data + subscriptions."""
-    result = Mailjet_Main.contact.get(id=contact_id_or_email)
+    mailjet = get_mailjet_main()
+    result = mailjet.contact.get(id=contact_id_or_email)
     if result.status_code == 200:
         con = result.json()['Data'][0]
         if with_data:
-            res = Mailjet_Main.contactdata.get(id=contact_id_or_email)
+            res = mailjet.contactdata.get(id=contact_id_or_email)
             con['ContactData'] = res.json()['Data'][0]['Data']
         if with_subscriptions:
             filters={'Contact': con['ID']}
-            res = Mailjet_Main.listrecipient.get(filters=filters)
+            res = mailjet.listrecipient.get(filters=filters)
             con['Subscriptions'] = list()
             con['Subscriptions'].extend(res.json()['Data'])
         if with_msg_stats:
             filters = {'ContactEmail': con['Email']}
-            res = Mailjet_Main.messagestatistics.get(filters=filters)
+            res = mailjet.messagestatistics.get(filters=filters)
             con['MessageStatistics'] = res.json()['Data'][0]
         return con
     # Contact not found
@@ -170,18 +174,50 @@ def mailjet_get(contact_id_or_email, with_data=True,
         print('Status: %s - Reason: %s', result.status_code, result.reason)
         return False
 
-def get_uuid_and_long(email):
-    sql = 'SELECT * FROM `Contacts` WHERE email_cleaned = %s'
-    with db_conn.cursor() as cursor:
-        cursor.execute(sql, (email, ))
-        res = cursor.fetchone()
-    if res:
-        return res[0], uuid.UUID(res[0]).int & (1<<32)-1
-    return False, False
+def uuid_to_long(u):
+    """Segment number of a contact: the last 32 bits of its uuid."""
+    return uuid.UUID(u).int & (1<<32)-1
 
 def gen_uuid4_and_long():
     u = uuid.uuid4()
     return str(u), u.int & (1<<32)-1
+
+def contact_uuid5(email_cleaned):
+    """Deterministic uuid of a contact: same on every retry and replica."""
+    if not isinstance(email_cleaned, str):
+        # Py2: uuid5 wants a byte string
+        email_cleaned = email_cleaned.encode('utf8')
+    return str(uuid.uuid5(CONTACT_UUID_NAMESPACE, email_cleaned))
+
+def new_contact_uuid(email_cleaned):
+    if CONTACT_UUID_MODE == 'uuid5':
+        return contact_uuid5(email_cleaned)
+    return gen_uuid4_and_long()[0]
+
+# Legacy contacts Bloom filter: loaded on first use (per container)
+legacy_contacts = None
+
+def get_legacy_contacts():
+    """Return the Bloom filter of contacts with a random (uuid4) uuid,
+       or None if there is none."""
+    global legacy_contacts
+    if legacy_contacts is None and LEGACY_CONTACTS_BLOOM:
+        bucket, key = LEGACY_CONTACTS_BLOOM[len('s3://'):].split('/', 1)
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        legacy_contacts = BloomFilter.from_bytes(response['Body'].read())
+        log.info('Legacy contacts Bloom filter loaded: %s bits.',
+                 legacy_contacts.num_bits)
+    return legacy_contacts
+
+def known_contact_uuid(email_cleaned):
+    """Return the uuid of this contact if we know it without asking RDS
+       (new contacts included), None if it needs a lookup."""
+    if CONTACT_UUID_MODE != 'uuid5':
+        return None
+    legacy = get_legacy_contacts()
+    if legacy is None or email_cleaned in legacy:
+        return None
+    return contact_uuid5(email_cleaned)
     
 def make_mpt_dict(email, uuid, seg_num, event_body, campaign, mj_contact):
     """Take all top-level (ie, string or unicode) attributes from the
@@ -213,7 +249,7 @@ def mailjet_main_add(email, uuid, seg_num, event_body, campaign, mj_contact):
     mpt_dict = make_mpt_dict(email, uuid, seg_num, event_body, campaign, mj_contact)
     data_string = mapping_template % mpt_dict
     data = json.loads(data_string)
-    response = Mailjet_Main.contactslist_managecontact.create(id=list_id, data=data)
+    response = get_mailjet_main().contactslist_managecontact.create(id=list_id, data=data)
     s = int(response.status_code) 
     if s not in (200, 201):
         log.error(response)
@@ -243,17 +279,22 @@ def send_welcome_mail(mailjet, campaign, email):
 def ddb_contacts_add(uuid, event_body, campaign):
     pass
 
-def rds_contact_add(uuid, email_tuple, event_body, campaign, location):
-    con_tuple = (
-        uuid,
-        email_tuple[0],
-        email_tuple[0],
-        email_tuple[1],
-        email_tuple[2],
-        email_tuple[3],
-        email_tuple[4],
-    )
-    ins_sql = """INSERT INTO `Contacts` (
+# Contact, campaign and contact-campaign SQL.
+# `Contacts` has a UNIQUE index on `email_cleaned`: every statement below
+# looks up contacts through that index only.
+CONTACT_SELECT_SQL = """SELECT `uuid` FROM `Contacts`
+    WHERE `email_cleaned` = %s;"""
+
+# A locking read: it sees a row another transaction committed after this
+# one's first SELECT (a plain SELECT reads that snapshot: REPEATABLE READ)
+CONTACT_LOCK_SQL = """SELECT `uuid` FROM `Contacts`
+    WHERE `email_cleaned` = %s LOCK IN SHARE MODE;"""
+
+# A no-op update on a duplicate: concurrent leads for the same (new)
+# email can't fail, the first one to insert wins.
+# pymysql doesn't set CLIENT.FOUND_ROWS, so rowcount is 1 for an insert
+# and 0 for an existing contact.
+CONTACT_UPSERT_SQL = """INSERT INTO `Contacts` (
         `uuid`,
         `email`,
         `email_cleaned`,
@@ -261,59 +302,90 @@ def rds_contact_add(uuid, email_tuple, event_body, campaign, location):
         `email_domain`,
         `email_tld`,
         `err_msg`)
-    VALUES ({plcs});""".format(plcs=','.join(['%s' for i in range(len(con_tuple)) ]))
-    with db_conn.cursor() as cursor:
-        cursor.execute(ins_sql, con_tuple)
-    db_conn.commit()
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE `email_cleaned` = `email_cleaned`;"""
+
+# 4th field `created_at` DEFAULT CURRENT_TIMESTAMP
+CAMPAIGN_INSERT_SQL = """INSERT IGNORE INTO `Campaigns`
+        (uuid, short_name, campaign_decimal)
+    VALUES (%s, %s, %s);"""
+
+# Takes the uuid of the stored contact (not ours): correct even if another
+# lead for the same email won the race (INSERT ... SELECT reads the
+# latest committed row, not the snapshot). A duplicate (contact already
+# came in through this campaign on this day) is ignored.
+CONCAM_INSERT_SQL = """INSERT IGNORE INTO `ContactsCampaigns`
+    SELECT `uuid`, %s, %s, %s, %s, %s FROM `Contacts`
+    WHERE `email_cleaned` = %s;"""
 
-def rds_campaign_add(campaign):
-    # 4th field `created_at` DEFAULT CURRENT_TIMESTAMP
+# Both in one round trip (CLIENT.MULTI_STATEMENTS): two result sets
+CONTACT_CONCAM_SQL = CONTACT_UPSERT_SQL + '\n' + CONCAM_INSERT_SQL
+
+# Campaigns known to be in RDS (per container)
+rds_campaigns = set()
+
+def rds_campaign_add(cursor, campaign):
+    """Add the campaign to `Campaigns` if it's not there yet."""
     cam_tuple   = (
         campaign['UUID']['S'], campaign['CampaignShortName']['S'],
         campaign['CampaignDecimal']['N']
     )
-    ins_sql = """INSERT INTO `Campaigns` (uuid, short_name, campaign_decimal)
-    VALUES ({plcs});""".format(plcs=','.join(['%s' for i in range(len(cam_tuple)) ]))
-    with db_conn.cursor() as cursor:
-        cursor.execute(ins_sql, cam_tuple)
-    db_conn.commit()
+    cursor.execute(CAMPAIGN_INSERT_SQL, cam_tuple)
+    if cursor.rowcount:
+        log.info('New campaign "%s" added to RDS.',
+                 campaign['CampaignShortName']['S'])
+
+def rds_contact_upsert(email_tuple, event_body, campaign, location):
+    """Add the contact (if new) and the contact-campaign in one transaction.
+       Returns (uuid, seg_num, is_new).
 
-def rds_contactcampaign_add(contact_uuid, email_tuple, event_body, campaign, location):
+       Round trips (+ the commit):
+       Existing contact: 1 (indexed) SELECT, 1 INSERT.
+       New contact: 1 SELECT, 1 INSERT + INSERT (one round trip).
+       Known uuid (uuid5, not a legacy contact): 1 INSERT + INSERT.
+       (+1 INSERT IGNORE for the first lead of a campaign per container,
+       +1 locking SELECT for the loser of a race for a new contact.)"""
     try:
         time_stamp = event_body['data']['timestamp']
     except KeyError as e:
         time_stamp = event_body['meta']['time_stamp']
     created_at_day = time_stamp.split('T')[0]
     concam_tuple  = (
-        contact_uuid, campaign['UUID']['S'], time_stamp, created_at_day,
-        event_body['data']['source_ip'], location
+        campaign['UUID']['S'], time_stamp, created_at_day,
+        event_body['data']['source_ip'], location, email_tuple[0]
     )
     log.debug(concam_tuple)
-    concam_sql = """INSERT INTO `ContactsCampaigns`
-    VALUES ({plcs});""".format(plcs=','.join(['%s' for i in range(len(concam_tuple)) ]))
-    with db_conn.cursor() as cursor:
-        # Add to `ContactsCampaigns`
-        try:
-            cursor.execute(concam_sql, concam_tuple)
-        except IntegrityError as e:
-            log.warn(e)
-            # Duplicate entry? (1062)
-            # Contact already came in through this campaign on this day
-            if e.args[0] == 1062:
-                pass
-            # FK-constraint? (1452)
-            # Should be missing Campaign
-            elif e.args[0] == 1452:
-                rds_campaign_add(campaign)
-                log.info('New campaign "%s" added to RDS.',
-                         campaign['CampaignShortName']['S'])
-                # Finally, still add the ContactsCampaigns-record
-                cursor.execute(concam_sql, concam_tuple)
-            else:
-                raise e
-                # TODO: send out warning (SNS?)
-                # Will now trigger a DLQ
-    db_conn.commit()
+    def concam_added(cursor):
+        if not cursor.rowcount:
+            log.info('Contact already came in through this campaign today.')
+    def upsert(cursor):
+        if campaign['UUID']['S'] not in rds_campaigns:
+            rds_campaign_add(cursor, campaign)
+        contact_uuid = known_contact_uuid(email_tuple[0])
+        known = bool(contact_uuid)
+        if not known:
+            cursor.execute(CONTACT_SELECT_SQL, (email_tuple[0], ))
+            res = cursor.fetchone()
+            if res:
+                cursor.execute(CONCAM_INSERT_SQL, concam_tuple)
+                concam_added(cursor)
+                return res[0], False
+            contact_uuid = new_contact_uuid(email_tuple[0])
+        con_tuple = (contact_uuid, email_tuple[0]) + tuple(email_tuple)
+        cursor.execute(CONTACT_CONCAM_SQL, con_tuple + concam_tuple)
+        is_new = bool(cursor.rowcount)
+        cursor.nextset()
+        concam_added(cursor)
+        if not is_new and not known:
+            # Lost the race to a concurrent lead: use its uuid
+            cursor.execute(CONTACT_LOCK_SQL, (email_tuple[0], ))
+            contact_uuid = cursor.fetchone()[0]
+        return contact_uuid, is_new
+    # Safe to run again: nothing is committed until the end and every
+    # statement tolerates rows that are already there
+    contact_uuid, is_new = db.run(upsert, idempotent=True)
+    rds_campaigns.add(campaign['UUID']['S'])
+    return contact_uuid, uuid_to_long(contact_uuid), is_new
     
 def get_s3_location(bucket, key):
     """Provide absolute S3-location based on bucket and key."""
@@ -326,16 +398,14 @@ def campaign_get(campaign_token):
     )
     return response['Item']
 
-def lambda_handler(event, context):
-    log.debug(json.dumps(event))
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
+def handle_lead(bucket, key):
     log.debug("Bucket is: %s", bucket)
     log.debug("Key is: %s", key)
     location = get_s3_location(bucket, key)
     # Get object from S3
     try:
-        response = s3_client.get_object(Bucket=bucket, Key=key)
+        with metrics.timer('s3_get'):
+            response = s3_client.get_object(Bucket=bucket, Key=key)
     except Exception as e:
         log.error(e)
         log.error('Error getting object {} from bucket {}. \
@@ -347,7 +417,8 @@ def lambda_handler(event, context):
         log.info(event_body)
         stage    = event_body['meta']['context']['stage']
         # Get campaign data and configuration via api-key ("CampaignToken")
-        campaign = campaign_get(event_body['meta']['context']['api-key'])
+        with metrics.timer('ddb_get'):
+            campaign = campaign_get(event_body['meta']['context']['api-key'])
         log.info('Contact came via "%s".', campaign['CampaignShortName']['S'])
         # Clean email and return tuple: (email_cleaned, email_local, email_domain, email_tld, err_msg)
         email_tuple = split_email(event_body['data']['email'])
@@ -358,33 +429,48 @@ def lambda_handler(event, context):
             log.warn(msg)
             send_out_warning('Invalid email in bdm_event_lead_trigger', msg)
         else:
-            uuid, seg_num = get_uuid_and_long(email_tuple[0])
-            if not uuid:
-                uuid, seg_num = gen_uuid4_and_long()
-                log.info('Contact not found in RDS. Will add with uuid=%s and seg_num=%s', uuid, seg_num)
-                rds_contact_add(uuid, email_tuple, event_body, campaign, location)
-                rds_contactcampaign_add(uuid, email_tuple, event_body, campaign, location)
+            with metrics.timer('db_write'):
+                uuid, seg_num, is_new = rds_contact_upsert(email_tuple,
+                                            event_body, campaign, location)
+            db.report(metrics)
+            metrics.count('NewContacts', int(is_new), stage='db_write')
+            if is_new:
+                log.info('Contact not found in RDS. Added with uuid=%s and seg_num=%s', uuid, seg_num)
             log.debug('uuid=%s,  seg_num=%s', uuid, seg_num)
-            rds_contactcampaign_add(uuid, email_tuple, event_body, campaign, location)
             # Get contact and some data
-            mj_contact = mailjet_get(email_tuple[0])
+            with metrics.timer('mailjet_get'):
+                mj_contact = mailjet_get(email_tuple[0])
             #~ ddb_contacts_add(uuid, event_body, campaign)
             if campaign.get('SubscribesTo'):
                 # Add to Mailjet Main Account
-                res = mailjet_main_add(email_tuple[0], uuid, seg_num,
-                        event_body, campaign, mj_contact)
+                with metrics.timer('mailjet_add'):
+                    res = mailjet_main_add(email_tuple[0], uuid, seg_num,
+                            event_body, campaign, mj_contact)
             # Send out welcome mail if new contact or contact without msg's
             if (not mj_contact or not mj_contact['MessageStatistics']['DeliveredCount']) \
                 and campaign['WelcomeMail']['M']['SendWelcomeMail']['BOOL']:
-                # Initiate Mailjet Transactional Account
-                Mailjet_Trans = Client(auth=(MJ_TRANS_APIKEY_PUBLIC, MJ_TRANS_APIKEY_PRIVATE))
-                res = send_welcome_mail(Mailjet_Trans, campaign, email_tuple[0])
+                with metrics.timer('mailjet_welcome'):
+                    res = send_welcome_mail(get_mailjet_trans(), campaign, email_tuple[0])
                 log.info('Welcome mail %s sent to %s.',
                          campaign['WelcomeMail']['M']['TemplateID']['N'],
                          email_tuple[0])
             else:
                 log.info('NO Welcome mail sent to %s.', email_tuple[0])
 
+@metrics.instrumented
+@alerts.instrumented
+def lambda_handler(event, context):
+    log.debug(json.dumps(event))
+    # No-op once the secrets are cached
+    with metrics.timer('secrets'):
+        kms_secrets.prefetch(*SECRETS)
+    # S3, SNS(S3), SQS(S3) or EventBridge: every record is a lead
+    for obj in events.iter_s3_objects(event):
+        # A second delivery would mean a second welcome mail
+        with idempotency.once_object('bdm_event_lead_trigger', obj) as first:
+            if first:
+                handle_lead(obj.bucket, obj.key)
+
 def main():
     from mock_event import event
     lambda_handler(event, None)
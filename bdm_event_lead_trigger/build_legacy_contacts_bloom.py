@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  build_legacy_contacts_bloom.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+#
+# Migration to deterministic (uuid5) contact uuids:
+#
+#   1. deploy bdm_event_lead_trigger with CONTACT_UUID_MODE=uuid5
+#      (new contacts get a uuid5, every lead still does a lookup)
+#   2. run this script: it builds a Bloom filter of all contacts whose
+#      uuid is NOT the uuid5 of their email (the "legacy" contacts) and
+#      uploads it to S3. This set doesn't grow anymore after step 1.
+#   3. set LEGACY_CONTACTS_BLOOM=s3://<bucket>/<key>
+#      (leads for non-legacy contacts skip the lookup)
+#
+#   $ source env.secrets
+#   $ python build_legacy_contacts_bloom.py s3://bdm-events/config/legacy_contacts.bloom
+#
+##########################################################################
+
+from __future__ import print_function
+import sys
+import logging
+# 3th party
+from pymysql.cursors import SSCursor
+# Own
+from lambda_common.bloom import BloomFilter
+from bdm_event_lead_trigger import db, s3_client, contact_uuid5
+
+log = logging.getLogger('bdm_event_lead_trigger')
+
+# Room for some more than the legacy contacts: keeps the error rate down
+ERROR_RATE  = 0.001
+HEADROOM    = 1.2
+
+
+def find_legacy_emails():
+    """Return the list of email_cleaned's with a non-uuid5 uuid."""
+    sql = 'SELECT `uuid`, `email_cleaned` FROM `Contacts`'
+    legacy = list()
+    # Unbuffered cursor: doesn't keep the whole table in memory
+    with db.cursor(SSCursor) as cursor:
+        cursor.execute(sql)
+        for contact_uuid, email_cleaned in cursor:
+            if email_cleaned and contact_uuid != contact_uuid5(email_cleaned):
+                legacy.append(email_cleaned)
+    return legacy
+
+def build_bloom(emails):
+    bloom = BloomFilter(int(len(emails) * HEADROOM), ERROR_RATE)
+    for email in emails:
+        bloom.add(email)
+    return bloom
+
+def main(argv):
+    if len(argv) != 2 or not argv[1].startswith('s3://'):
+        print('Usage: %s s3://<bucket>/<key>' % argv[0])
+        return 1
+    bucket, key = argv[1][len('s3://'):].split('/', 1)
+    emails = find_legacy_emails()
+    log.info('%s legacy contacts found.', len(emails))
+    bloom = build_bloom(emails)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=bloom.to_bytes(),
+                         ContentType='application/octet-stream')
+    log.info('Bloom filter (%s bits, %s hashes) saved to %s.',
+             bloom.num_bits, bloom.num_hashes, argv[1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
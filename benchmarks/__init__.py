@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+#
+#  Benchmarks for the λ-functions in this repo.
+#
+#  Run from the repo root, e.g.:
+#
+#   $ python -m benchmarks.bench_emails
+#
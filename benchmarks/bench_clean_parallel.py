@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_clean_parallel.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Parallel cleaning of clean_auction_csv (chunked_csv): clean_rows on the
+#  parsed export against clean_rows_parallel on its bytes, per number of
+#  worker processes.
+#
+#   $ python -m benchmarks.bench_clean_parallel [--rows 200000] [--workers 1,2,4,6]
+#
+#  The serial time includes the parsing (read_export), as the workers
+#  parse their chunks. Every parallel run must give the serial rows, bad
+#  lines and quality metrics: exit code 1 if not. A speedup needs as many
+#  CPUs as workers (Lambda: 6 vCPUs at 10240 MB).
+#
+#  A `--quote-rate` of the lines has the quotes of real exports: a literal
+#  " in an unquoted title (`TV 55" scherm`) or a quoted field with a
+#  newline. The chunks of split_records, in small sizes too, must read as
+#  the whole file does.
+#
+###############################################################################
+
+from __future__ import print_function
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib
+
+from benchmarks import synthetic_export
+
+REPO_DIR    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_clean():
+    os.environ.setdefault('BUCKET', 'bdm-auction-exports')
+    os.environ.setdefault('METRICS_DISABLED', '1')
+    sys.path.insert(0, os.path.join(REPO_DIR, 'clean_auction_csv'))
+    return importlib.import_module('clean_auction_csv')
+
+def add_quotes(lines, rate, seed):
+    """A literal quote in the title or a newline in a quoted extra_info
+       for `rate` of the lines (the generated lines have no ';' in a
+       quoted field)."""
+    rnd = random.Random(seed)
+    for n in range(1, len(lines)):
+        if rnd.random() >= rate:
+            continue
+        fields = lines[n].split(u';')
+        if rnd.random() < 0.5:
+            fields[2] += u' 55" scherm'
+        else:
+            fields[14] = u'"regel 1\nregel ""2"""'
+        lines[n] = u';'.join(fields)
+    return lines
+
+def raw_export(rows, corrupt_rate, seed, quote_rate=0.0):
+    day, lines = next(synthetic_export.generate_days(rows, 1, corrupt_rate,
+                                                     seed=seed))
+    lines = add_quotes(lines, quote_rate, seed)
+    return u'\n'.join(lines).encode('utf8') + b'\n'
+
+def check_split(clean_fn, data, chunk_sizes=(1, 100, 4096, 65536)):
+    """The chunks of split_records, read one by one, give the records of
+       the whole file."""
+    def read(part):
+        return list(clean_fn.csv.reader(io.BytesIO(part), delimiter=';',
+                                        quotechar='"'))
+    records = read(data)
+    for size in chunk_sizes:
+        chunks = clean_fn.chunked_csv.split_records(data, 0, size, b';')
+        if [r for c in chunks for r in read(data[c.begin:c.end])] != records \
+                or sum(c.records for c in chunks) != len(records):
+            print('Chunks of %s bytes: records DIFFERENT' % size)
+            return False
+    return True
+
+def outcome(clean_fn, data, run):
+    """(seconds, result) of run(), the bad lines it warned about with it."""
+    bad_lines = dict()
+    clean_fn.send_bad_lines_warning = lambda filename, bad: bad_lines.update(bad)
+    start = time.time()
+    rows, profile = run()
+    seconds = time.time() - start
+    return seconds, ([tuple(row) for row in rows], sorted(bad_lines),
+                     json.dumps(profile.report(), default=str))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--workers', default='1,2,4,6')
+    parser.add_argument('--corrupt-rate', type=float, default=0.001)
+    parser.add_argument('--quote-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+    clean_fn = import_clean()
+    data = raw_export(args.rows, args.corrupt_rate, args.seed, args.quote_rate)
+    filename = 'auctions-2017-05-01.csv'
+    if not check_split(clean_fn, data):
+        return 1
+    chunks = clean_fn.chunked_csv.split_records(data, 0, clean_fn.CHUNK_SIZE,
+                                                b';')
+    print('%s rows, %.1f MB, %s chunks, %s CPUs' % (args.rows,
+          len(data) / 1048576.0, len(chunks), clean_fn.chunked_csv.cpu_count()))
+    serial, expected = outcome(clean_fn, data, lambda: clean_fn.clean_rows(
+        clean_fn.read_export(io.BytesIO(data)), filename))
+    print('%-8s %9s %8s  %s' % ('workers', 'seconds', 'speedup', 'result'))
+    print('%-8s %9.3f %8s  %s' % ('serial', serial, '1.00', 'reference'))
+    same = True
+    for workers in [int(w) for w in args.workers.split(',')]:
+        seconds, result = outcome(clean_fn, data,
+            lambda: clean_fn.clean_rows_parallel(data, filename, workers))
+        same = same and result == expected
+        print('%-8s %9.3f %8.2f  %s' % (workers, seconds, serial / seconds,
+              'same' if result == expected else 'DIFFERENT'))
+    return 0 if same else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_emails.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Benchmark of lambda_common.emails over (by default) 1M addresses, and a
+#  compatibility check against the old split_email of
+#  bdm_event_lead_trigger: every address the old function accepted and
+#  the new one validates must give the same tuple.
+#
+#   $ python -m benchmarks.bench_emails [number of addresses]
+#
+###############################################################################
+
+from __future__ import print_function
+import sys
+import time
+import random
+
+from lambda_common import emails
+
+DOMAINS = ['telenet.be', 'gmail.com', 'hotmail.com', 'skynet.be',
+           'proximus.be', 'yahoo.fr', u'bücher.de', 'b.', 'example']
+LOCALS  = ['jan', 'an.peeters', 'marie+promo', 'x', 'piet..jan', '']
+
+
+def legacy_split_email(email):
+    """split_email as it was in bdm_event_lead_trigger."""
+    email_cleaned   = None
+    email_local     = None
+    email_domain    = None
+    email_tld       = None
+    err_msg         = None
+    email_cleaned   = email.strip().lower()
+    parts = email_cleaned.split('@')
+    if len(parts) == 2:
+        email_local = parts[0]
+        email_domain = parts[1]
+        email_domains = email_domain.split('.')
+        if len(email_domains) > 1:
+            email_tld = email_domains[-1:][0]
+        else:
+            err_msg = 'No domain'
+    elif len(parts) == 1:
+        err_msg = 'No @-character'
+    elif len(parts) > 2:
+        err_msg = 'More then one @-character'
+    return email_cleaned, email_local, email_domain, email_tld, err_msg
+
+def gen_addresses(n, distinct=50000, seed=42):
+    rnd = random.Random(seed)
+    pool = list()
+    for i in range(distinct):
+        local = '%s%s' % (rnd.choice(LOCALS), i)
+        if rnd.random() < 0.01:
+            local += '@'
+        email = u'%s@%s' % (local, rnd.choice(DOMAINS))
+        if rnd.random() < 0.1:
+            # Sloppy input: spaces and upper case
+            email = u' %s ' % email.upper()
+        pool.append(email)
+    return [rnd.choice(pool) for i in range(n)]
+
+def check_compatibility(addresses):
+    """Return the number of addresses that were checked and the mismatches."""
+    mismatches = list()
+    checked = 0
+    for email in set(addresses):
+        new = emails.split_email(email)
+        if new[4]:
+            # Invalid according to the new rules: may differ
+            continue
+        checked += 1
+        if new != legacy_split_email(email):
+            mismatches.append(email)
+    return checked, mismatches
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 1000000
+    addresses = gen_addresses(n)
+    results = [
+        ('legacy split_email', timed(lambda a: [legacy_split_email(e) for e in a], addresses)),
+        ('split_email (LRU)', timed(lambda a: [emails.split_email(e) for e in a], addresses)),
+        ('split_emails (batch)', timed(emails.split_emails, addresses)),
+    ]
+    for name, secs in results:
+        print('%-22s %8.3f s  %10.0f addresses/s' % (name, secs, n / secs))
+    checked, mismatches = check_compatibility(addresses)
+    print('Compatibility: %s valid addresses checked, %s mismatches.'
+          % (checked, len(mismatches)))
+    for email in mismatches[:10]:
+        print('  %r: %r != %r' % (email, emails.split_email(email),
+                                  legacy_split_email(email)))
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_imports.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Cold-start regression check: imports every function module in a fresh
+#  interpreter with `-X importtime` (Python 3.7+) and fails (exit 1) when
+#
+#   - the import takes longer than the function's budget (ms, best of
+#     --repeat runs), or
+#   - a heavy module that should only be imported on use (boto3, the
+#     Google client libraries, ...) is imported at module level.
+#
+#   $ python -m benchmarks.bench_imports
+#   $ python -m benchmarks.bench_imports --top 15 bdm_event_lead_trigger
+#
+#  The second check doesn't depend on the speed of the machine; use
+#  --scale for the budgets on a slow one. A function that doesn't import
+#  at all fails too, unless --skip-broken (e.g. without the requirements
+#  of every function installed).
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import re
+import sys
+import argparse
+import subprocess
+from collections import OrderedDict
+
+from benchmarks.bench_pipeline import REPO_DIR, ENV_DEFAULTS
+
+# Import time budget (ms) per function
+BUDGETS = OrderedDict([
+    ('bdm_event_lead_trigger',      100),
+    ('auction_csv_to_s3',           150),
+    ('clean_auction_csv',            60),
+    ('auction_csv_to_raw_mysql',    100),
+    ('auction_csv_to_google',        50),
+    ('auction_pipeline',             50),
+])
+
+# Only to be imported when used
+DEFERRED = ('boto3', 'botocore', 'pytz', 'requests', 'mailjet_rest',
+            'httplib2', 'apiclient', 'googleapiclient', 'oauth2client',
+            'pyarrow')
+
+# ...unless the function needs it on every invocation anyway
+ALLOWED = {
+    'auction_csv_to_s3': ('requests', ),
+}
+
+IMPORTTIME_RE = re.compile(
+    r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def import_times(name):
+    """Import function module `name` in a new interpreter. Returns a list
+       of (module, self us, cumulative us, depth)."""
+    env = dict(os.environ)
+    for k, v in ENV_DEFAULTS.items():
+        env.setdefault(k, v)
+    env['METRICS_DISABLED'] = '1'
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % name],
+        cwd=os.path.join(REPO_DIR, name), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    err = err.decode('utf8', 'replace')
+    if proc.returncode:
+        raise RuntimeError(err.strip().splitlines()[-1] if err.strip()
+                           else 'exit code %s' % proc.returncode)
+    times = list()
+    for line in err.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m:
+            times.append((m.group(4), int(m.group(1)), int(m.group(2)),
+                          len(m.group(3)) // 2))
+    return times
+
+def module_time_ms(name, times):
+    for module, self_us, cumulative_us, depth in times:
+        if module == name:
+            return cumulative_us / 1000.0
+    return None
+
+def deferred_imports(name, times):
+    allowed = ALLOWED.get(name, ())
+    found = set()
+    for module, self_us, cumulative_us, depth in times:
+        top = module.split('.')[0]
+        if top in DEFERRED and top not in allowed:
+            found.add(top)
+    return sorted(found)
+
+def check(name, repeat=3, scale=1.0, top=0, skip_broken=False):
+    """Returns (ok, report line). A module that can't be imported fails,
+       unless `skip_broken`."""
+    try:
+        runs = [import_times(name) for _ in range(repeat)]
+    except RuntimeError as e:
+        if skip_broken:
+            return True, '%-26s SKIPPED (%s)' % (name, e)
+        return False, '%-26s FAIL (%s)' % (name, e)
+    ms = min(module_time_ms(name, times) for times in runs)
+    budget = BUDGETS[name] * scale
+    heavy = deferred_imports(name, runs[0])
+    ok = ms <= budget and not heavy
+    line = '%-26s %7.1f ms (budget %5.0f ms) %s' % (
+        name, ms, budget, 'OK' if ok else 'FAIL')
+    if heavy:
+        line += '\n    imported at module level: %s' % ', '.join(heavy)
+    if top:
+        heaviest = sorted(runs[0], key=lambda t: -t[1])[:top]
+        for module, self_us, cumulative_us, depth in heaviest:
+            line += '\n    %8.1f ms  %s' % (self_us / 1000.0, module)
+    return ok, line
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('functions', nargs='*', default=list(BUDGETS),
+                        help='functions to check (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='imports per function, the best counts')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply all budgets (slow machines)')
+    parser.add_argument('--top', type=int, default=0,
+                        help='show the N slowest modules (self time)')
+    parser.add_argument('--skip-broken', action='store_true',
+                        help="skip functions that don't import instead of "
+                        "failing")
+    args = parser.parse_args()
+    if sys.version_info < (3, 7):
+        print('-X importtime needs Python 3.7+.', file=sys.stderr)
+        return 2
+    failed = 0
+    for name in args.functions:
+        ok, line = check(name, args.repeat, args.scale, args.top,
+                         args.skip_broken)
+        print(line)
+        failed += not ok
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_leads.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Load test of bdm_event_lead_trigger: how many leads/s before RDS or
+#  Mailjet can't keep up?
+#
+#   $ python -m benchmarks.bench_leads --leads 1000 --rates 10,25,50,100 \
+#       --concurrency 10,25 --mailjet-rps 50 --out leads.json
+#
+#  Synthetic leads (JSON, as campaign_entries writes them) are put on an S3
+#  stand-in and replayed against lambda_handler at a fixed rate (0: as fast
+#  as it goes). Every worker thread is a λ container with its own MySQL
+#  connection; `--concurrency` is the number of containers. Stand-ins:
+#
+#   - S3 and DynamoDB (EntryCampaigns): see standins.py
+#   - MySQL: the handler's statements on tables in memory. A round trip
+#     takes --db-latency ms on one of --db-capacity server threads; more
+#     than --db-max-connections connections fail ("Too many connections")
+#   - Mailjet: --mailjet-latency ms per call, a 429 for --mailjet-429 of
+#     the calls and for every call over --mailjet-rps per second
+#
+#  Per run: throughput, latency (p50/p95/p99 from the scheduled arrival:
+#  queueing included), MySQL round trips and Mailjet calls per lead and the
+#  failures. The report ends with the highest rate that was sustained and
+#  the concurrency it needs (Little's law: rate x time per lead).
+#
+#  Needs the function's requirements (pymysql) and boto3; no AWS, RDS or
+#  Mailjet account.
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import copy
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import importlib
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue                   # Python 2
+
+from benchmarks import standins
+
+REPO_DIR    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION    = 'bdm_event_lead_trigger'
+BUCKET      = 'bdm-events'
+
+ENV_DEFAULTS = {
+    'MYSQL_HOST'        : 'bench',
+    'TOPIC_ARN'         : 'arn:aws:sns:eu-west-1:000000000000:bench',
+    'METRICS_DISABLED'  : '1',
+    'IDEMPOTENCY_STORE' : 'none',
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+}
+# A rate is sustained when this much of it is handled...
+SUSTAINED       = 0.95
+# ...and at most this part of the leads fails
+MAX_FAILED      = 0.01
+
+
+class Context(object):
+    function_name = 'bench'
+    aws_request_id = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+# Leads
+
+FIRST_NAMES = ['jan', 'marie', 'pieter', 'an', 'luc', 'els', 'tom', 'sofie']
+DOMAINS     = ['gmail.com', 'hotmail.com', 'telenet.be', 'skynet.be',
+               'outlook.com', 'proximus.be']
+
+def campaign_item(n):
+    """EntryCampaigns item of campaign `n`."""
+    return {
+        'CampaignToken'     : {'S': 'token-%04d' % n},
+        'UUID'              : {'S': 'campaign-%04d' % n},
+        'CampaignShortName' : {'S': 'bench-%04d' % n},
+        'CampaignDecimal'   : {'N': '%d.1' % n},
+        'SubscribesTo'      : {'L': [{'M': {'ListID': {'N': str(1000 + n)}}}]},
+        'MJMappingTemplate' : {'S': json.dumps({
+            'Email': '%(email)s', 'Action': 'addforce',
+            'Properties': {'uuid': '%(uuid)s', 'seg_num': '%(seg_num)s'}})},
+        'WelcomeMail'       : {'M': {'TemplateID': {'N': '42'},
+                                     'SendWelcomeMail': {'BOOL': True}}},
+    }
+
+def generate_leads(count, campaigns=5, repeat_rate=0.1, invalid_rate=0.01,
+                   seed=42):
+    """`count` lead objects: a `repeat_rate` of them from an email that
+       came in before, an `invalid_rate` with an invalid email."""
+    rnd = random.Random(seed)
+    emails = list()
+    for i in range(count):
+        if emails and rnd.random() < repeat_rate:
+            email = rnd.choice(emails)
+        elif rnd.random() < invalid_rate:
+            email = 'not-an-email-%s' % i
+        else:
+            email = '%s.%s@%s' % (rnd.choice(FIRST_NAMES), i, rnd.choice(DOMAINS))
+            emails.append(email)
+        stamp = '2017-05-%02dT%02d:%02d:%02dZ' % (1 + i * 30 // count,
+            rnd.randrange(24), rnd.randrange(60), rnd.randrange(60))
+        yield {
+            'meta': {
+                'context': {'api-key': 'token-%04d' % rnd.randrange(campaigns),
+                            'stage': 'prod'},
+                'time_stamp': stamp,
+            },
+            'data': {
+                'email'     : email,
+                'source_ip' : '10.%s.%s.%s' % (rnd.randrange(256),
+                                               rnd.randrange(256), rnd.randrange(256)),
+                'timestamp' : stamp,
+                'firstname' : email.split('.')[0].title(),
+            },
+        }
+
+def s3_event(bucket, key):
+    return {'Records': [{'eventSource': 'aws:s3',
+                         's3': {'bucket': {'name': bucket},
+                                'object': {'key': key}}}]}
+
+
+# MySQL stand-in
+
+class MySQLError(Exception):
+    pass
+
+
+class LeadsMySQL(object):
+    """The tables and statements of bdm_event_lead_trigger in memory, with
+       the latency and limits of a (small) RDS instance."""
+
+    def __init__(self, module, latency=0.002, capacity=20,
+                 max_connections=50, connect_latency=0.02):
+        self.latency            = latency
+        self.connect_latency    = connect_latency
+        self.max_connections    = max_connections
+        self._server            = threading.BoundedSemaphore(capacity)
+        self._lock              = threading.Lock()
+        self._local             = threading.local()
+        self.connections        = 0
+        self.refused            = 0
+        self.contacts           = dict()        # email_cleaned: uuid
+        self.campaigns          = set()
+        self.contacts_campaigns = set()
+        # The statements of a round trip (more than one: MULTI_STATEMENTS)
+        self.statements = {
+            module.CONTACT_SELECT_SQL   : [self._contact_select],
+            module.CONTACT_LOCK_SQL     : [self._contact_select],
+            module.CONTACT_UPSERT_SQL   : [self._contact_upsert],
+            module.CAMPAIGN_INSERT_SQL  : [self._campaign_insert],
+            module.CONCAM_INSERT_SQL    : [self._concam_insert],
+            module.CONTACT_CONCAM_SQL   : [self._contact_upsert,
+                                           self._concam_insert],
+        }
+
+    def round_trips(self):
+        """Round trips of this thread so far."""
+        return getattr(self._local, 'round_trips', 0)
+
+    def round_trip(self):
+        self._local.round_trips = self.round_trips() + 1
+        with self._server:
+            time.sleep(self.latency)
+
+    def connect(self, *args, **kwargs):
+        """pymysql.connect"""
+        import pymysql
+        with self._lock:
+            if self.connections >= self.max_connections:
+                self.refused += 1
+                raise pymysql.err.OperationalError(1040, 'Too many connections')
+            self.connections += 1
+        self.round_trip()
+        time.sleep(self.connect_latency)
+        return Connection(self)
+
+    def execute(self, sql, args):
+        """[(rows, rowcount)] of the statements of `sql`."""
+        self.round_trip()
+        results = list()
+        with self._lock:
+            for statement in self.statements[sql]:
+                n = statement.__code__.co_argcount - 1
+                results.append(statement(*args[:n]))
+                args = args[n:]
+        return results
+
+    def _contact_select(self, email_cleaned):
+        contact = self.contacts.get(email_cleaned)
+        return ([(contact, )] if contact else []), (1 if contact else 0)
+
+    def _contact_upsert(self, contact_uuid, email, email_cleaned,
+                        email_local, email_domain, email_tld, err_msg):
+        if email_cleaned in self.contacts:
+            return [], 0
+        self.contacts[email_cleaned] = contact_uuid
+        return [], 1
+
+    def _campaign_insert(self, campaign_uuid, short_name, decimal):
+        if campaign_uuid in self.campaigns:
+            return [], 0
+        self.campaigns.add(campaign_uuid)
+        return [], 1
+
+    def _concam_insert(self, campaign_uuid, time_stamp, day, source_ip,
+                       location, email_cleaned):
+        contact = self.contacts.get(email_cleaned)
+        key = (contact, campaign_uuid, day)
+        if contact is None or key in self.contacts_campaigns:
+            return [], 0
+        self.contacts_campaigns.add(key)
+        return [], 1
+
+
+class Connection(object):
+    """The part of a pymysql connection the ConnectionManager uses."""
+
+    _sock = None
+
+    def __init__(self, server):
+        self.server = server
+        self.open   = True
+
+    def cursor(self):
+        return Cursor(self.server)
+
+    def commit(self):
+        self.server.round_trip()
+
+    def ping(self, reconnect=False):
+        self.server.round_trip()
+
+    def close(self):
+        if self.open:
+            self.open = False
+            with self.server._lock:
+                self.server.connections -= 1
+
+
+class Cursor(object):
+
+    def __init__(self, server):
+        self.server     = server
+        self.rowcount   = -1
+        self._rows      = []
+        self._results   = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=()):
+        self._results = self.server.execute(sql, args)
+        self.nextset()
+        return self.rowcount
+
+    def nextset(self):
+        if not self._results:
+            return None
+        self._rows, self.rowcount = self._results.pop(0)
+        return True
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+
+class PerThread(object):
+    """A copy of ConnectionManager `template` per thread: one connection
+       per λ container."""
+
+    def __init__(self, template):
+        self._template  = template
+        self._local     = threading.local()
+        self.managers   = list()
+
+    def _manager(self):
+        manager = getattr(self._local, 'manager', None)
+        if manager is None:
+            manager = copy.copy(self._template)
+            manager._conn = None
+            manager.stats = dict(self._template.stats)
+            self._local.manager = manager
+            self.managers.append(manager)
+        return manager
+
+    def __getattr__(self, name):
+        return getattr(self._manager(), name)
+
+    def close(self):
+        for manager in self.managers:
+            manager.close()
+
+
+# Mailjet stand-in
+
+class MailjetResponse(object):
+
+    def __init__(self, status_code, data=None):
+        self.status_code    = status_code
+        self._data          = data if data is not None else {}
+        self.text           = json.dumps(self._data)
+        self.reason         = 'Too Many Requests' if status_code == 429 else ''
+        self.headers        = {}
+
+    def json(self):
+        return self._data
+
+
+class MailjetEndpoint(object):
+
+    def __init__(self, stub, name):
+        self.stub, self.name = stub, name
+
+    def get(self, id=None, filters=None, **kwargs):
+        return self.stub.call(self.name, 'get', id, filters or {})
+
+    def create(self, id=None, data=None, **kwargs):
+        return self.stub.call(self.name, 'create', id, data or {})
+
+
+class MailjetStub(object):
+    """mailjet_rest.Client: contacts in memory, `latency` s per call, a 429
+       for `error_rate` of the calls and for the calls over `rps` a
+       second (0: no limit)."""
+
+    ENDPOINTS = ('contact', 'contactdata', 'listrecipient',
+                 'messagestatistics', 'contactslist_managecontact', 'send')
+
+    def __init__(self, latency=0.08, error_rate=0.0, rps=0, seed=42):
+        self.latency    = latency
+        self.error_rate = error_rate
+        self.rps        = rps
+        self.random     = random.Random(seed)
+        self.contacts   = dict()        # email: ID
+        self.delivered  = set()
+        self.calls      = 0
+        self.throttled  = 0
+        self._recent    = list()
+        self._lock      = threading.Lock()
+        self._local     = threading.local()
+        for name in self.ENDPOINTS:
+            setattr(self, name, MailjetEndpoint(self, name))
+
+    def thread_calls(self):
+        return getattr(self._local, 'calls', 0)
+
+    def _throttle(self, now):
+        with self._lock:
+            self.calls += 1
+            self._recent = [t for t in self._recent if t > now - 1.0]
+            over = self.rps and len(self._recent) >= self.rps
+            self._recent.append(now)
+            if over or self.random.random() < self.error_rate:
+                self.throttled += 1
+                return True
+        return False
+
+    def call(self, endpoint, method, id, data):
+        self._local.calls = self.thread_calls() + 1
+        time.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self._throttle(time.time()):
+            return MailjetResponse(429, {'ErrorMessage': 'Too many requests'})
+        with self._lock:
+            return getattr(self, '_%s_%s' % (endpoint, method))(id, data)
+
+    def _contact_get(self, email, data):
+        if email not in self.contacts:
+            return MailjetResponse(404)
+        return MailjetResponse(200, {'Data': [{
+            'ID': self.contacts[email], 'Email': email,
+            'CreatedAt': '2017-05-01T00:00:00Z'}]})
+
+    def _contactdata_get(self, email, data):
+        return MailjetResponse(200, {'Data': [{'Data': []}]})
+
+    def _listrecipient_get(self, id, filters):
+        return MailjetResponse(200, {'Data': []})
+
+    def _messagestatistics_get(self, id, filters):
+        delivered = int(filters.get('ContactEmail') in self.delivered)
+        return MailjetResponse(200, {'Data': [{'DeliveredCount': delivered}]})
+
+    def _contactslist_managecontact_create(self, list_id, data):
+        email = data['Email']
+        contact_id = self.contacts.setdefault(email, len(self.contacts) + 1)
+        return MailjetResponse(201, {'Data': [{'ContactID': contact_id,
+                                               'Action': 'addforce'}]})
+
+    def _send_create(self, id, data):
+        for recipient in data.get('Recipients', []):
+            self.delivered.add(recipient['Email'])
+        return MailjetResponse(200, {'Sent': data.get('Recipients', [])})
+
+
+# Replay
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+def replay(module, events, rate, concurrency, mysql, mailjet):
+    """Handle `events` at `rate` per second (0: at once) with
+       `concurrency` containers. Returns [(scheduled, start, end, round
+       trips, Mailjet calls, error)]."""
+    todo = queue.Queue()
+    results = list()
+    lock = threading.Lock()
+    def container():
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            scheduled, event = item
+            trips, calls = mysql.round_trips(), mailjet.thread_calls()
+            start = time.time()
+            error = None
+            try:
+                module.lambda_handler(event, Context())
+            except Exception as e:
+                error = type(e).__name__
+            end = time.time()
+            with lock:
+                results.append((scheduled, start, end,
+                                mysql.round_trips() - trips,
+                                mailjet.thread_calls() - calls, error))
+    threads = [threading.Thread(target=container) for _ in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    begin = time.time()
+    for n, event in enumerate(events):
+        scheduled = begin + (n / float(rate) if rate else 0)
+        wait = scheduled - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        todo.put((scheduled, event))
+    for _ in threads:
+        todo.put(None)
+    for t in threads:
+        t.join()
+    return results
+
+def summarize(results, rate, concurrency, mysql, mailjet):
+    begin = min(r[0] for r in results)
+    end = max(r[2] for r in results)
+    ok = [r for r in results if r[5] is None]
+    latency = [r[2] - r[0] for r in ok]
+    service = [r[2] - r[1] for r in ok]
+    errors = dict()
+    for r in results:
+        if r[5]:
+            errors[r[5]] = errors.get(r[5], 0) + 1
+    return OrderedDict([
+        ('rate',            rate),
+        ('concurrency',     concurrency),
+        ('leads',           len(results)),
+        ('failed',          len(results) - len(ok)),
+        ('errors',          errors),
+        ('throughput',      round(len(ok) / max(end - begin, 1e-9), 2)),
+        ('p50_s',           round(percentile(latency, 50) or 0, 4)),
+        ('p95_s',           round(percentile(latency, 95) or 0, 4)),
+        ('p99_s',           round(percentile(latency, 99) or 0, 4)),
+        ('service_mean_s',  round(sum(service) / max(len(service), 1), 4)),
+        ('db_round_trips',  round(sum(r[3] for r in results) / float(len(results)), 2)),
+        ('db_round_trips_max', max(r[3] for r in results)),
+        ('db_refused',      mysql.refused),
+        ('mailjet_calls',   round(sum(r[4] for r in results) / float(len(results)), 2)),
+        ('mailjet_429',     mailjet.throttled),
+    ])
+
+def is_sustained(run, p99_slo):
+    offered = run['rate'] or run['throughput']
+    return run['throughput'] >= SUSTAINED * offered and \
+        run['failed'] <= MAX_FAILED * run['leads'] and run['p99_s'] <= p99_slo
+
+def sizing(runs, p99_slo, max_connections):
+    """The highest sustained rate and what it needs, or None."""
+    sustained = [r for r in runs if is_sustained(r, p99_slo)]
+    if not sustained:
+        return None
+    best = max(sustained, key=lambda r: (r['throughput'], -r['concurrency']))
+    # Little's law, with some headroom for bursts
+    needed = int(math.ceil(best['throughput'] * best['service_mean_s'] * 1.5))
+    return OrderedDict([
+        ('leads_per_s',         best['throughput']),
+        ('tested_concurrency',  best['concurrency']),
+        ('reserved_concurrency', max(1, min(needed, max_connections))),
+        ('db_round_trips_per_s', round(best['throughput'] * best['db_round_trips'], 1)),
+        ('mailjet_calls_per_s', round(best['throughput'] * best['mailjet_calls'], 1)),
+    ])
+
+
+def import_lead_trigger(workdir, dynamodb):
+    for name, value in ENV_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+    s3 = standins.install(workdir, dynamodb=dynamodb)
+    sys.path.insert(0, os.path.join(REPO_DIR, FUNCTION))
+    module = importlib.import_module(FUNCTION)
+    from lambda_common import kms_secrets
+    for secret in module.SECRETS:
+        kms_secrets.override(secret, 'bench')
+    # Lines per lead at DEBUG, an ERROR per 429: the report counts those
+    import logging
+    module.log.setLevel(logging.CRITICAL)
+    return module, s3
+
+def put_leads(s3, leads):
+    events = list()
+    for n, lead in enumerate(leads):
+        key = 'leads/bench-%06d.json' % n
+        s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(lead).encode('utf8'))
+        events.append(s3_event(BUCKET, key))
+    return events
+
+def run_one(module, events, rate, concurrency, args):
+    """One replay on fresh stand-ins."""
+    import pymysql
+    mysql = LeadsMySQL(module, latency=args.db_latency / 1000.0,
+                       capacity=args.db_capacity,
+                       max_connections=args.db_max_connections)
+    mailjet = MailjetStub(latency=args.mailjet_latency / 1000.0,
+                          error_rate=args.mailjet_429, rps=args.mailjet_rps,
+                          seed=args.seed)
+    pymysql.connect = mysql.connect
+    template = module.db if not isinstance(module.db, PerThread) \
+        else module.db._template
+    module.db = PerThread(template)
+    module.Mailjet_Main = module.Mailjet_Trans = mailjet
+    module.rds_campaigns.clear()
+    try:
+        results = replay(module, events, rate, concurrency, mysql, mailjet)
+    finally:
+        module.db.close()
+    return summarize(results, rate, concurrency, mysql, mailjet)
+
+def print_report(runs, size, p99_slo):
+    print('%6s %5s %9s %7s %7s %7s %6s %6s %6s %6s' % ('rate', 'conc',
+          'leads/s', 'p50 s', 'p95 s', 'p99 s', 'db rt', 'mj', '429', 'failed'))
+    for r in runs:
+        print('%6s %5s %9.2f %7.3f %7.3f %7.3f %6.2f %6.2f %6s %6s%s' % (
+              r['rate'] or 'max', r['concurrency'], r['throughput'],
+              r['p50_s'], r['p95_s'], r['p99_s'], r['db_round_trips'],
+              r['mailjet_calls'], r['mailjet_429'], r['failed'],
+              '' if is_sustained(r, p99_slo) else '  (not sustained)'))
+    if size is None:
+        print('No rate was sustained (%.0f%% handled, p99 <= %ss).'
+              % (SUSTAINED * 100, p99_slo))
+        return
+    print('Sustained up to %(leads_per_s)s leads/s (tested with %(tested_concurrency)s '
+          'containers): reserved concurrency %(reserved_concurrency)s, '
+          '%(db_round_trips_per_s)s MySQL round trips/s, '
+          '%(mailjet_calls_per_s)s Mailjet calls/s.' % size)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test of bdm_event_lead_trigger on stand-ins.')
+    parser.add_argument('--leads', type=int, default=500)
+    parser.add_argument('--rates', default='10,25,50',
+                        help='leads/s, comma separated (0: as fast as it goes)')
+    parser.add_argument('--concurrency', default='10',
+                        help='containers, comma separated')
+    parser.add_argument('--campaigns', type=int, default=5)
+    parser.add_argument('--repeat-rate', type=float, default=0.1,
+                        help='leads of an email that came in before')
+    parser.add_argument('--invalid-rate', type=float, default=0.01)
+    parser.add_argument('--db-latency', type=float, default=2.0, help='ms')
+    parser.add_argument('--db-capacity', type=int, default=20,
+                        help='round trips served at the same time')
+    parser.add_argument('--db-max-connections', type=int, default=50)
+    parser.add_argument('--mailjet-latency', type=float, default=80.0, help='ms')
+    parser.add_argument('--mailjet-429', type=float, default=0.0,
+                        help='part of the calls that gets a 429')
+    parser.add_argument('--mailjet-rps', type=int, default=0,
+                        help='calls/s before 429s (0: no limit)')
+    parser.add_argument('--uuid-mode', choices=['uuid4', 'uuid5'],
+                        help='CONTACT_UUID_MODE of the function')
+    parser.add_argument('--p99-slo', type=float, default=2.0,
+                        help='highest p99 (s) of a sustained rate')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='write the report (JSON) here')
+    args = parser.parse_args(argv)
+    if args.uuid_mode:
+        os.environ['CONTACT_UUID_MODE'] = args.uuid_mode
+    workdir = tempfile.mkdtemp(prefix='bench_leads_')
+    try:
+        dynamodb = standins.MemoryDynamoDBClient({'EntryCampaigns': 'CampaignToken'})
+        for n in range(args.campaigns):
+            dynamodb.put_item(TableName='EntryCampaigns', Item=campaign_item(n))
+        module, s3 = import_lead_trigger(workdir, dynamodb)
+        events = put_leads(s3, generate_leads(args.leads, args.campaigns,
+                                              args.repeat_rate,
+                                              args.invalid_rate, args.seed))
+        runs = list()
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            for rate in [float(r) for r in args.rates.split(',')]:
+                runs.append(run_one(module, events, rate, concurrency, args))
+        size = sizing(runs, args.p99_slo, args.db_max_connections)
+        print_report(runs, size, args.p99_slo)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(OrderedDict([('settings', vars(args)),
+                                       ('runs', runs), ('sizing', size)]),
+                          f, indent=1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_pipeline.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  End-to-end benchmark of the auction pipeline, on synthetic exports and
+#  local stand-ins (see standins.py):
+#
+#   auction_csv_to_s3 -> clean_auction_csv -> diff -> auction_csv_to_raw_mysql
+#                                                  -> auction_csv_to_google
+#
+#  Day 1 is run to prime the stand-ins (yesterday's clean csv), day 2 is
+#  measured. Every stage runs in a fresh interpreter (like a cold start):
+#  we record import time, wall time, peak RSS and rows/sec per stage.
+#
+#  The MySQL stage needs a local MariaDB/MySQL (--mysql-host, ...): it is
+#  skipped otherwise. The Google stage uses a fake Drive service (the
+#  Google client libraries don't need to be installed).
+#
+#   $ python -m benchmarks.bench_pipeline --rows 100000 --out results.json
+#   $ python -m benchmarks.bench_pipeline --compare before.json after.json
+#
+#  `--stages pipeline` runs day 2 through auction_pipeline (one process,
+#  concurrent sinks) instead, to compare with the chain.
+#
+#  Overhead of lambda_common.metrics: compare a run with --no-metrics to
+#  one without.
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import resource
+import importlib
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+
+from benchmarks import standins
+from benchmarks import synthetic_export
+
+REPO_DIR    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET      = 'bdm-auction-exports'
+MYSQL_TABLE = 'AuctionsRaw'
+
+ENV_DEFAULTS = {
+    'BUCKET'            : BUCKET,
+    'AUCTION_EXPORT_URL': 'http://localhost/exports/auctions-{date}.csv',
+    'TOPIC_ARN'         : 'arn:aws:sns:eu-west-1:000000000000:bench',
+    'MYSQL_HOST'        : '127.0.0.1',
+    'MYSQL_DB_NAME'     : 'bench',
+    'MYSQL_DB_USERNAME' : 'root',
+    'MYSQL_DB_PASSWORD' : 'not-encrypted',
+    'MYSQL_TABLE_NAME'  : MYSQL_TABLE,
+    'GOOGLE_PROJECT_ID' : 'bench',
+    'GOOGLE_LOGIN_EMAIL': 'bench@example.com',
+    'FOLDER_ID'         : 'bench',
+    'JSON_FILE'         : '/dev/null',
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+}
+
+
+class Context(object):
+    """Enough of a Lambda context for the handlers."""
+    function_name = 'bench'
+    aws_request_id = 'bench'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+class Skip(Exception):
+    pass
+
+
+def s3_event(bucket, key, via_sns=False):
+    record = {'EventSource': 'aws:s3', 'eventSource': 'aws:s3',
+              's3': {'bucket': {'name': bucket}, 'object': {'key': key}}}
+    if not via_sns:
+        return {'Records': [record]}
+    return {'Records': [{'EventSource': 'aws:sns',
+                         'Sns': {'Message': json.dumps({'Records': [record]})}}]}
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for line in f) - 1
+
+def import_function(name):
+    sys.path.insert(0, os.path.join(REPO_DIR, name))
+    return importlib.import_module(name)
+
+def raw_key(day):
+    return day.strftime('raw_csv/%Y/%m/auctions-%Y-%m-%d.csv')
+
+
+# Stages: take (workdir, s3 stand-in, day), return the number of rows
+
+def stage_s3(workdir, s3, day):
+    module = import_function('auction_csv_to_s3')
+    module.requests.get = standins.fs_http_get(os.path.join(workdir, 'http'))
+    class event(object):
+        today = day.strftime('%Y-%m-%d')
+    module.lambda_handler(event, None)
+    return count_lines(s3._existing_path(BUCKET, raw_key(day)))
+
+def stage_clean(workdir, s3, day):
+    module = import_function('clean_auction_csv')
+    module.lambda_handler(s3_event(BUCKET, raw_key(day)), Context())
+    return count_lines(s3._existing_path(BUCKET, raw_key(day)))
+
+def stage_diff(workdir, s3, day):
+    """Stand-in for the diff function (not in this repo): hash diff on
+       the RELFIELDS of clean_auction_csv."""
+    module = import_function('clean_auction_csv')
+    csv = module.csv
+    lots = dict()
+    for name in ('latest', 'yesterday'):
+        with open(s3._existing_path(BUCKET, 'clean_csv/%s.csv' % name), 'rb') as f:
+            rdr = csv.reader(f, delimiter=',', quotechar='"')
+            header = next(rdr)
+            lots[name] = list(map(tuple, rdr))
+    relfields = module.RELFIELDS
+    set_diff = module.lot_to_set_of_reltuples(lots['latest'], relfields) - \
+               module.lot_to_set_of_reltuples(lots['yesterday'], relfields)
+    diff_lot = module.get_diff_lot(set_diff, lots['latest'])
+    path = os.path.join(workdir, 'diff.csv')
+    with open(path, 'wb') as f:
+        wrt = csv.writer(f, delimiter=',', quotechar='"')
+        wrt.writerow(header)
+        wrt.writerows(diff_lot)
+    with open(path, 'rb') as f:
+        s3.put_object(Bucket=BUCKET, Key='clean_csv/diff.csv', Body=f)
+    return len(lots['latest'])
+
+def setup_mysql(module):
+    """An empty table for auction_csv_to_raw_mysql `module`."""
+    from lambda_common import kms_secrets
+    kms_secrets.override('MYSQL_DB_PASSWORD', os.environ['MYSQL_DB_PASSWORD'])
+    def create_table(cursor):
+        cursor.execute('DROP TABLE IF EXISTS `%s`' % MYSQL_TABLE)
+        cursor.execute(module.CREATE_SQL)
+        # Its summary tables are created (empty) on the first load
+        summary_tables = module.summary_tables
+        for summary in summary_tables.SUMMARIES:
+            cursor.execute('DROP TABLE IF EXISTS `%s`' %
+                           summary_tables.table_name(MYSQL_TABLE, summary))
+    module.db.run(create_table)
+
+def stage_mysql(workdir, s3, day):
+    if not os.environ.get('BENCH_MYSQL'):
+        raise Skip('no MySQL configured (--mysql-host)')
+    module = import_function('auction_csv_to_raw_mysql')
+    setup_mysql(module)
+    module.lambda_handler(s3_event(BUCKET, 'clean_csv/diff.csv', via_sns=True),
+                          Context())
+    return count_lines(s3._existing_path(BUCKET, 'clean_csv/diff.csv'))
+
+def fake_google(module):
+    """Fake Drive service for auction_csv_to_google `module` (the Google
+       client libraries are only imported on use). Returns the list the
+       row counts of the uploads go to."""
+    uploaded = list()
+    class Request(object):
+        def __init__(self, result, media=None):
+            self.result, self.media = result, media
+            self.progress, self.lines = 0, 0
+        def execute(self):
+            return self.result
+        def next_chunk(self, num_retries=0):
+            # As googleapiclient does it: a short read is the last chunk
+            data = self.media.getbytes(self.progress, self.media.chunksize())
+            self.progress += len(data)
+            self.lines += data.count(b'\n')
+            if len(data) < self.media.chunksize():
+                uploaded.append(self.lines - 1)
+                return None, self.result
+            return self.progress, None
+    class Files(object):
+        def list(self, q):
+            return Request({'files': []})
+        def delete(self, fileId):
+            return Request({})
+        def create(self, body, media_body, fields):
+            return Request({'id': 'bench'}, media_body)
+    class Drive(object):
+        def files(self):
+            return Files()
+    module.get_delegated_credentials = lambda email: None
+    module.get_drive_service = lambda credentials: Drive()
+    # The upload's byte stream, without googleapiclient
+    module.csv_media_upload = module.CsvRowsStream
+    return uploaded
+
+def stage_google(workdir, s3, day):
+    module = import_function('auction_csv_to_google')
+    uploaded = fake_google(module)
+    module.lambda_handler(s3_event(BUCKET, 'clean_csv/latest.csv', via_sns=True),
+                          Context())
+    return sum(uploaded)
+
+def stage_pipeline(workdir, s3, day):
+    """Day 2 through auction_pipeline instead of the chain above (run
+       it on its own: --stages pipeline)."""
+    module = import_function('auction_pipeline')
+    fetch_fn = module.module('auction_csv_to_s3')
+    fetch_fn.requests.get = standins.fs_http_get(os.path.join(workdir, 'http'))
+    fake_google(module.module('auction_csv_to_google'))
+    sinks = ['s3', 'events', 'google']
+    if os.environ.get('BENCH_MYSQL'):
+        setup_mysql(module.module('auction_csv_to_raw_mysql'))
+        sinks.append('mysql')
+    summary = module.run(day.strftime('%Y-%m-%d'), bucket=BUCKET, sinks=sinks)
+    return summary['rows']
+
+STAGES = OrderedDict([
+    ('s3',      stage_s3),
+    ('clean',   stage_clean),
+    ('diff',    stage_diff),
+    ('mysql',   stage_mysql),
+    ('google',  stage_google),
+    ('pipeline', stage_pipeline),
+])
+# The chain; the pipeline stage does it all again
+CHAIN = ['s3', 'clean', 'diff', 'mysql', 'google']
+
+
+def run_stage(name, workdir, day):
+    """Run one stage in this process; return its metrics."""
+    for k, v in ENV_DEFAULTS.items():
+        os.environ.setdefault(k, v)
+    s3 = standins.install(workdir)
+    result = OrderedDict([('stage', name)])
+    start = time.time()
+    try:
+        rows = STAGES[name](workdir, s3, day)
+    except Skip as e:
+        result['skipped'] = str(e)
+        return result
+    wall = time.time() - start
+    result['wall_s']        = round(wall, 4)
+    result['rows']          = rows
+    result['rows_per_s']    = round(rows / wall, 1) if wall else None
+    # ru_maxrss: kB on Linux
+    result['peak_rss_mb']   = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    result['s3_calls']      = s3.calls
+    return result
+
+def run_stage_subprocess(name, workdir, day, env):
+    cmd = [sys.executable, '-m', 'benchmarks.bench_pipeline', '--run-stage',
+           name, '--workdir', workdir, '--day', day.strftime('%Y-%m-%d')]
+    proc = subprocess.Popen(cmd, cwd=REPO_DIR, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        return OrderedDict([('stage', name), ('error', err.decode('utf8')[-2000:])])
+    return json.loads(out.decode('utf8').strip().splitlines()[-1],
+                      object_pairs_hook=OrderedDict)
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=REPO_DIR).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    env = dict(os.environ)
+    if args.no_metrics:
+        env['METRICS_DISABLED'] = '1'
+    if args.mysql_host:
+        env.update({'BENCH_MYSQL': '1', 'MYSQL_HOST': args.mysql_host,
+                    'MYSQL_DB_NAME': args.mysql_db,
+                    'MYSQL_DB_USERNAME': args.mysql_user,
+                    'MYSQL_DB_PASSWORD': args.mysql_password})
+    try:
+        export_dir = os.path.join(workdir, 'http', 'exports')
+        os.makedirs(export_dir)
+        days = list()
+        for day, lines in synthetic_export.generate_days(
+                args.rows, 2, args.corrupt_rate, args.churn_rate, seed=args.seed):
+            synthetic_export.write_export(lines, os.path.join(
+                export_dir, synthetic_export.export_filename(day)))
+            days.append(day)
+        # clean_auction_csv renames latest.csv -> yesterday.csv
+        latest = os.path.join(workdir, 's3', BUCKET, 'clean_csv', 'latest.csv')
+        os.makedirs(os.path.dirname(latest))
+        open(latest, 'wb').close()
+        # Day 1: prime
+        for name in ('s3', 'clean'):
+            result = run_stage_subprocess(name, workdir, days[0], env)
+            if 'error' in result:
+                print('Priming failed in stage "%s":\n%s' % (name, result['error']))
+                return 1
+        # Day 2: measure
+        results = list()
+        for name in args.stages:
+            result = run_stage_subprocess(name, workdir, days[1], env)
+            results.append(result)
+            print(format_result(result))
+        report = OrderedDict([
+            ('meta', OrderedDict([
+                ('git_rev', git_rev()),
+                ('timestamp', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+                ('python', platform.python_version()),
+                ('rows', args.rows),
+                ('corrupt_rate', args.corrupt_rate),
+                ('churn_rate', args.churn_rate),
+                ('seed', args.seed),
+                ('metrics', not args.no_metrics),
+            ])),
+            ('stages', results),
+        ])
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(report, f, indent=2)
+            print('Results written to %s.' % args.out)
+        return 1 if any('error' in r for r in results) else 0
+    finally:
+        if args.keep:
+            print('Work dir kept: %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def format_result(r):
+    if 'skipped' in r:
+        return '%-8s skipped: %s' % (r['stage'], r['skipped'])
+    if 'error' in r:
+        return '%-8s ERROR:\n%s' % (r['stage'], r['error'])
+    return '%-8s %8.3f s %10s rows %12s rows/s %8.1f MB' % (
+        r['stage'], r['wall_s'], r['rows'], r['rows_per_s'], r['peak_rss_mb'])
+
+def compare(before_path, after_path):
+    """Print the relative change per stage between two result files."""
+    with open(before_path) as f:
+        before = dict((r['stage'], r) for r in json.load(f)['stages'])
+    with open(after_path) as f:
+        after = json.load(f)['stages']
+    metrics = ('wall_s', 'rows_per_s', 'peak_rss_mb')
+    print('%-8s %s' % ('stage', ''.join('%22s' % m for m in metrics)))
+    for r in after:
+        b = before.get(r['stage'], {})
+        cells = list()
+        for m in metrics:
+            if r.get(m) is None or not b.get(m):
+                cells.append('%22s' % '-')
+            else:
+                cells.append('%12s (%+6.1f%%)' % (r[m], 100.0 * (r[m] - b[m]) / b[m]))
+        print('%-8s %s' % (r['stage'], ''.join(cells)))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the auction pipeline.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--corrupt-rate', type=float, default=0.001)
+    parser.add_argument('--churn-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--stages', default=','.join(CHAIN),
+                        type=lambda s: s.split(','))
+    parser.add_argument('--out', help='write the results (JSON) to this file')
+    parser.add_argument('--keep', action='store_true', help="don't remove the work dir")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='run with METRICS_DISABLED=1 (to measure their overhead)')
+    parser.add_argument('--mysql-host')
+    parser.add_argument('--mysql-db', default='bench')
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    # Internal: run a single stage (in a fresh interpreter)
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--day', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.compare:
+        return compare(*args.compare)
+    if args.run_stage:
+        day = datetime.strptime(args.day, '%Y-%m-%d')
+        print(json.dumps(run_stage(args.run_stage, args.workdir, day)))
+        return 0
+    return run_benchmark(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
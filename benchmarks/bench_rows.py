@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_rows.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Memory of the clean rows of clean_auction_csv: the AuctionRecords
+#  (amounts in cents, dates in epoch seconds) against the plain tuples of
+#  Decimals and UTC date strings they replaced.
+#
+#   $ python -m benchmarks.bench_rows [--rows 100000]
+#
+#  Every representation is built in a fresh interpreter from the same
+#  synthetic export; the memory is the growth of the RSS while building
+#  it (the raw rows are read before). `access` times bid_is_suspicious
+#  over all rows. The records' text() must give the tuples' csv text:
+#  exit code 1 if not.
+#
+###############################################################################
+
+from __future__ import print_function
+import io
+import os
+import sys
+import gc
+import json
+import time
+import decimal
+import hashlib
+import argparse
+import importlib
+import subprocess
+
+from benchmarks import synthetic_export
+
+REPO_DIR    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES       = ['tuples', 'records']
+
+
+def import_clean():
+    os.environ.setdefault('BUCKET', 'bdm-auction-exports')
+    os.environ.setdefault('METRICS_DISABLED', '1')
+    sys.path.insert(0, os.path.join(REPO_DIR, 'clean_auction_csv'))
+    return importlib.import_module('clean_auction_csv')
+
+def legacy_converters(clean_fn):
+    """The clean functions of HEADER_LIST as they were: Decimal amounts
+       and "2017-01-12T16:23:29Z" dates."""
+    def field_to_decimal(val):
+        return decimal.Decimal(val.replace(',', '.')) if val else decimal.Decimal(0.0)
+    def datetime_to_utc(val):
+        if val:
+            epoch = clean_fn.datetime_to_epoch(val)
+            return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+        return None
+    legacy = {clean_fn.field_to_cents: field_to_decimal,
+              clean_fn.datetime_to_epoch: datetime_to_utc}
+    return [(n, legacy.get(func, func)) for n, func in clean_fn.CLEAN_ITEMS]
+
+def legacy_bid_is_suspicious(row):
+    bid, cost = row[5], row[7]
+    if not (row[9] or row[12]):
+        if cost:
+            return (bid / cost) > 5 or bid > 800
+        return bid > 800
+    return False
+
+def build_tuples(clean_fn, lot):
+    items = legacy_converters(clean_fn)
+    return [tuple([func(row[n]) for n, func in items][:-1]) for row in lot]
+
+def build_records(clean_fn, lot):
+    return clean_fn.clean_list_of_tuples(lot)
+
+def raw_lot(clean_fn, rows, seed):
+    day, lines = next(synthetic_export.generate_days(rows, 1, 0, seed=seed))
+    data = u'\n'.join(lines).encode('utf8') + b'\n'
+    return clean_fn.read_export(io.BytesIO(data))
+
+def run_mode(mode, rows, seed):
+    """One representation, in this interpreter: a dict of results."""
+    from lambda_common.metrics import rss_mb
+    clean_fn = import_clean()
+    lot = raw_lot(clean_fn, rows, seed)
+    gc.collect()
+    before = rss_mb()
+    start = time.time()
+    if mode == 'tuples':
+        clean = build_tuples(clean_fn, lot)
+        suspicious = legacy_bid_is_suspicious
+    else:
+        clean = build_records(clean_fn, lot)
+        suspicious = clean_fn.bid_is_suspicious
+    build = time.time() - start
+    gc.collect()
+    grown = rss_mb() - before
+    start = time.time()
+    flagged = sum(1 for row in clean if suspicious(row))
+    access = time.time() - start
+    if mode == 'tuples':
+        as_text = importlib.import_module('change_events').as_text
+        texts = [tuple(as_text(v) for v in row) for row in clean]
+    else:
+        texts = [row.text() for row in clean]
+    return {
+        'mode'      : mode,
+        'rows'      : len(clean),
+        'build_s'   : round(build, 3),
+        'mb'        : round(grown, 1),
+        'bytes_row' : int(grown * 1048576 / max(len(clean), 1)),
+        'access_s'  : round(access, 3),
+        'flagged'   : flagged,
+        'text_sha1' : hashlib.sha1(json.dumps(texts).encode('utf8')).hexdigest(),
+    }
+
+def run_subprocess(mode, rows, seed):
+    cmd = [sys.executable, '-m', 'benchmarks.bench_rows', '--run-mode', mode,
+           '--rows', str(rows), '--seed', str(seed)]
+    out = subprocess.check_output(cmd, cwd=REPO_DIR)
+    return json.loads(out.decode('utf8').strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--run-mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.run_mode:
+        print(json.dumps(run_mode(args.run_mode, args.rows, args.seed)))
+        return 0
+    results = [run_subprocess(mode, args.rows, args.seed) for mode in MODES]
+    print('%-8s %8s %9s %8s %10s %9s' % ('mode', 'rows', 'build s', 'MB',
+                                         'bytes/row', 'access s'))
+    for r in results:
+        print('%-8s %8s %9.3f %8.1f %10s %9.3f' % (r['mode'], r['rows'],
+              r['build_s'], r['mb'], r['bytes_row'], r['access_s']))
+    tuples, records = results
+    if tuples['mb']:
+        print('records: %.0f%% of the memory of tuples'
+              % (100.0 * records['mb'] / tuples['mb']))
+    same = tuples['text_sha1'] == records['text_sha1']
+    print('csv text: %s, suspicious bids: %s / %s' % (
+          'same' if same else 'DIFFERENT', tuples['flagged'], records['flagged']))
+    return 0 if same else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
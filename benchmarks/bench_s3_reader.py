@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_s3_reader.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Benchmark of lambda_common.s3_reader against a local S3 stand-in that
+#  behaves like S3 seen from a Lambda: every GET waits --latency ms for
+#  the first byte and one connection reads --bandwidth MB/s at most.
+#
+#   $ python -m benchmarks.bench_s3_reader
+#   $ python -m benchmarks.bench_s3_reader --sizes 1,16,128 --workers 16
+#
+#  Per object size (MB) and mode:
+#
+#   - single:   one GET, read to a file (what a plain get_object does)
+#   - download: s3_reader.download() to a file
+#   - buffer:   s3_reader.download_buffer()
+#   - stream:   s3_reader.open_stream(), every line read (as csv.reader
+#               would)
+#
+#  Every mode is checked against the object (sha1, or the line count).
+#  Exit code 1 on a mismatch.
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from lambda_common import s3_reader
+from benchmarks.standins import FsS3Client
+
+MB      = 1024 * 1024
+BUCKET  = 'bench'
+LINE    = (b'123456789012;Mali Media;Veiling %07d;%07d;Jan;Peeters;'
+           b'jan.peeters@example.com;1250.00;2017-05-01 12:00:00\n')
+
+
+class ThrottledBody(object):
+    def __init__(self, body, latency, bandwidth):
+        self.body       = body
+        self.latency    = latency
+        self.bandwidth  = bandwidth
+
+    def read(self, n=-1):
+        if self.latency:
+            time.sleep(self.latency)
+            self.latency = 0
+        data = self.body.read(n)
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+
+class ThrottledS3Client(FsS3Client):
+    """FsS3Client with the first-byte latency (s) and the bandwidth per
+       connection (bytes/s) of S3."""
+
+    def __init__(self, root, latency, bandwidth):
+        super(ThrottledS3Client, self).__init__(root)
+        self.latency    = latency
+        self.bandwidth  = bandwidth
+
+    def get_object(self, **kwargs):
+        res = super(ThrottledS3Client, self).get_object(**kwargs)
+        res['Body'] = ThrottledBody(res['Body'], self.latency, self.bandwidth)
+        return res
+
+    def head_object(self, **kwargs):
+        time.sleep(self.latency)
+        return super(ThrottledS3Client, self).head_object(**kwargs)
+
+
+def make_object(client, size_mb):
+    """A csv-like object of (about) size_mb MB; returns (key, sha1, lines)."""
+    key = 'objects/%s.csv' % size_mb
+    path = client._path(BUCKET, key)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    sha1 = hashlib.sha1()
+    size = lines = 0
+    with open(path, 'wb') as f:
+        while size < size_mb * MB:
+            block = b''.join(LINE % (i, i) for i in range(lines, lines + 1000))
+            f.write(block)
+            sha1.update(block)
+            size += len(block)
+            lines += 1000
+    return key, sha1.hexdigest(), lines
+
+def sha1_of_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def run_single(client, key, size, workdir, args):
+    path = os.path.join(workdir, 'single.out')
+    body = client.get_object(Bucket=BUCKET, Key=key)['Body']
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: body.read(MB), b''):
+            f.write(chunk)
+    return sha1_of_file(path)
+
+def run_download(client, key, size, workdir, args):
+    path = os.path.join(workdir, 'download.out')
+    with open(path, 'wb') as f:
+        s3_reader.download(client, BUCKET, key, f, size,
+                           range_size=args.range_size * MB,
+                           max_workers=args.workers)
+    return sha1_of_file(path)
+
+def run_buffer(client, key, size, workdir, args):
+    buf = s3_reader.download_buffer(client, BUCKET, key, size,
+                                    range_size=args.range_size * MB,
+                                    max_workers=args.workers)
+    return hashlib.sha1(buf).hexdigest()
+
+def run_stream(client, key, size, workdir, args):
+    lines = 0
+    with s3_reader.open_stream(client, BUCKET, key, size,
+                               range_size=args.range_size * MB,
+                               max_workers=args.workers) as f:
+        for line in f:
+            lines += 1
+    return lines
+
+MODES = [
+    ('single',      run_single),
+    ('download',    run_download),
+    ('buffer',      run_buffer),
+    ('stream',      run_stream),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1,16,128,1024',
+                        help='object sizes in MB (default: %(default)s)')
+    parser.add_argument('--modes', default=','.join(m for m, _ in MODES))
+    parser.add_argument('--latency', type=float, default=30,
+                        help='first-byte latency per GET, ms')
+    parser.add_argument('--bandwidth', type=float, default=80,
+                        help='MB/s per connection (0: unlimited)')
+    parser.add_argument('--range-size', type=int,
+                        default=s3_reader.RANGE_SIZE // MB, help='MB')
+    parser.add_argument('--workers', type=int, default=s3_reader.MAX_WORKERS)
+    parser.add_argument('--workdir', help='default: a temporary directory')
+    args = parser.parse_args(argv)
+    s3_reader.MIN_PARALLEL = 2 * args.range_size * MB
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_s3_reader-')
+    client = ThrottledS3Client(os.path.join(workdir, 's3'),
+                               args.latency / 1000.0, args.bandwidth * MB)
+    modes = [(name, func) for name, func in MODES
+             if name in args.modes.split(',')]
+    print('latency %s ms, %s MB/s per connection, %s MB ranges, %s workers'
+          % (args.latency, args.bandwidth or 'unlimited', args.range_size,
+             args.workers))
+    print('%8s  %-9s %9s %9s %6s  %s' % ('size MB', 'mode', 's', 'MB/s',
+                                         'GETs', 'check'))
+    failed = 0
+    try:
+        for size_mb in [int(s) for s in args.sizes.split(',')]:
+            key, sha1, lines = make_object(client, size_mb)
+            size = os.path.getsize(client._path(BUCKET, key))
+            for name, func in modes:
+                client.calls.clear()
+                start = time.time()
+                result = func(client, key, size, workdir, args)
+                secs = time.time() - start
+                ok = result == (lines if name == 'stream' else sha1)
+                failed += not ok
+                print('%8s  %-9s %9.3f %9.1f %6s  %s' % (
+                    size_mb, name, secs, size / MB / secs,
+                    client.calls.get('get_object', 0), 'OK' if ok else 'FAIL'))
+            os.remove(client._path(BUCKET, key))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  check_diff.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  The change events of clean_auction_csv's hash diff (yesterday in a
+#  dict) against those of the merge diff (both sorted on auc_id), day
+#  after day of synthetic exports:
+#
+#   $ python -m benchmarks.check_diff [--rows 20000 --days 4]
+#
+#  Yesterday is read back from its clean csv, as the function does, and
+#  merged as written sorted and shuffled (external_sort, with a budget
+#  small enough to spill). Exits 1 if the events of any day differ.
+#
+###############################################################################
+
+from __future__ import print_function
+import io
+import sys
+import json
+import random
+import logging
+import argparse
+
+from benchmarks import synthetic_export
+from benchmarks.bench_rows import import_clean
+
+
+def clean_day(clean_fn, day, lines):
+    data = u'\r\n'.join(lines).encode('utf8') + b'\r\n'
+    lot = clean_fn.read_export(io.BytesIO(data))
+    rows, _ = clean_fn.clean_rows(lot, synthetic_export.export_filename(day))
+    return rows
+
+def csv_rows(clean_fn, rows, path):
+    """`rows` written as the clean csv, read back."""
+    clean_fn.lot_to_csv_file(rows, path)
+    with open(path, 'rb') as f:
+        return list(clean_fn.clean_csv_rows(f))
+
+def dumps(events):
+    return sorted(json.dumps(e) for e in events)
+
+def check_day(clean_fn, day, previous, rows, scr, budget, seed):
+    """(number of events, spill files, [what differs])."""
+    import sorted_diff
+    from change_events import ChangeDetector
+    key = clean_fn.auc_id_key
+    today = [row.text() for row in rows]
+    detector = ChangeDetector(clean_fn.CLEAN_HEADER, day)
+    detector.load_previous(previous)
+    expected = dumps(detector.events(today))
+    today.sort(key=key)
+    in_order = sorted(previous, key=key)
+    shuffled = list(previous)
+    random.Random(seed).shuffle(shuffled)
+    spills = list()
+    spill = sorted_diff._spill
+    def counted_spill(run, path):
+        spills.append(path)
+        return spill(run, path)
+    sorted_diff._spill = counted_spill
+    try:
+        merges = [
+            ('sorted', in_order),
+            ('shuffled', sorted_diff.external_sort(shuffled, key, scr, budget)),
+        ]
+        differs = [name for name, previous_rows in merges
+                   if dumps(ChangeDetector(clean_fn.CLEAN_HEADER, day)
+                            .merged_events(previous_rows, today)) != expected]
+    finally:
+        sorted_diff._spill = spill
+    return len(expected), len(spills), differs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the merge diff against the hash diff.')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=4)
+    parser.add_argument('--churn-rate', type=float, default=0.1)
+    parser.add_argument('--budget', type=int, default=256 * 1024,
+                        help='bytes per sorted run (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+    clean_fn = import_clean()
+    clean_fn.log.setLevel(logging.WARNING)
+    from lambda_common import scratch
+    failed, previous = 0, None
+    with scratch.task('check_diff') as scr:
+        for day, lines in synthetic_export.generate_days(
+                args.rows, args.days, 0, args.churn_rate, seed=args.seed):
+            rows = clean_day(clean_fn, day, lines)
+            if previous is not None:
+                events, spills, differs = check_day(
+                    clean_fn, day, previous, rows, scr, args.budget, args.seed)
+                print('%s  %6s events  %3s spill files  %s' % (
+                    day.strftime('%Y-%m-%d'), events, spills,
+                    'DIFFERENT (%s)' % ', '.join(differs) if differs
+                    else 'same'))
+                failed += bool(differs)
+            previous = csv_rows(clean_fn, rows, scr.path('previous.csv'))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  check_history.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Round trip of the clean history: clean_auction_csv adds a few days of
+#  synthetic exports to it (local S3 stand-in), history_query reads them
+#  back with DuckDB and every row is compared with what was cleaned:
+#
+#   $ python -m benchmarks.check_history [--rows 5000 --days 3]
+#
+#  The writing side can run in another interpreter, the λ's python2.7
+#  with the history layer (clean_auction_csv/requirements-history.txt):
+#
+#   $ PYTHONPATH=/path/to/layer python -m benchmarks.check_history \
+#       --writer-python python2.7
+#
+#  Also checks the date and partner pruning of the manifest and that a
+#  re-run of a day replaces its partition. Exits 1 on any difference.
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+
+from benchmarks import synthetic_export
+from benchmarks.check_diff import clean_day
+from benchmarks.bench_rows import import_clean
+from benchmarks.standins import FsS3Client
+
+BUCKET = 'bdm-auction-exports'
+
+
+def cleaned_days(clean_fn, args):
+    """[(day, filename, rows)] of the synthetic exports."""
+    return [(day, synthetic_export.export_filename(day),
+             clean_day(clean_fn, day, lines))
+            for day, lines in synthetic_export.generate_days(
+                args.rows, args.days, 0, args.churn_rate, seed=args.seed)]
+
+def write_history(clean_fn, days, root):
+    """Add every day to the history under `root`, then the first one
+       again (a re-run). The rows added go to `root`/expected.json, for
+       the reading side (the synthetic days differ per interpreter).
+       Returns 1 if the history isn't written."""
+    import clean_history
+    from lambda_common import scratch
+    if not clean_history.is_available():
+        print('No history: pyarrow missing or CLEAN_HISTORY=0.')
+        return 1
+    clean_fn.s3_client = FsS3Client(root)
+    with scratch.task('check_history') as scr:
+        for day, filename, rows in days + days[:1]:
+            # Errors are only logged there: the manifest tells
+            clean_fn.add_to_history(BUCKET, filename, rows, scr)
+    expected = dict((day.strftime('%Y-%m-%d'),
+                     [row.text() + (clean_fn.bid_is_suspicious(row), )
+                      for row in rows])
+                    for day, filename, rows in days)
+    with open(os.path.join(root, 'expected.json'), 'w') as f:
+        json.dump(expected, f)
+    return 0
+
+def read_expected(clean_fn, root):
+    """{dt: rows as the history should return them (sorted)}"""
+    from clean_history import CONVERTERS
+    kinds = [kind for name, kind in clean_fn.HISTORY_COLUMNS]
+    with open(os.path.join(root, 'expected.json')) as f:
+        days = json.load(f)
+    return dict((dt, sorted(tuple(CONVERTERS[kind](val)
+                                  for kind, val in zip(kinds, row))
+                            for row in rows))
+                for dt, rows in days.items())
+
+def read_rows(clean_fn, root, dt):
+    """The rows of `dt` as DuckDB returns them (sorted), timestamps as
+       naive UTC like the converters'."""
+    import pytz
+    import history_query
+    names = ', '.join(name for name, kind in clean_fn.HISTORY_COLUMNS)
+    _, rows = history_query.query(
+        root, 'SELECT %s FROM clean_history' % names, dt, dt)
+    def naive(val):
+        if hasattr(val, 'tzinfo') and val.tzinfo is not None:
+            return val.astimezone(pytz.utc).replace(tzinfo=None)
+        return val
+    return sorted(tuple(naive(val) for val in row) for row in rows)
+
+def check_history(clean_fn, root):
+    """([what differs], rows checked)"""
+    import history_query
+    differs = list()
+    expected = read_expected(clean_fn, root)
+    root = os.path.join(root, BUCKET)
+    manifest = history_query.read_manifest(root)['partitions']
+    dts = sorted(expected)
+    if sorted(manifest) != dts:
+        differs.append('partitions %s, not %s' % (sorted(manifest), dts))
+    for dt in dts:
+        rows = manifest.get(dt, {}).get('rows')
+        if rows != len(expected[dt]):
+            differs.append('%s: %s rows in the manifest, not %s' % (
+                dt, rows, len(expected[dt])))
+        if read_rows(clean_fn, root, dt) != expected[dt]:
+            differs.append('%s: rows read back differ' % dt)
+    # Pruning: the last day's rarest partner, on the other days too
+    partners = dict()
+    for row in expected[dts[-1]]:
+        partners[row[1]] = partners.get(row[1], 0) + 1
+    partner = min(sorted(partners), key=partners.get)
+    files = history_query.partition_files(root, dts[-1], dts[-1], [partner])
+    if len(files) != 1:
+        differs.append('%s files for one day and partner' % len(files))
+    counts = dict((dt, sum(1 for row in rows if row[1] == partner))
+                  for dt, rows in expected.items())
+    _, found = history_query.query(
+        root, 'SELECT CAST(dt AS VARCHAR), count(*) FROM clean_history '
+              'GROUP BY 1', partners=[partner])
+    if dict(found) != dict((dt, n) for dt, n in counts.items() if n):
+        differs.append('rows of %s per day: %s, not %s' % (
+            partner, dict(found), counts))
+    return differs, sum(len(rows) for rows in expected.values())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the clean history: write it, read it with DuckDB.')
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--churn-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--writer-python', metavar='PYTHON',
+                        help='write the history with this interpreter')
+    parser.add_argument('--write-only', metavar='ROOT',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    clean_fn = import_clean()
+    clean_fn.log.setLevel(logging.WARNING)
+    if args.write_only:
+        return write_history(clean_fn, cleaned_days(clean_fn, args),
+                             args.write_only)
+    from lambda_common import scratch
+    with scratch.task('check_history') as scr:
+        root = scr.path('s3')
+        if args.writer_python:
+            failed = subprocess.call(
+                [args.writer_python, '-m', 'benchmarks.check_history',
+                 '--rows', str(args.rows), '--days', str(args.days),
+                 '--churn-rate', str(args.churn_rate),
+                 '--seed', str(args.seed), '--write-only', root])
+        else:
+            failed = write_history(clean_fn, cleaned_days(clean_fn, args),
+                                   root)
+        if failed:
+            return 1
+        differs, rows = check_history(clean_fn, root)
+    for line in differs:
+        print('DIFFERENT: %s' % line)
+    if not differs:
+        print('%s days, %s rows: same' % (args.days, rows))
+    return 1 if differs else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
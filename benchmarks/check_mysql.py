@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  check_mysql.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Checks of the SQL of the functions against a real MariaDB/MySQL: what
+#  the stand-ins of the benchmarks can't tell (locking, snapshots, the
+#  server's view of our statements, lost connections).
+#
+#   $ docker run -d -p 3306:3306 -e MYSQL_ALLOW_EMPTY_PASSWORD=1 mariadb:10.6
+#   $ python -m benchmarks.check_mysql --mysql-host 127.0.0.1
+#   $ python -m benchmarks.check_mysql --mysql-host 127.0.0.1 lead_race
+#
+#  Every check works in its own tables of the `--mysql-db` database (made
+#  if needed): don't point it at a production schema. Exits 1 if a check
+#  fails. Needs the requirements of the functions (pymysql, boto3).
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import time
+import decimal
+import argparse
+import importlib
+import threading
+import traceback
+from collections import OrderedDict
+
+REPO_DIR    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENV_DEFAULTS = {
+    'TOPIC_ARN'         : 'arn:aws:sns:eu-west-1:000000000000:check',
+    'METRICS_DISABLED'  : '1',
+    'IDEMPOTENCY_STORE' : 'none',
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+}
+
+# name: check(server), in the order they run
+CHECKS = OrderedDict()
+
+def check(func):
+    CHECKS[func.__name__[len('check_'):]] = func
+    return func
+
+
+class Server(object):
+    """The MariaDB/MySQL of the checks."""
+
+    def __init__(self, host, port, user, password, db):
+        self.host, self.port = host, port
+        self.user, self.password, self.db = user, password, db
+
+    def connect(self, **kwargs):
+        import pymysql
+        return pymysql.connect(self.host, port=self.port, user=self.user,
+                               passwd=self.password, db=self.db,
+                               charset='utf8', **kwargs)
+
+    def manager(self, **kwargs):
+        from lambda_common.mysql_conn import ConnectionManager
+        return ConnectionManager(self.host, port=self.port, user=self.user,
+                                 password=self.password, db=self.db, **kwargs)
+
+    def execute(self, *statements):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def kill(self, conn, after=0):
+        """KILL (the thread of) pymysql connection `conn`, from another
+           connection, `after` seconds from now (in a thread)."""
+        sql = 'KILL %d' % conn.thread_id()
+        if not after:
+            return self.execute(sql)
+        timer = threading.Timer(after, self.execute, (sql, ))
+        timer.start()
+        return timer
+
+    def query(self, sql, args=()):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                return cursor.fetchall()
+        finally:
+            conn.close()
+
+
+def import_function(name, env=None):
+    for k, v in dict(ENV_DEFAULTS, **(env or {})).items():
+        os.environ.setdefault(k, v)
+    sys.path.insert(0, os.path.join(REPO_DIR, name))
+    return importlib.import_module(name)
+
+
+# bdm_event_lead_trigger
+
+LEAD_TABLES = [
+    """CREATE TABLE `Contacts` (
+        `uuid` VARCHAR(36) NOT NULL PRIMARY KEY,
+        `email` VARCHAR(255), `email_cleaned` VARCHAR(255) NOT NULL,
+        `email_local` VARCHAR(255), `email_domain` VARCHAR(255),
+        `email_tld` VARCHAR(64), `err_msg` VARCHAR(255),
+        UNIQUE KEY `email_cleaned` (`email_cleaned`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE `Campaigns` (
+        `uuid` VARCHAR(36) NOT NULL PRIMARY KEY,
+        `short_name` VARCHAR(255), `campaign_decimal` DECIMAL(10,2),
+        `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE `ContactsCampaigns` (
+        `contact_uuid` VARCHAR(36) NOT NULL, `campaign_uuid` VARCHAR(36) NOT NULL,
+        `time_stamp` VARCHAR(32), `day` DATE NOT NULL,
+        `source_ip` VARCHAR(64), `location` VARCHAR(255),
+        PRIMARY KEY (`contact_uuid`, `campaign_uuid`, `day`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+]
+
+def lead_trigger(server):
+    """bdm_event_lead_trigger on fresh tables of `server`."""
+    module = import_function('bdm_event_lead_trigger',
+                             {'MYSQL_HOST': server.host})
+    server.execute('DROP TABLE IF EXISTS `ContactsCampaigns`',
+                   'DROP TABLE IF EXISTS `Campaigns`',
+                   'DROP TABLE IF EXISTS `Contacts`', *LEAD_TABLES)
+    module.db = server.manager(client_flag=module.CLIENT.MULTI_STATEMENTS)
+    module.rds_campaigns.clear()
+    return module
+
+def lead(email, n=0):
+    return {'meta': {'context': {'api-key': 'check', 'stage': 'check'}},
+            'data': {'email': email, 'source_ip': '10.0.0.%s' % n,
+                     'timestamp': '2017-05-01T10:00:0%sZ' % n}}
+
+def campaign(n):
+    return {'UUID': {'S': 'campaign-%s' % n},
+            'CampaignShortName': {'S': 'check-%s' % n},
+            'CampaignDecimal': {'N': '%s.1' % n}}
+
+@check
+def check_lead_race(server):
+    """A new contact whose insert loses to a lead that committed after
+       this transaction's first SELECT: it gets the winner's uuid."""
+    module = lead_trigger(server)
+    from lambda_common.emails import split_email
+    email = split_email('race@example.com')
+    winner = dict()
+    first_uuid = module.new_contact_uuid
+    def new_contact_uuid(email_cleaned):
+        # Between our SELECT (nothing) and our INSERT: another container
+        # adds the contact, on its own connection, and commits
+        loser_db, module.db = module.db, server.manager(
+            client_flag=module.CLIENT.MULTI_STATEMENTS)
+        module.new_contact_uuid = first_uuid
+        try:
+            winner['result'] = module.rds_contact_upsert(
+                email, lead('race@example.com', 1), campaign(1), 's3://a')
+        finally:
+            module.db.close()
+            module.db = loser_db
+        return first_uuid(email_cleaned)
+    module.new_contact_uuid = new_contact_uuid
+    try:
+        loser = module.rds_contact_upsert(email, lead('race@example.com', 2),
+                                          campaign(2), 's3://b')
+    finally:
+        module.new_contact_uuid = first_uuid
+        module.db.close()
+    contact_uuid, _, is_new = winner['result']
+    assert is_new, winner
+    assert loser[0] == contact_uuid and not loser[2], (loser, winner)
+    rows = server.query('SELECT `uuid` FROM `Contacts`')
+    assert rows == ((contact_uuid, ), ), rows
+    rows = server.query('SELECT `contact_uuid`, `campaign_uuid` '
+                        'FROM `ContactsCampaigns` ORDER BY 2')
+    assert rows == ((contact_uuid, 'campaign-1'), (contact_uuid, 'campaign-2')), rows
+
+@check
+def check_lead_concurrent(server, threads=8):
+    """Concurrent leads for the same new email, a connection each: one
+       contact, everyone gets its uuid, nobody fails."""
+    module = lead_trigger(server)
+    from lambda_common.emails import split_email
+    from benchmarks.bench_leads import PerThread
+    module.db = PerThread(module.db)
+    email = split_email('concurrent@example.com')
+    start = threading.Barrier(threads) if hasattr(threading, 'Barrier') else None
+    results, errors = list(), list()
+    def container(n):
+        try:
+            if start:
+                start.wait()
+            results.append(module.rds_contact_upsert(
+                email, lead('concurrent@example.com', n), campaign(n), 's3://x'))
+        except Exception:
+            errors.append(traceback.format_exc())
+    workers = [threading.Thread(target=container, args=(n, ))
+               for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    module.db.close()
+    assert not errors, errors[0]
+    uuids = set(r[0] for r in results)
+    assert len(uuids) == 1, uuids
+    assert sum(r[2] for r in results) == 1, results
+    rows = server.query('SELECT COUNT(*), COUNT(DISTINCT `contact_uuid`) '
+                        'FROM `ContactsCampaigns`')
+    assert rows == ((threads, 1), ), rows
+
+
+# lambda_common.mysql_conn
+
+CONN_TABLE = """CREATE TABLE `ConnCheck` (
+    `id` INT NOT NULL PRIMARY KEY, `value` VARCHAR(32)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+def conn_table(server):
+    server.execute('DROP TABLE IF EXISTS `ConnCheck`', CONN_TABLE)
+
+def insert(n, sleep=0):
+    """Unit of work: insert row `n` (after `sleep` s, the first time)."""
+    calls = list()
+    def func(cursor):
+        calls.append(n)
+        cursor.execute('INSERT INTO `ConnCheck` VALUES (%s, %s) '
+                       'ON DUPLICATE KEY UPDATE `value` = VALUES(`value`)',
+                       (n, 'row %s' % n))
+        if sleep and len(calls) == 1:
+            cursor.execute('SELECT SLEEP(%s)', (sleep, ))
+        return n
+    func.calls = calls
+    return func
+
+def conn_rows(server):
+    return [r[0] for r in server.query('SELECT `id` FROM `ConnCheck` ORDER BY 1')]
+
+@check
+def check_conn_lost_idle(server):
+    """A connection killed while idle (gone away, 2006/2013): idempotent
+       work is run again on a new connection."""
+    conn_table(server)
+    db = server.manager(ping_after=3600)
+    db.run(insert(1))
+    server.kill(db.connection())
+    time.sleep(0.2)
+    func = insert(2)
+    assert db.run(func, idempotent=True) == 2
+    assert func.calls == [2, 2], func.calls
+    assert db.stats['retries'] == 1, db.stats
+    assert conn_rows(server) == [1, 2], conn_rows(server)
+    db.close()
+
+@check
+def check_conn_lost_query(server):
+    """A connection killed during a query (lost, 2013): idempotent work
+       is run again, and only committed once."""
+    conn_table(server)
+    db = server.manager(ping_after=3600)
+    server.kill(db.connection(), after=0.5)
+    func = insert(1, sleep=5)
+    start = time.time()
+    assert db.run(func, idempotent=True) == 1
+    assert func.calls == [1, 1] and time.time() - start < 4, func.calls
+    assert db.stats['retries'] == 1, db.stats
+    assert conn_rows(server) == [1], conn_rows(server)
+    db.close()
+
+@check
+def check_conn_not_idempotent(server):
+    """Work that isn't idempotent is never run again: the lost connection
+       is raised, nothing is committed, the next run reconnects."""
+    from lambda_common.mysql_conn import is_connection_lost
+    conn_table(server)
+    db = server.manager(ping_after=3600)
+    server.kill(db.connection(), after=0.5)
+    func = insert(1, sleep=5)
+    try:
+        db.run(func)
+    except Exception as e:
+        assert is_connection_lost(e), e
+    else:
+        raise AssertionError('run() of a lost connection returned')
+    assert func.calls == [1] and db.stats['retries'] == 0, db.stats
+    assert conn_rows(server) == [], conn_rows(server)
+    # The next unit of work gets a new connection (after the ping)
+    db.ping_after = 0
+    db.run(insert(2))
+    assert conn_rows(server) == [2], conn_rows(server)
+    db.close()
+
+@check
+def check_conn_ping_after(server):
+    """No ping within `ping_after` s of the last use; after it, the ping
+       finds the killed connection and reconnects before the work runs."""
+    conn_table(server)
+    db = server.manager(ping_after=1)
+    pings = list()
+    is_healthy = db._is_healthy
+    def counted_ping(conn):
+        pings.append(time.time())
+        return is_healthy(conn)
+    db._is_healthy = counted_ping
+    db.run(insert(1))
+    db.run(insert(2))
+    assert not pings, pings
+    server.kill(db.connection())
+    time.sleep(1.5)
+    func = insert(3)
+    db.run(func)
+    assert len(pings) == 1 and func.calls == [3], (pings, func.calls)
+    assert db.stats['reconnects'] == 1 and db.stats['retries'] == 0, db.stats
+    assert conn_rows(server) == [1, 2, 3], conn_rows(server)
+    db.close()
+
+@check
+def check_conn_rollback(server):
+    """A unit of work that raises is rolled back: the next one on the same
+       connection doesn't commit it."""
+    conn_table(server)
+    db = server.manager()
+    def failing(cursor):
+        insert(1)(cursor)
+        raise ValueError('halfway')
+    try:
+        db.run(failing)
+    except ValueError:
+        pass
+    db.run(insert(2))
+    assert conn_rows(server) == [2], conn_rows(server)
+    db.close()
+
+
+# auction_csv_to_raw_mysql
+
+def raw_mysql(server):
+    """auction_csv_to_raw_mysql on a fresh table of `server`, without
+       summary tables (the first load makes them)."""
+    module = import_function('auction_csv_to_raw_mysql', {
+        'MYSQL_HOST': server.host, 'MYSQL_DB_NAME': server.db,
+        'MYSQL_DB_USERNAME': server.user, 'MYSQL_TABLE_NAME': 'AuctionsRaw'})
+    table = module.MYSQL['table_name']
+    server.execute('DROP TABLE IF EXISTS `%s`' % table, *[
+        'DROP TABLE IF EXISTS `%s`' % module.summary_tables.table_name(table, s)
+        for s in module.summary_tables.SUMMARIES])
+    # Strict: a text of the clean csv MySQL would have to coerce ('' dates,
+    # 'True' booleans) is an error, not a zero
+    module.db = server.manager(
+        charset='utf8', sql_mode='STRICT_TRANS_TABLES,NO_ENGINE_SUBSTITUTION')
+    module._tables_checked = False
+    return module
+
+def auction(module, auc_id, date_high_bid, **values):
+    """A row of the diff (clean csv columns, as text)."""
+    row = dict((name, u'') for _, name, _ in module.HEADER_LIST)
+    row.update(ogm=u'%012d' % auc_id, auc_id=u'%s' % auc_id,
+               pa_title=u'Partner A', auc_title=u'Check %s' % auc_id,
+               high_bid=u'100.00', admin_cost=u'5.00', garant_price=u'0',
+               annul_ins=u'0', full_option=u'0',
+               cust_email=u'check%s@example.com' % auc_id,
+               bid_is_suspicious=u'False', date_high_bid=date_high_bid)
+    row.update(values)
+    return tuple(row[name] for _, name, _ in module.HEADER_LIST)
+
+def summary_rows(server, module, summary, columns):
+    table = module.summary_tables.table_name(module.MYSQL['table_name'],
+                                             summary)
+    return [(u'%s' % row[0], ) + tuple(row[1:]) for row in server.query(
+        'SELECT `day`, `pa_title`, %s FROM `%s` ORDER BY 1, 2' % (
+            ', '.join('`%s`' % c for c in columns), table))]
+
+@check
+def check_summary_days(server):
+    """Loads that insert, update, move a row to another partner and pay
+       or annul it: after each one the summary tables are what a rebuild
+       makes of them, with the days of Brussels (around midnight UTC)."""
+    module = raw_mysql(server)
+    summary_tables = module.summary_tables
+    table = module.MYSQL['table_name']
+    loads = [
+        # 23:30 and 00:30 in Brussels, a payment at 00:15 on the 23rd
+        [auction(module, 1, u'2017-08-21T21:30:00Z'),
+         auction(module, 2, u'2017-08-21T22:30:00Z'),
+         auction(module, 3, u'2017-08-22T10:00:00Z',
+                 pay_date=u'2017-08-22T22:15:00Z')],
+        [auction(module, 2, u'2017-08-21T22:30:00Z',
+                 pay_date=u'2017-08-23T08:00:00Z'),
+         auction(module, 4, u'2017-08-23T23:59:00Z', pa_title=u'Partner B')],
+        [auction(module, 1, u'2017-08-21T21:30:00Z', pa_title=u'Partner B',
+                 high_bid=u'80.00'),
+         auction(module, 3, u'2017-08-22T10:00:00Z',
+                 pay_date=u'2017-08-22T22:15:00Z',
+                 annul_date=u'2017-08-24T09:00:00Z')],
+    ]
+    for n, diff_lot in enumerate(loads):
+        module.upsert_diff(diff_lot)
+        differences = module.db.run(
+            lambda cursor: summary_tables.verify(cursor, table))
+        assert not any(differences.values()), (n, differences)
+    partner_day, revenue_day = summary_tables.SUMMARIES
+    rows = summary_rows(server, module, partner_day, ['auctions', 'paid'])
+    assert rows == [(u'2017-08-21', u'Partner B', 1, 0),
+                    (u'2017-08-22', u'Partner A', 2, 2),
+                    (u'2017-08-24', u'Partner B', 1, 0)], rows
+    rows = summary_rows(server, module, revenue_day,
+                        ['paid', 'annulled', 'revenue'])
+    assert rows == [(u'2017-08-23', u'Partner A', 2, 1,
+                     decimal.Decimal('105.00'))], rows
+    module.db.close()
+
+@check
+def check_summary_suspicious(server):
+    """A suspicious row ('True' in the clean csv) is loaded as 1 and
+       counted in the summary; made 'False' again, it isn't."""
+    module = raw_mysql(server)
+    summary_tables = module.summary_tables
+    table = module.MYSQL['table_name']
+    partner_day = summary_tables.SUMMARIES[0]
+    for suspicious, counted in ((u'True', 1), (u'False', 0)):
+        module.upsert_diff([
+            auction(module, 1, u'2017-08-21T10:00:00Z',
+                    bid_is_suspicious=suspicious),
+            auction(module, 2, u'2017-08-21T11:00:00Z')])
+        rows = server.query('SELECT `bid_is_suspicious` FROM `%s` '
+                            'ORDER BY `auc_id`' % table)
+        assert rows == ((counted, ), (0, )), (suspicious, rows)
+        rows = summary_rows(server, module, partner_day,
+                            ['auctions', 'suspicious'])
+        assert rows == [(u'2017-08-21', u'Partner A', 2, counted)], (
+            suspicious, rows)
+        differences = module.db.run(
+            lambda cursor: summary_tables.verify(cursor, table))
+        assert not any(differences.values()), (suspicious, differences)
+    module.db.close()
+
+@check
+def check_ogm_conflict(server):
+    """A row of the diff whose OGM belongs to another auc_id: left out
+       (with a warning), the other row keeps its values, the rest of the
+       diff is loaded (a new OGM of an auction too) and the summary tables
+       agree."""
+    module = raw_mysql(server)
+    table = module.MYSQL['table_name']
+    module.upsert_diff([auction(module, 1, u'2017-08-21T10:00:00Z'),
+                        auction(module, 2, u'2017-08-21T11:00:00Z')])
+    sent = list()
+    send = module.alerts.send
+    module.alerts.send = lambda *args: sent.append(args)
+    try:
+        module.upsert_diff([
+            auction(module, 3, u'2017-08-22T10:00:00Z', ogm=u'%012d' % 1,
+                    pa_title=u'Partner B', high_bid=u'999.00'),
+            auction(module, 2, u'2017-08-21T11:00:00Z', ogm=u'%012d' % 22,
+                    high_bid=u'50.00')])
+    finally:
+        module.alerts.send = send
+    assert len(sent) == 1 and 'auc_id 3' in sent[0][2], sent
+    rows = server.query('SELECT `auc_id`, `ogm`, `pa_title`, `high_bid` '
+                        'FROM `%s` ORDER BY 1' % table)
+    assert rows == ((1, u'%012d' % 1, u'Partner A', decimal.Decimal('100.00')),
+                    (2, u'%012d' % 22, u'Partner A', decimal.Decimal('50.00'))
+                    ), rows
+    differences = module.db.run(
+        lambda cursor: module.summary_tables.verify(cursor, table))
+    assert not any(differences.values()), differences
+    module.db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the SQL of the functions against MariaDB/MySQL.')
+    parser.add_argument('checks', nargs='*', metavar='check',
+                        help='default: all (%s)' % ', '.join(CHECKS))
+    parser.add_argument('--mysql-host', required=True)
+    parser.add_argument('--mysql-port', type=int, default=3306)
+    parser.add_argument('--mysql-db', default='bench')
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    args = parser.parse_args(argv)
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error('no check "%s"' % name)
+    server = Server(args.mysql_host, args.mysql_port, args.mysql_user,
+                    args.mysql_password, None)
+    server.execute('CREATE DATABASE IF NOT EXISTS `%s`' % args.mysql_db)
+    server.db = args.mysql_db
+    from lambda_common import kms_secrets
+    kms_secrets.override('MYSQL_DB_PASSWORD', args.mysql_password)
+    failed = 0
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name](server)
+        except Exception:
+            failed += 1
+            print('%-24s FAILED\n%s' % (name, traceback.format_exc()))
+        else:
+            print('%-24s ok' % name)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  standins.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Local stand-ins for the AWS services the functions use:
+#
+#   - S3: a directory per bucket on the local filesystem
+#   - SNS, SQS, Kinesis: messages/records are appended (as JSON lines) to
+#     sns.jsonl, sqs.jsonl, kinesis.jsonl
+#   - HTTP (the auction export URL): served from the local filesystem
+#   - DynamoDB: get_item/put_item on tables in memory
+#
+#  `install(workdir)` patches `boto3.client`, so it has to be called
+#  before the function modules are imported. MySQL is not stood in for:
+#  point MYSQL_HOST to a local MariaDB/MySQL (bench_leads has its own
+#  stand-in for the statements of bdm_event_lead_trigger).
+#
+###############################################################################
+
+import os
+import io
+import json
+import time
+import shutil
+import threading
+try:
+    from urllib.parse import urlparse, parse_qsl    # Python 3
+except ImportError:
+    from urlparse import urlparse, parse_qsl        # Python 2
+
+
+class NoSuchKey(Exception):
+    """What the real client raises (as a ClientError) for a missing key."""
+    pass
+
+
+class PreconditionFailed(Exception):
+    """What the real client raises (as a ClientError) for an IfMatch that
+       doesn't match."""
+    response = {'Error': {'Code': 'PreconditionFailed'},
+                'ResponseMetadata': {'HTTPStatusCode': 412}}
+
+
+class FsS3Client(object):
+    """The part of the boto3 S3 client the functions use, on local disk."""
+
+    class exceptions(object):
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, root):
+        self.root = root
+        self.calls = dict()
+        # (bucket, key): tags, as put
+        self.tags = dict()
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        # Ranged GETs come from several threads
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _existing_path(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            raise NoSuchKey('s3://%s/%s' % (bucket, key))
+        return path
+
+    def _write(self, bucket, key, body):
+        path = self._path(bucket, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            if hasattr(body, 'read'):
+                shutil.copyfileobj(body, f)
+            else:
+                # boto3 takes text too (utf-8)
+                if not isinstance(body, bytes):
+                    body = body.encode('utf8')
+                f.write(body)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self._count('download_fileobj')
+        with open(self._existing_path(Bucket, Key), 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self._count('upload_fileobj')
+        self._write(Bucket, Key, Fileobj)
+
+    def _etag(self, path):
+        return '"%x"' % int(os.path.getmtime(path) * 1000)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        self._count('get_object')
+        path = self._existing_path(Bucket, Key)
+        if IfMatch is not None and IfMatch != self._etag(path):
+            raise PreconditionFailed('s3://%s/%s' % (Bucket, Key))
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if Range:
+                # Only read the range: ranged GETs of big objects
+                start, end = [int(x) for x in Range[len('bytes='):].split('-')]
+                end = min(end, size - 1)
+                f.seek(start)
+                data = f.read(end - start + 1)
+            else:
+                data = f.read()
+        response = {'ContentLength': len(data), 'ETag': self._etag(path)}
+        if Range:
+            response['ContentRange'] = 'bytes %s-%s/%s' % (start, end, size)
+        response['Body'] = io.BytesIO(data)
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count('head_object')
+        path = self._existing_path(Bucket, Key)
+        return {'ContentLength': os.path.getsize(path),
+                'ETag': self._etag(path)}
+
+    def put_object(self, Bucket, Key, Body=b'', Tagging='', **kwargs):
+        self._count('put_object')
+        self._write(Bucket, Key, Body)
+        self.tags[(Bucket, Key)] = dict(parse_qsl(Tagging))
+        return {'ETag': '"local"'}
+
+    def copy_object(self, Bucket, CopySource, Key, **kwargs):
+        self._count('copy_object')
+        src_bucket, src_key = CopySource.split('/', 1)
+        shutil.copyfile(self._existing_path(src_bucket, src_key),
+                        self._path(Bucket, Key))
+        # TaggingDirective COPY, the default
+        self.tags[(Bucket, Key)] = dict(self.tags.get((src_bucket, src_key),
+                                                      {}))
+        return {}
+
+    def get_object_tagging(self, Bucket, Key, **kwargs):
+        self._count('get_object_tagging')
+        self._existing_path(Bucket, Key)
+        tags = self.tags.get((Bucket, Key), {})
+        return {'TagSet': [{'Key': k, 'Value': v}
+                           for k, v in sorted(tags.items())]}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._count('delete_object')
+        path = self._path(Bucket, Key)
+        if os.path.isfile(path):
+            os.remove(path)
+        self.tags.pop((Bucket, Key), None)
+        return {}
+
+
+class FileSNSClient(object):
+    """SNS client that appends the published messages to a file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, **kwargs):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(kwargs) + '\n')
+        return {'MessageId': 'local'}
+
+
+class FileSQSClient(object):
+    """SQS client that appends the sent messages to a file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        with open(self.path, 'a') as f:
+            for entry in Entries:
+                f.write(json.dumps({'QueueUrl': QueueUrl,
+                                    'MessageBody': entry['MessageBody']}) + '\n')
+        return {'Successful': [{'Id': e['Id']} for e in Entries]}
+
+
+class FileKinesisClient(object):
+    """Kinesis client that appends the records to a file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def put_records(self, StreamName, Records, **kwargs):
+        with open(self.path, 'a') as f:
+            for record in Records:
+                data = record['Data']
+                if isinstance(data, bytes):
+                    data = data.decode('utf8')
+                f.write(json.dumps({'StreamName': StreamName,
+                                    'PartitionKey': record['PartitionKey'],
+                                    'Data': data}) + '\n')
+        return {'FailedRecordCount': 0,
+                'Records': [{'SequenceNumber': '0'} for r in Records]}
+
+
+class MemoryDynamoDBClient(object):
+    """get_item/put_item on tables in memory: {table name: {key: item}},
+       the key being the value of the item's `key_names` attribute.
+       Every call takes `latency` seconds."""
+
+    def __init__(self, key_names=None, latency=0.0):
+        # {table name: key attribute}
+        self.key_names  = dict(key_names or {})
+        self.latency    = latency
+        self.tables     = dict()
+        self.calls      = dict()
+        self._lock      = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key(self, table, item):
+        attr = self.key_names.get(table) or sorted(item)[0]
+        return json.dumps(item[attr], sort_keys=True)
+
+    def put_item(self, TableName, Item, **kwargs):
+        self._call('put_item')
+        with self._lock:
+            self.tables.setdefault(TableName, {})[self._key(TableName, Item)] = Item
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call('get_item')
+        item = self.tables.get(TableName, {}).get(self._key(TableName, Key))
+        return {'Item': item} if item is not None else {}
+
+
+class FsHTTPResponse(object):
+
+    def __init__(self, path):
+        self.status_code = 200 if os.path.isfile(path) else 404
+        self.content = b''
+        if self.status_code == 200:
+            with open(path, 'rb') as f:
+                self.content = f.read()
+        self.text = self.content.decode('utf8', 'replace')
+
+
+def fs_http_get(root):
+    """A `requests.get` that serves http://<anything>/<path> from `root`."""
+    def get(url, *args, **kwargs):
+        return FsHTTPResponse(os.path.join(root, urlparse(url).path.lstrip('/')))
+    return get
+
+
+def install(workdir, dynamodb=None):
+    """Patch boto3.client: S3, SNS, SQS and Kinesis go to `workdir`,
+       DynamoDB to `dynamodb` (a MemoryDynamoDBClient) if given, the rest
+       is real. Returns the S3 stand-in."""
+    import boto3
+    s3 = FsS3Client(os.path.join(workdir, 's3'))
+    standins = {
+        's3'        : s3,
+        'sns'       : FileSNSClient(os.path.join(workdir, 'sns.jsonl')),
+        'sqs'       : FileSQSClient(os.path.join(workdir, 'sqs.jsonl')),
+        'kinesis'   : FileKinesisClient(os.path.join(workdir, 'kinesis.jsonl')),
+    }
+    if dynamodb is not None:
+        standins['dynamodb'] = dynamodb
+    real_client = boto3.client
+    def client(service_name, *args, **kwargs):
+        if service_name in standins:
+            return standins[service_name]
+        return real_client(service_name, *args, **kwargs)
+    boto3.client = client
+    return s3
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
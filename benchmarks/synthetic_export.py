@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  synthetic_export.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Generator of synthetic auction exports, in the raw (';'-delimited)
+#  format auction_csv_to_s3 downloads and clean_auction_csv reads.
+#
+#   - `rows`: number of auctions on the first day
+#   - `corrupt_rate`: fraction of lines with a stray ';' (bad lines)
+#   - `churn_rate`: fraction of auctions that change from one day to the
+#       next (paid, annulled, collected, new bid). Half as many new
+#       auctions come in, and as many old ones drop out.
+#
+#   $ python -m benchmarks.synthetic_export /tmp/exports --rows 100000 --days 2
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# Raw header, as in the export (see HEADER_LIST of clean_auction_csv)
+RAW_HEADER = [
+    'OGM code', 'Partner Titel', 'Veiling Titel', 'Veiling ID',
+    'Veiling link', 'Hoogste bod', 'Administratiekost', 'Garante prijs',
+    'Datum Hoogste bod', 'Betaal datum', 'Annuleringsverzekering',
+    'Full option', 'Annulatie datum', 'Inningsdatum', 'Extra informatie',
+    'Clang ID', 'Klant Voornaam', 'Klant Achternaam', 'Klant Email',
+    'Klant Straat', 'Klant Nummer', 'Klant Toevoeging', 'Klant Postcode',
+    'Klant Gemeente', 'Klant Telefoon', 'Clang error',
+]
+
+PARTNERS    = [u'Hotel Ter Duinen', u'Restaurant De Kroon', u'Wellness Aqua',
+               u'Kasteel van Gaasbeek', u'B&B Het Anker', u'Brasserie Nova']
+ITEMS       = [u'Overnachting voor 2', u'Diner 3-gangen', u'Dagje wellness',
+               u'Weekend aan zee', u'Ballonvaart', u'Kookworkshop']
+FIRST_NAMES = [u'jan', u'an', u'piet', u'marie', u'joke', u'luc', u'élise']
+LAST_NAMES  = [u'peeters', u'janssens', u'maes', u'jacobs', u'de smet']
+DOMAINS     = [u'telenet.be', u'gmail.com', u'hotmail.com', u'skynet.be',
+               u'example.com']
+TOWNS       = [u'gent', u'brugge', u'antwerpen', u'leuven', u'kortrijk']
+STREETS     = [u'kerkstraat', u'stationsstraat', u'dorpstraat', u'markt']
+
+DATE_FMT    = '%Y-%m-%d %H:%M:%S'
+
+
+def fmt_decimal(value):
+    """Decimal as in the export: '12,50'."""
+    return (u'%.2f' % value).replace(u'.', u',')
+
+def fmt_date(value):
+    return value.strftime(DATE_FMT) if value else u''
+
+def ogm_code(auc_id):
+    base = auc_id % 10 ** 10
+    check = base % 97 or 97
+    digits = u'%010d%02d' % (base, check)
+    return u'="%s/%s/%s"' % (digits[:3], digits[3:7], digits[7:])
+
+def new_auction(rnd, auc_id, day):
+    bid = rnd.uniform(5, 400)
+    first = rnd.choice(FIRST_NAMES)
+    last = rnd.choice(LAST_NAMES)
+    return {
+        'auc_id'        : auc_id,
+        'partner'       : rnd.choice(PARTNERS),
+        'title'         : rnd.choice(ITEMS),
+        'high_bid'      : bid,
+        'admin_cost'    : rnd.choice([2.5, 3.5, 4.95]),
+        'garant_price'  : bid * rnd.uniform(0.8, 3) if rnd.random() < 0.9 else 0,
+        'date_high_bid' : day - timedelta(seconds=rnd.randint(0, 86400 * 7)),
+        'pay_date'      : None,
+        'annul_ins'     : rnd.choice([0, 0, 2.95]),
+        'full_option'   : rnd.choice([0, 0, 0, 9.95]),
+        'annul_date'    : None,
+        'collect_date'  : None,
+        'clang_id'      : rnd.randint(100000, 999999),
+        'fname'         : first,
+        'lname'         : last,
+        'email'         : u'%s.%s%s@%s' % (first, last.replace(u' ', u''),
+                            rnd.randint(1, 9999), rnd.choice(DOMAINS)),
+        'street'        : rnd.choice(STREETS),
+        'housenr'       : rnd.randint(1, 250),
+        'town'          : rnd.choice(TOWNS),
+    }
+
+def churn(rnd, auction, day):
+    """Move an auction one step further in its life."""
+    event = rnd.random()
+    when = day - timedelta(seconds=rnd.randint(0, 86400))
+    if auction['pay_date'] is None and auction['annul_date'] is None:
+        if event < 0.5:
+            auction['pay_date'] = when
+        elif event < 0.6:
+            auction['annul_date'] = when
+        else:
+            auction['high_bid'] *= rnd.uniform(1.01, 1.5)
+            auction['date_high_bid'] = when
+    elif auction['pay_date'] and auction['collect_date'] is None:
+        auction['collect_date'] = when
+
+def auction_to_fields(a):
+    return [
+        ogm_code(a['auc_id']), a['partner'], a['title'],
+        u'%s' % a['auc_id'], u'https://www.biedmee.be/veiling/%s' % a['auc_id'],
+        fmt_decimal(a['high_bid']), fmt_decimal(a['admin_cost']),
+        fmt_decimal(a['garant_price']) if a['garant_price'] else u'',
+        fmt_date(a['date_high_bid']), fmt_date(a['pay_date']),
+        fmt_decimal(a['annul_ins']), fmt_decimal(a['full_option']),
+        fmt_date(a['annul_date']), fmt_date(a['collect_date']),
+        u'', u'%s' % a['clang_id'], a['fname'], a['lname'],
+        a['email'].upper() if a['clang_id'] % 17 == 0 else a['email'],
+        a['street'], u'%s' % a['housenr'], u'', u'9000', a['town'],
+        u'+32 9 %s' % a['clang_id'], u'',
+    ]
+
+def quote(field):
+    if u';' in field or u'"' in field or u'\n' in field:
+        return u'"%s"' % field.replace(u'"', u'""')
+    return field
+
+def to_line(fields, corrupt=False):
+    line = u';'.join(quote(f) for f in fields)
+    if corrupt:
+        # A stray, unquoted ';' in the title: one field too many
+        line = line.replace(fields[2], fields[2] + u';', 1)
+    return line
+
+def generate_days(rows, days=2, corrupt_rate=0.001, churn_rate=0.05,
+                  start=None, seed=42):
+    """Yield (date, list of lines) for `days` consecutive days."""
+    rnd = random.Random(seed)
+    day = start or datetime(2017, 8, 21, 6, 0, 0)
+    next_id = 100000
+    auctions = list()
+    for i in range(rows):
+        auctions.append(new_auction(rnd, next_id, day))
+        next_id += 1
+    for d in range(days):
+        if d:
+            day += timedelta(days=1)
+            for auction in rnd.sample(auctions, int(len(auctions) * churn_rate)):
+                churn(rnd, auction, day)
+            n_new = int(len(auctions) * churn_rate / 2)
+            del auctions[:n_new]
+            for i in range(n_new):
+                auctions.append(new_auction(rnd, next_id, day))
+                next_id += 1
+        lines = [to_line(RAW_HEADER)]
+        lines.extend(to_line(auction_to_fields(a), rnd.random() < corrupt_rate)
+                     for a in auctions)
+        yield day, lines
+
+def write_export(lines, path):
+    with open(path, 'wb') as f:
+        f.write(u'\r\n'.join(lines).encode('utf8'))
+        f.write(b'\r\n')
+    return path
+
+def export_filename(day):
+    return day.strftime('auctions-%Y-%m-%d.csv')
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic auction exports.')
+    parser.add_argument('out_dir')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--corrupt-rate', type=float, default=0.001)
+    parser.add_argument('--churn-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    for day, lines in generate_days(args.rows, args.days, args.corrupt_rate,
+                                    args.churn_rate, seed=args.seed):
+        path = write_export(lines, os.path.join(args.out_dir, export_filename(day)))
+        print('%s: %s lines' % (path, len(lines) - 1))
+    return 0
+
+if __name__ == '__main__':
+    main()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
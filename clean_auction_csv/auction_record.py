@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  auction_record.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Compact rows of a clean export: a tuple class (namedtuple, no __dict__)
+#  with a field per column, made from the column kinds:
+#
+#   Record = auction_record.record_type('AuctionRecord',
+#                                       [('auc_id', 'string'),
+#                                        ('high_bid', 'cents'),
+#                                        ('pay_date', 'epoch'), ...])
+#   row = Record(u'1234', 1250, 1493640000)
+#   row.high_bid                # 1250: amounts in integer cents
+#   row.text()                  # (u'1234', u'12.50', u'2017-05-01T12:00:00Z')
+#
+#  An int takes a quarter of the memory of a Decimal and less than half
+#  of a date string; indexing (row[5]) works as with the plain tuples.
+#  text() gives the values as they're written in the clean csv.
+#
+###############################################################################
+
+import time
+import calendar
+import decimal
+from collections import namedtuple
+
+# Own context: whatever precision the cleaner sets
+CENTS_CONTEXT   = decimal.Context(prec=18, rounding=decimal.ROUND_HALF_UP)
+DATE_FORMAT     = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def to_cents(val):
+    """'12,50' or '12.50' -> 1250; None if empty. Raises (as Decimal()
+       does) decimal.InvalidOperation on what isn't a number."""
+    if not val:
+        return None
+    val = val.replace(',', '.')
+    units, _, fraction = val.partition('.')
+    # The usual 1250.50: no Decimal needed
+    if units.isdigit() and len(fraction) == 2 and fraction.isdigit():
+        return int(units) * 100 + int(fraction)
+    amount = decimal.Decimal(val)
+    return int(amount.scaleb(2, context=CENTS_CONTEXT)
+                     .to_integral_value(context=CENTS_CONTEXT))
+
+def to_epoch(dt):
+    """Aware datetime -> seconds since the epoch (UTC)."""
+    return calendar.timegm(dt.utctimetuple())
+
+def cents_text(cents):
+    if cents is None:
+        # An empty amount has always been written as 0
+        return u'0'
+    sign = u'-' if cents < 0 else u''
+    return u'%s%d.%02d' % (sign, abs(cents) // 100, abs(cents) % 100)
+
+def epoch_text(epoch):
+    if epoch is None:
+        return u''
+    return u'%s' % time.strftime(DATE_FORMAT, time.gmtime(epoch))
+
+def string_text(val):
+    if val is None:
+        return u''
+    if isinstance(val, bytes):
+        return val.decode('utf8')
+    return val
+
+# Column kind: its text
+TEXT = {
+    'string'    : string_text,
+    'cents'     : cents_text,
+    'epoch'     : epoch_text,
+}
+
+
+def record_type(name, columns):
+    """A tuple class named `name` for rows of `columns`: [(column name,
+       kind)] with kind one of TEXT."""
+    texts = tuple(TEXT[kind] for _, kind in columns)
+
+    class Record(namedtuple(name, [column for column, _ in columns])):
+        __slots__ = ()
+        kinds = tuple(kind for _, kind in columns)
+
+        def text(self):
+            """The values as text (as in the clean csv)."""
+            return tuple([f(v) for f, v in zip(texts, self)])
+
+    Record.__name__ = name
+    return Record
+
+def record_maker(record):
+    """Fast constructor of `record` (a record_type) from a sequence."""
+    return lambda values: tuple.__new__(record, values)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  change_events.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Typed change events between two clean exports (yesterday, today), per
+#  auction (auc_id):
+#
+#   auction_created     auc_id not in yesterday's export
+#   paid                pay_date got (another) value
+#   annulled            annul_date got (another) value
+#   collected           collect_date got (another) value
+#   bid_changed         high_bid or date_high_bid changed
+#
+#  A new auction that is already paid (...) gets auction_created and paid.
+#  Every event has the changed fields before (not for auction_created)
+#  and after, and an `id` (date:type:auc_id) to deduplicate on:
+#
+#   {"id":"2017-05-02:paid:1234","type":"paid","dt":"2017-05-02",
+#    "auc_id":"1234","ogm":"...","before":{"pay_date":""},
+#    "after":{"pay_date":"2017-05-01T12:00:00Z"}}
+#
+#  Yesterday is kept in a dict of only the tracked fields (hash diff), or,
+#  for exports too big for that, merged with today with both sorted on
+#  auc_id (merged_events, see sorted_diff). Values are compared as they
+#  are in the clean csv (text), amounts by their value: 155 is 155.00.
+#
+###############################################################################
+
+import decimal
+from collections import OrderedDict
+# Own
+import sorted_diff
+
+KEY     = 'auc_id'
+OGM     = 'ogm'
+# Event type: the fields that trigger it
+TRANSITIONS = OrderedDict([
+    ('paid',        ('pay_date', )),
+    ('annulled',    ('annul_date', )),
+    ('collected',   ('collect_date', )),
+    ('bid_changed', ('high_bid', 'date_high_bid')),
+])
+CREATED = 'auction_created'
+# Only set (not cleared) dates count as a transition
+SET_ONLY = ('paid', 'annulled', 'collected')
+# Compared as numbers
+AMOUNTS = ('high_bid', )
+
+
+def as_text(val):
+    """A value as it is written in (so read back from) the clean csv."""
+    if val is None:
+        return u''
+    if isinstance(val, bytes):
+        return val.decode('utf8')
+    return u'%s' % (val, )
+
+
+def as_amount(val):
+    """An amount of the clean csv ('155', '155.00', '12.5') as a Decimal,
+       as it is if it isn't a number."""
+    try:
+        return decimal.Decimal(val or 0)
+    except decimal.InvalidOperation:
+        return val
+
+def is_same(field, old, new):
+    if old == new:
+        return True
+    if field in AMOUNTS:
+        return as_amount(old) == as_amount(new)
+    return False
+
+
+class ChangeDetector(object):
+    """`header`: the names of the columns of the rows (clean csv)."""
+
+    def __init__(self, header, day):
+        self.header     = list(header)
+        self.dt         = day.strftime('%Y-%m-%d')
+        self.key_idx    = self.header.index(KEY)
+        self.ogm_idx    = self.header.index(OGM)
+        self.fields     = list()
+        for fields in TRANSITIONS.values():
+            for field in fields:
+                if field not in self.fields:
+                    self.fields.append(field)
+        self.field_idx  = [self.header.index(f) for f in self.fields]
+        self.previous   = dict()
+
+    def _tracked(self, row):
+        return tuple(as_text(row[i]) for i in self.field_idx)
+
+    def load_previous(self, rows):
+        """Yesterday's rows (any iterable, e.g. a csv reader)."""
+        key_idx = self.key_idx
+        for row in rows:
+            self.previous[as_text(row[key_idx])] = self._tracked(row)
+        return len(self.previous)
+
+    def _event(self, kind, auc_id, ogm, before, after):
+        event = OrderedDict([
+            ('id',      '%s:%s:%s' % (self.dt, kind, auc_id)),
+            ('type',    kind),
+            ('dt',      self.dt),
+            ('auc_id',  auc_id),
+            ('ogm',     ogm),
+        ])
+        if before is not None:
+            event['before'] = before
+        event['after'] = after
+        return event
+
+    def key(self, row):
+        return as_text(row[self.key_idx])
+
+    def events(self, rows):
+        """Yield the events of today's `rows`."""
+        for row in rows:
+            new = self._tracked(row)
+            old = self.previous.get(self.key(row))
+            if old != new:
+                for event in self._row_events(row, old, new):
+                    yield event
+
+    def merged_events(self, previous_rows, rows):
+        """`events` without yesterday in a dict: `previous_rows` and `rows`
+           are both sorted on key() (see sorted_diff)."""
+        for kind, old_row, row in sorted_diff.diff(previous_rows, rows,
+                                                   self.key, self._tracked):
+            if row is not None:
+                old = self._tracked(old_row) if old_row is not None else None
+                for event in self._row_events(row, old, self._tracked(row)):
+                    yield event
+
+    def _row_events(self, row, old, new):
+        auc_id = self.key(row)
+        ogm = as_text(row[self.ogm_idx])
+        created = old is None
+        if created:
+            after = OrderedDict((f, v) for f, v in zip(self.fields, new) if v)
+            yield self._event(CREATED, auc_id, ogm, None, after)
+            old = tuple(u'' for _ in self.fields)
+        old_values = dict(zip(self.fields, old))
+        new_values = dict(zip(self.fields, new))
+        for kind, fields in TRANSITIONS.items():
+            changed = [f for f in fields
+                       if not is_same(f, old_values[f], new_values[f])]
+            if not changed:
+                continue
+            if kind in SET_ONLY and not new_values[fields[0]]:
+                continue
+            if created and kind == 'bid_changed':
+                continue
+            yield self._event(kind, auc_id, ogm,
+                OrderedDict((f, old_values[f]) for f in changed),
+                OrderedDict((f, new_values[f]) for f in changed))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  chunked_csv.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  A csv (bytes) in chunks of whole records, handled by worker processes:
+#
+#   chunks = chunked_csv.split_records(data, begin, CHUNK_SIZE, b';')
+#   for result in chunked_csv.map_chunks(func, data, chunks, workers):
+#       ...                             # func(data, chunk), in chunk order
+#
+#  A record ends at a newline outside a quoted field, as csv.reader sees
+#  it: a quote opens a field only at its start (`TV 55" scherm` is no
+#  quoted field), "" in a quoted field is a quote, and a quoted field may
+#  hold newlines. Lines without a quote (most of them) are records as
+#  they are. Every chunk knows the index of its first record, so row
+#  numbers stay those of the whole file.
+#
+#  The workers are forked processes with a Pipe each: Lambda has no
+#  /dev/shm, so multiprocessing.Pool and Queue don't work there. The
+#  data isn't copied to them (fork), only the results come back.
+#
+#  A child forked while other threads run (the alerts thread, boto3's
+#  and s3_reader's pools, those of an earlier invocation in a warm
+#  container) can inherit a lock one of them holds, and hang on it.
+#  Python 2.7 has no fresh-interpreter start method, so:
+#
+#   workers = chunked_csv.Workers(4)
+#   workers.start()             # first thing, before any thread exists
+#   ...
+#   for result in map_chunks(func, data, chunks, pool=workers):
+#
+#  Workers are forked once (per container) and kept; they get the bytes
+#  of every chunk through their Pipe. Without them, map_chunks only forks
+#  while this is the only thread, otherwise the chunks are done here.
+#
+###############################################################################
+
+import os
+import logging
+import threading
+import traceback
+import multiprocessing
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+Chunk = namedtuple('Chunk', ['begin', 'end', 'first_index', 'records'])
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def next_record(data, pos, end=None, delimiter=b','):
+    """Offset after the record that starts at `pos` (its newline), as
+       csv.reader reads it: a quote only opens a field at the start of
+       the field ("" in it is a quote), anywhere else it's a character."""
+    end = len(data) if end is None else end
+    field_start = True
+    while pos < end:
+        if field_start and data[pos:pos + 1] == b'"':
+            # A quoted field: up to its closing quote
+            pos += 1
+            while True:
+                quote = data.find(b'"', pos, end)
+                if quote < 0:
+                    return end
+                pos = quote + 1
+                if data[pos:pos + 1] != b'"':
+                    break
+                pos += 1
+            # Anything after it, up to a delimiter, is unquoted
+            field_start = False
+            continue
+        newline = data.find(b'\n', pos, end)
+        newline = end if newline < 0 else newline
+        delim = data.find(delimiter, pos, newline)
+        if delim < 0:
+            return min(newline + 1, end)
+        pos, field_start = delim + 1, True
+    return end
+
+def split_records(data, begin=0, chunk_size=16 * 1024 * 1024, delimiter=b','):
+    """[Chunk] of about `chunk_size` bytes of whole records, from offset
+       `begin` (e.g. after the header) to the end of `data`."""
+    chunks = list()
+    end = len(data)
+    pos, first, records, start = begin, 0, 0, begin
+    while pos < end:
+        newline = data.find(b'\n', pos)
+        newline = end if newline < 0 else newline
+        if data.find(b'"', pos, newline) < 0:
+            # Most lines: no quotes, the record is the line
+            pos = min(newline + 1, end)
+        else:
+            pos = next_record(data, pos, end, delimiter)
+        records += 1
+        if pos - start >= chunk_size:
+            chunks.append(Chunk(start, pos, first, records))
+            start, first, records = pos, first + records, 0
+    if records:
+        chunks.append(Chunk(start, end, first, records))
+    return chunks
+
+
+def _work(conn, func, data, chunks):
+    try:
+        for chunk in chunks:
+            conn.send((True, func(data, chunk)))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+def _context():
+    # fork: the workers share `data` instead of getting a pickled copy
+    get_context = getattr(multiprocessing, 'get_context', None)
+    return get_context('fork') if get_context else multiprocessing
+
+def _serve(conn):
+    # A worker of Workers: (func, data, chunk) in, result out, until None
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        except Exception:
+            # Not unpickled: e.g. `func` defined after the fork
+            conn.send((False, traceback.format_exc()))
+            continue
+        if item is None:
+            break
+        func, data, chunk = item
+        try:
+            conn.send((True, func(data, chunk)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+class Workers(object):
+    """Worker processes forked before there are threads, kept for the
+       chunks of later calls (see the top of this file)."""
+
+    def __init__(self, size=None):
+        self.size   = size or cpu_count()
+        self.procs  = list()
+        self.conns  = list()
+
+    def start(self):
+        """Fork the workers, if not running yet. Only while this is the
+           only thread: returns whether they run."""
+        if self.is_running() or self.size <= 1:
+            return self.is_running()
+        self.close()
+        if threading.active_count() > 1:
+            log.warning('%s threads running: no worker processes started.',
+                        threading.active_count())
+            return False
+        ctx = _context()
+        for n in range(self.size):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_serve, args=(child_conn, ))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self.procs.append(proc)
+            self.conns.append(parent_conn)
+        log.info('%s worker processes started.', self.size)
+        return True
+
+    def is_running(self):
+        return bool(self.procs) and all(p.is_alive() for p in self.procs)
+
+    def map(self, func, data, chunks, workers=None):
+        """Yield func(data, chunk) for every chunk, in order: one chunk
+           (its bytes, offsets from 0) per worker at a time. `func` has
+           to be picklable (a module-level function, or a partial of
+           one)."""
+        workers = min(workers or self.size, self.size, len(chunks))
+        def send(n):
+            chunk = chunks[n]
+            self.conns[n % workers].send((func, data[chunk.begin:chunk.end],
+                chunk._replace(begin=0, end=chunk.end - chunk.begin)))
+        idle = False
+        try:
+            for n in range(workers):
+                send(n)
+            for n in range(len(chunks)):
+                ok, result = self.conns[n % workers].recv()
+                if not ok:
+                    # The chunks still out first: the workers stay usable
+                    for m in range(n + 1, min(n + workers, len(chunks))):
+                        self.conns[m % workers].recv()
+                    idle = True
+                    raise RuntimeError('Chunk %s failed:\n%s' % (n, result))
+                if n + workers < len(chunks):
+                    send(n + workers)
+                yield result
+            idle = True
+        finally:
+            if not idle:
+                # Results on their way (or a worker died): start over
+                self.close()
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            conn.close()
+        for proc in self.procs:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self.procs, self.conns = list(), list()
+
+
+def map_chunks(func, data, chunks, workers=None, pool=None):
+    """Yield func(data, chunk) for every chunk, in order. Chunks are dealt
+       round-robin over `workers` processes (default: one per CPU): those
+       of `pool` (Workers) if it runs, else forked for this call, but only
+       while this is the only thread. One worker runs them here, without
+       a process."""
+    workers = min(workers or cpu_count(), len(chunks))
+    if workers > 1 and pool is not None and pool.is_running():
+        for result in pool.map(func, data, chunks, workers):
+            yield result
+        return
+    if workers > 1 and threading.active_count() > 1:
+        log.warning('%s threads running: not forking, the chunks are done '
+                    'in this process.', threading.active_count())
+        workers = 1
+    if workers <= 1:
+        for chunk in chunks:
+            yield func(data, chunk)
+        return
+    ctx = _context()
+    procs, conns = list(), list()
+    try:
+        for n in range(workers):
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_work,
+                               args=(child_conn, func, data, chunks[n::workers]))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            procs.append(proc)
+            conns.append(parent_conn)
+        for n in range(len(chunks)):
+            ok, result = conns[n % workers].recv()
+            if not ok:
+                raise RuntimeError('Chunk %s failed:\n%s' % (n, result))
+            yield result
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        for conn in conns:
+            conn.close()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -27,25 +27,37 @@
 #  AWS λ-function to:
 #
 #   - get/read today's raw csv from S3
-#   - clean it:
+#   - clean it (big exports: in chunks over all CPUs, see chunked_csv.py):
 #       - format fields (datetime to UTC, strip away chars in OGM, ...)
 #       - find and remove bad lines (send out warning)
 #       - mark suspicious bids
+#       - profile it: nulls, parse failures, duplicates, ... per column
+#         (report in clean_csv/latest_quality.json, warning on drift)
 #   - filter it:
 #       - remove rows from own domains and emails
+#       - one row per auc_id and per OGM: the latest date_high_bid wins
 #   - save to S3 on /clean_csv (which will trigger the diff-fn):
 #       - rename clean_csv/latest.csv -> clean_csv/yesterday.csv
 #       - upload new to clean_csv/latest.csv
+#   - send out change events (auction_created, paid, annulled, collected,
+#     bid_changed) against the previous export, see change_events.py
+#     (big exports: sorted merge instead of a dict, see sorted_diff.py)
+#   - add it to the history: clean_history/dt=yyyy-mm-dd/ (Parquet, only
+#     with pyarrow installed, see clean_history.py)
 #
 #   That's all...
 #
 ###############################################################################
 
 
+import os
+import io
 import logging
+import json
 import urllib
 import gzip
 import decimal
+import functools
 from datetime import datetime, timedelta
 from collections import OrderedDict
 try:
@@ -54,13 +66,28 @@ except ImportError:
     from io import StringIO
 # 3th party
 import unicodecsv as csv
-import pytz
-import requests
-import boto3
-from botocore.client import Config
-import botocore.exceptions as boto_exceptions
+# Own
+from lambda_common import alerts
+from lambda_common import auction_schema
+from lambda_common import aws_clients
+from lambda_common import event_sinks
+from lambda_common import events
+from lambda_common import idempotency
+from lambda_common import metrics
+from lambda_common import s3_reader
+from lambda_common import scratch
+from lambda_common.emails import clean_email, split_emails
+from data_profile import DataProfile, drift
+import clean_history
+from change_events import ChangeDetector, as_text
+import sorted_diff
+import auction_record
+import chunked_csv
 
 decimal.getcontext().prec = 2
+# bid/cost of bid_is_suspicious: rounded to 2 digits (5.04 isn't > 5), as
+# it always was, in whatever thread
+RATIO_CONTEXT = decimal.Context(prec=2)
 
 # Logging
 log = logging.getLogger('clean_auction_csv')
@@ -71,40 +98,68 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno
 ch.setFormatter(formatter)
 log.addHandler(ch)
 
-# Download CSV as file to /tmp: easier for the csv-module
+# Download CSV as file: easier for the csv-module
 # instead of: csv_string = response['Body'].read()
-tmp_file = '/tmp/tmp.csv'
-
+# 'tmp' and 'tmp_clean' are file names in the scratch directory of the
+# export (see lambda_common.scratch), which is removed afterwards.
 tmp_names = {
     'today': {
-        'tmp': '/tmp/current_csv.csv',
-        'tmp_clean': '/tmp/current_csv_clean.csv',
+        'tmp': 'current_csv.csv',
+        'tmp_clean': 'current_csv_clean.csv',
         's3_key' : 'clean_csv/latest.csv',
     },
     'yesterday': {
-        'tmp': '/tmp/yesterday_csv.csv',
-        'tmp_clean': '/tmp/yesterday_csv_clean.csv',
+        'tmp': 'yesterday_csv.csv',
+        'tmp_clean': 'yesterday_csv_clean.csv',
         's3_key' : 'clean_csv/yesterday.csv',
     },
     'diff': {
-        'tmp': '/tmp/diff_csv.csv',
-        'tmp_clean': '/tmp/diff_csv_clean.csv',
+        'tmp': 'diff_csv.csv',
+        'tmp_clean': 'diff_csv_clean.csv',
         's3_key' : 'clean_csv/diff.csv',
     },
+    'quality': {
+        'tmp': 'quality.json',
+        's3_key' : 'clean_csv/latest_quality.json',
+    },
     'all': {
-        'tmp': '/tmp/all_csv.csv',
-        'tmp_clean': '/tmp/all_csv_clean.csv',
+        'tmp': 'all_csv.csv',
+        'tmp_clean': 'all_csv_clean.csv',
         's3_key' : 'clean_csv/all.csv',
     },
 }
+# Without context (local test) the raw csv is read from here
+LOCAL_RAW_CSV = '/tmp/current_csv.csv'
 
 
 # Bucket 
 bucket      = os.environ['BUCKET']
 
-# Initialize boto3-clients per container
+# SNS-topic for warnings about the csv
+CORRUPT_CSV_TOPIC_ARN = 'arn:aws:sns:eu-central-1:625469223576:Corrupt_Auction_CSV'
+# Number of previous quality reports that make up the baseline
+QUALITY_HISTORY = 14
+# Where the change events go (see lambda_common.event_sinks), 'none' for
+# nowhere
+CHANGE_EVENTS_SINK = os.environ.get('CHANGE_EVENTS_SINK') or \
+                     's3://%s/change_events/' % bucket
+# Diff against the previous export: 'hash' (yesterday in a dict), 'merge'
+# (both sorted on auc_id, see sorted_diff) or 'auto': merge from a raw
+# export of MERGE_DIFF_SIZE bytes
+DIFF_MODE       = os.environ.get('DIFF_MODE') or 'auto'
+MERGE_DIFF_SIZE = int(os.environ.get('MERGE_DIFF_SIZE', 256 * 1024 * 1024))
+# Clean a raw export of PARALLEL_SIZE bytes in chunks of CHUNK_SIZE over
+# CLEAN_WORKERS processes (default: one per CPU; 1 never in parallel)
+CLEAN_WORKERS   = int(os.environ.get('CLEAN_WORKERS') or chunked_csv.cpu_count())
+PARALLEL_SIZE   = int(os.environ.get('PARALLEL_SIZE', 32 * 1024 * 1024))
+CHUNK_SIZE      = 4 * 1024 * 1024
+# Their processes, per container: forked before any thread runs (see
+# start_workers)
+clean_workers   = chunked_csv.Workers(CLEAN_WORKERS)
+
+# boto3-clients per container (created on first use)
 region_name = 'eu-central-1'
-s3_client   = boto3.client('s3', config=Config(signature_version='s3v4'))
+s3_client   = aws_clients.lazy_client('s3', signature_version='s3v4')
 
 # Validation/clean function
 def format_quoted_field(val):
@@ -119,21 +174,31 @@ def trim_lower(val):
 def trim_title(val):
     return val.strip().title()
 
-def field_to_decimal(val):
-    """Convert a numeric field to a proper value
-       for 'Decimal'-type. (Replaces ',' by '.')
-       Returns 0 if empty.
+def field_to_cents(val):
+    """Convert a numeric field ('12,50') to integer cents (1250).
+       Returns None if empty (written as 0).
     """
-    return decimal.Decimal(val.replace(',', '.')) if val else decimal.Decimal(0.0)
+    return auction_record.to_cents(val)
+
+# pytz is imported (and the zone loaded) on first use
+_timezones = dict()
+
+def get_timezone(name):
+    try:
+        return _timezones[name]
+    except KeyError:
+        import pytz
+        _timezones[name] = pytz.timezone(name)
+        return _timezones[name]
 
-def datetime_to_utc(val):
+def datetime_to_epoch(val):
     """Convert a datetime à la "2017-01-12 17:23:29" in Europe/Brussels to
-       "2017-01-12T16:23:29Z" in UTC.
+       seconds since the epoch (written as "2017-01-12T16:23:29Z" in UTC).
     """
     if val:
         ts = datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
-        dt = pytz.timezone('Europe/Brussels').localize(ts)
-        return dt.astimezone(pytz.UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return auction_record.to_epoch(
+            get_timezone('Europe/Brussels').localize(ts))
     return None
 
 # TODO: add these to DDB-table for instance
@@ -143,36 +208,86 @@ DOMAIN_FILTER = [
 EMAIL_FILTER = [
     'alice@somedomain.com',
 ]
+# Clean function per kind of column (see lambda_common.auction_schema)
+CONVERTERS = {
+    'quoted'    : format_quoted_field,
+    'trim'      : trim,
+    'title'     : trim_title,
+    'email'     : clean_email,
+    'cents'     : field_to_cents,
+    'datetime'  : datetime_to_epoch,
+}
 HEADER_LIST = [
-    # Index, Original name,       Clean name, format fn, is_rel_field
+    # Index, Original name, Clean name, format fn, is_rel_field
+    (n, c.export, c.name, CONVERTERS[c.clean], c.relevant)
+    for n, c in enumerate(auction_schema.EXPORT_COLUMNS)
 ]
 #
 CLEAN_DICT = OrderedDict([(x[0], x[3]) for x in HEADER_LIST])
+CLEAN_ITEMS = list(CLEAN_DICT.items())
+# What the clean functions raise on a field that doesn't parse
+PARSE_ERRORS = (decimal.InvalidOperation, ValueError, OverflowError)
 
 # auc_id, pay_date, annul_date, collect_date
 RELFIELDS = [x[0] for x in HEADER_LIST if x[4]]
 
-def is_not_known(email):
-    try:
-        dom = email.split('@')[1]
-    except IndexError as e:
+# Header of the clean csv
+CLEAN_HEADER = list(auction_schema.CLEAN_HEADER)
+
+# A clean row: a tuple with the clean names as fields, amounts in cents and
+# dates in epoch seconds (see auction_record.py)
+COLUMN_KINDS = {field_to_cents: 'cents', datetime_to_epoch: 'epoch'}
+AuctionRecord = auction_record.record_type('AuctionRecord',
+    [(x[2], COLUMN_KINDS.get(x[3], 'string')) for x in HEADER_LIST][:-1])
+new_record = auction_record.record_maker(AuctionRecord)
+# Columns with few distinct values: one string object per value
+SHARED_COLUMNS = [1]                            # pa_title
+
+# Data profile: distinct values of, duplicates of and range of
+PROFILE_DISTINCT    = [0, 3, 15, 18]           # ogm, auc_id, clang_id, cust_email
+PROFILE_UNIQUE      = [0, 3]                   # ogm, auc_id
+PROFILE_MINMAX      = [x[0] for x in HEADER_LIST if x[3] in COLUMN_KINDS]
+
+# History (Parquet) columns: the clean csv's, with their types
+HISTORY_COLUMNS = [(x[2], 'decimal' if x[3] is field_to_cents else
+                          'timestamp' if x[3] is datetime_to_epoch else
+                          'string')
+                   for x in HEADER_LIST][:-1] + [('bid_is_suspicious', 'bool')]
+
+def new_data_profile(unique=True):
+    """Without `unique` the duplicates aren't counted (a chunk's)."""
+    return DataProfile([x[2] for x in HEADER_LIST],
+                       distinct=PROFILE_DISTINCT,
+                       unique=PROFILE_UNIQUE if unique else (),
+                       minmax=PROFILE_MINMAX,
+                       formats=dict((i, auction_record.TEXT[kind])
+                                    for i, kind in enumerate(AuctionRecord.kinds)
+                                    if i in PROFILE_MINMAX))
+
+def is_not_known(email_tuple):
+    """`email_tuple` as returned by `split_email(s)`. Addresses without '@'
+       are left out; one that doesn't parse otherwise (two '@'s, ...) is
+       kept unless it's filtered."""
+    email_cleaned, email_local, email_domain = email_tuple[:3]
+    if u'@' not in email_cleaned:
         return False
-    else:
-        if dom.lower() in DOMAIN_FILTER or email.lower() in EMAIL_FILTER:
-            return False
-        else:
-            return True
+    if email_domain in DOMAIN_FILTER or email_cleaned in EMAIL_FILTER:
+        return False
+    return True
 
 def bid_is_suspicious(row):
-    bid     = row[5]
-    cost    = row[7]
-    max_bid = 800
-    payed_or_cancelled = row[9] or row[12]
+    """`row`: an AuctionRecord (amounts in cents)."""
+    bid     = row.high_bid or 0
+    cost    = row.garant_price
+    max_bid = 800 * 100
+    payed_or_cancelled = row.pay_date or row.annul_date
     if not payed_or_cancelled:
         if cost:
             # TODO: find better formula
             #~ if (bid/cost) > 0.3*((int(bid)-int(cost))/(bid/cost)):
-            if (bid/cost) > 5 or bid > max_bid:
+            ratio = RATIO_CONTEXT.divide(decimal.Decimal(bid),
+                                         decimal.Decimal(cost))
+            if ratio > 5 or bid > max_bid:
                 return True
             return False
         else:
@@ -191,17 +306,29 @@ def add_in_element(lst, index):
     lst.insert(index, u'')
     return lst
 
-def csv_to_list_of_tuples(csvfile_path):
-    """Read in a csv file (from path) and return a list of tuples.
+def read_export(f):
+    """Read in a raw export (file object) and return a list of tuples.
        Header line is skipped."""
+    rdr = csv.reader(f, delimiter=';', quotechar='"')
+    # Skip header line
+    header = rdr.next()
+    return read_rows(rdr, has_suffix(header))
+
+def has_suffix(header):
+    """Older exports have no 'Klant Toevoeging' (inserted empty)."""
+    return 'Klant Toevoeging' in header
+
+def read_rows(rdr, suffix=True):
+    """The rows of csv reader `rdr` as a list of tuples."""
+    if suffix:
+        return list(map(tuple, rdr))
+    else:
+        return list(map(tuple, [add_in_element(r, 21) for r in rdr]))
+
+def csv_to_list_of_tuples(csvfile_path):
+    """`read_export` of a csv file (from path)."""
     with open(csvfile_path, 'rb') as f:
-        rdr = csv.reader(f, delimiter=';', quotechar='"')
-        # Skip header line
-        header = rdr.next()
-        if 'Klant Toevoeging' in header:
-            return list(map(tuple, rdr))
-        else:
-            return list(map(tuple, [add_in_element(r, 21) for r in rdr]))
+        return read_export(f)
 
 def find_bad_lines(lot):
     """Finds the "bad" lines in a csv line.
@@ -225,19 +352,103 @@ def remove_bad_lines(lot, bad_lines):
     correct_list = [i for j, i in enumerate(lot) if j not in bad_lines.keys()]
     return correct_list
 
-def clean_list_of_tuples(lot):
-    """Apply function to every element and drop last column (clang_error)."""
-    r = [tuple([func(row[n]) for n, func in CLEAN_DICT.iteritems()][:-1]) for row in lot]
+def find_parse_error(row):
+    """Index of the (first) field of `row` that doesn't clean."""
+    for n, func in CLEAN_ITEMS:
+        try:
+            func(row[n])
+        except PARSE_ERRORS:
+            return n
+
+def clean_list_of_tuples(lot, profile=None, skip=(), start=0):
+    """Apply function to every element and drop last column (clang_error):
+       a list of AuctionRecords. Rows with an index in `skip` (the bad lines) are left out, as are
+       rows with a field that doesn't parse. Every row is counted in
+       `profile` (a DataProfile), if given. `start`: the index of the
+       first row (of a chunk) in the file."""
+    r = list()
+    shared = dict()
+    for i, row in enumerate(lot, start):
+        if i in skip:
+            continue
+        try:
+            values = [func(row[n]) for n, func in CLEAN_ITEMS][:-1]
+        except PARSE_ERRORS:
+            clean_row = None
+            n = find_parse_error(row)
+            log.warn('Line %s: "%s" does not parse: %r.', i, HEADER_LIST[n][2], row[n])
+            if profile is not None:
+                profile.parse_error(i, n)
+        else:
+            for n in SHARED_COLUMNS:
+                values[n] = shared.setdefault(values[n], values[n])
+            clean_row = new_record(values)
+            r.append(clean_row)
+        if profile is not None:
+            profile.observe(row, clean_row)
     return r
 
 def filter_list_of_tuples(lot):
-    r = [row for row in lot if is_not_known(row[18])]
+    email_tuples = split_emails([row.cust_email for row in lot])
+    r = [row for row, email_tuple in zip(lot, email_tuples)
+         if is_not_known(email_tuple)]
     return r
 
+# Unique keys (index, name) and what decides between duplicates
+DEDUP_KEYS      = [(3, 'auc_id'), (0, 'ogm')]
+DEDUP_ORDER     = 8     # date_high_bid
+
+def dedup_list_of_tuples(lot, profile=None):
+    """Keep one row per auc_id and one per OGM (MySQL has both UNIQUE).
+       Rule: the row with the latest date_high_bid wins; on a tie (or
+       without dates) the last one in the file. Every dropped row is
+       reported to `profile`. The rows keep their order."""
+    # One hash pass: usually there are no duplicates at all
+    seen = [set() for _ in DEDUP_KEYS]
+    has_dups = False
+    for row in lot:
+        for (n, name), values in zip(DEDUP_KEYS, seen):
+            val = row[n]
+            if val:
+                if val in values:
+                    has_dups = True
+                    break
+                values.add(val)
+        if has_dups:
+            break
+    if not has_dups:
+        return lot
+    # Winners first, a row is kept if none of its keys is taken yet
+    order = sorted(range(len(lot)),
+                   key=lambda i: (lot[i][DEDUP_ORDER] or 0, i), reverse=True)
+    taken = [dict() for _ in DEDUP_KEYS]
+    keep = [False] * len(lot)
+    for i in order:
+        row = lot[i]
+        for (n, name), winners in zip(DEDUP_KEYS, taken):
+            val = row[n]
+            if val and val in winners:
+                kept = lot[winners[val]]
+                log.warn('Duplicate %s %s: keeping the row of %s, dropping the one of %s.',
+                         name, val, kept[DEDUP_ORDER], row[DEDUP_ORDER])
+                if profile is not None:
+                    profile.conflict(name, val, kept[DEDUP_ORDER], row[DEDUP_ORDER])
+                break
+        else:
+            keep[i] = True
+            for (n, name), winners in zip(DEDUP_KEYS, taken):
+                if row[n]:
+                    winners[row[n]] = i
+    return [row for row, k in zip(lot, keep) if k]
+
+def get_export_date(filename):
+    # Return the export's date (as object) from auctions-yyyy-mm-dd.csv
+    today_str = '-'.join(filename.split('.')[:-1][0].split('-')[1:4])
+    return datetime.strptime(today_str, '%Y-%m-%d')
+
 def get_yesterday(filename):
     # Return yesterday's date (as object) based on today's date
-    today_str = '-'.join(filename.split('.')[:-1][0].split('-')[1:4])
-    return datetime.strptime(today_str, '%Y-%m-%d') - timedelta(days=1)
+    return get_export_date(filename) - timedelta(days=1)
 
 def key_from_date(date_obj):
     """Generate S3-key for raw_csv"""
@@ -251,33 +462,144 @@ def get_diff_lot(set_diff, lot):
     """Return those tuples from `lot` (list of tuples) who's ID's are
        in `set_diff`.
        Return list of tuples as well."""
-    auc_ids = [x[0] for x in set_diff]
+    auc_ids = set([x[0] for x in set_diff])
     return [tup for tup in lot if tup[3] in auc_ids]
 
 def lot_to_csv_file(lot, file_path, quoting=csv.QUOTE_MINIMAL):
     with open(file_path, 'wb') as f:
         wrt = csv.writer(f, delimiter=',', quotechar='"', quoting=quoting)
         # Write header
-        header_list_clean = [x[2] for x in HEADER_LIST][:-1]
-        header_list_clean.append('bid_is_suspicious')
-        wrt.writerow(header_list_clean)
+        wrt.writerow(CLEAN_HEADER)
         for line in lot:
-            l = list(line)
-            l.append(bid_is_suspicious(line))
-            wrt.writerow(tuple(l))
+            wrt.writerow(line.text() + (bid_is_suspicious(line), ))
 
 def send_bad_lines_warning(filename, bad_lines):
     """Send out a warning about this csv-file with a summary of the bad
        lines found."""
     msg = '\n'.join([':'.join([str(k), ','.join([f for f in v])]) for k, v in bad_lines.items()])
-    client = boto3.client('sns')
-    response = client.publish(
-        TopicArn    = 'arn:aws:sns:eu-central-1:625469223576:Corrupt_Auction_CSV',
-        Subject     = 'OPGELET: corrupte csv: %s corrupte lijnen in %s.' % (len(bad_lines), filename),
-        Message     = msg,
-    )
+    alerts.send(CORRUPT_CSV_TOPIC_ARN,
+                'OPGELET: corrupte csv: %s corrupte lijnen in %s.' % (len(bad_lines), filename),
+                msg)
     log.warn('%s bad lines found in csv "%s".' % (len(bad_lines), filename))
-    log.info('Warning sent out via email.')
+    log.info('Warning queued.')
+
+def send_quality_warning(filename, drifted):
+    """Send out a warning about the metrics of this csv-file that drifted
+       from their baseline."""
+    msg = '\n'.join(['%s: %s (baseline %s, allowed deviation %s)' % d
+                     for d in drifted])
+    alerts.send(CORRUPT_CSV_TOPIC_ARN,
+                'OPGELET: afwijkende csv: %s metrics in %s.' % (len(drifted), filename),
+                msg)
+    log.warn('%s quality metrics drifted in csv "%s".' % (len(drifted), filename))
+
+def clean_csv_rows(f):
+    """Rows of a clean csv (file object, header skipped), one at a time."""
+    rdr = csv.reader(f, delimiter=',', quotechar='"')
+    next(rdr, None)
+    for row in rdr:
+        yield row
+
+def use_merge_diff(size):
+    """Merge diff for a raw export of `size` bytes (None: unknown)?"""
+    if DIFF_MODE == 'auto':
+        return size is not None and size >= MERGE_DIFF_SIZE
+    return DIFF_MODE == 'merge'
+
+def start_workers():
+    """Fork the clean workers, first thing in a handler: later on there
+       are threads (alerts, boto3, s3_reader), forking then isn't safe."""
+    if CLEAN_WORKERS > 1:
+        clean_workers.start()
+
+def use_parallel(size):
+    """Clean a raw export of `size` bytes (None: unknown) in chunks?"""
+    return CLEAN_WORKERS > 1 and size is not None and size >= PARALLEL_SIZE
+
+def auc_id_key(row):
+    """Sort key of the merge diff, of clean csv rows and of a lot."""
+    return as_text(row[3])
+
+def send_change_events(filename, lot, previous_rows, merge=False):
+    """Send out the change events of `lot` (AuctionRecords) against
+       `previous_rows` (the rows of the previous clean csv). With `merge`
+       both are sorted on auc_id (see sorted_diff). Returns the number of
+       events."""
+    day = get_export_date(filename)
+    detector = ChangeDetector(CLEAN_HEADER, day)
+    # Compared as text, as yesterday's rows are
+    lot = (row.text() for row in lot)
+    if merge:
+        changes = detector.merged_events(previous_rows, lot)
+    else:
+        detector.load_previous(previous_rows)
+        changes = detector.events(lot)
+    sink = event_sinks.from_url(CHANGE_EVENTS_SINK, partition_key='auc_id')
+    count = sink.put(changes, prefix='dt=%s/' % day.strftime('%Y-%m-%d'))
+    log.info('%s change events sent to %s.', count, CHANGE_EVENTS_SINK)
+    return count
+
+def publish_change_events(bucket, key, filename, lot, scr, merge=False):
+    """`send_change_events` against the clean csv `key` of the previous
+       export (see previous_export), read through Scratch `scr`. With
+       `merge`, `lot` is sorted on auc_id and the previous csv is sorted
+       too unless it was written that way."""
+    if key is None:
+        log.info('No previous export: no change events.')
+        return 0
+    try:
+        res = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        log.info('No previous export: no change events.')
+        return 0
+    with scr.spooled(res.get('ContentLength')) as f:
+        for chunk in iter(lambda: res['Body'].read(1024 * 1024), b''):
+            f.write(chunk)
+        f.seek(0)
+        previous_rows = clean_csv_rows(f)
+        if merge:
+            if sorted_diff.is_sorted(clean_csv_rows(f), auc_id_key):
+                f.seek(0)
+            else:
+                f.seek(0)
+                previous_rows = sorted_diff.external_sort(previous_rows,
+                                                          auc_id_key, scr)
+        return send_change_events(filename, lot, previous_rows, merge)
+
+def get_quality_history(bucket):
+    """Metrics of the previous exports, from the last quality report."""
+    try:
+        res = s3_client.get_object(Bucket=bucket,
+                                   Key=tmp_names['quality']['s3_key'])
+    except s3_client.exceptions.NoSuchKey:
+        return []
+    return json.loads(res['Body'].read()).get('history', [])
+
+def publish_quality_report(bucket, filename, profile):
+    """Save the quality report of `profile` next to latest.csv and warn
+       about the metrics that drifted from the trailing baseline."""
+    # A re-run of the same export isn't part of its own baseline
+    history = [h for h in get_quality_history(bucket)
+               if h.get('export') != filename]
+    today = profile.metrics()
+    drifted = drift(today, [h['metrics'] for h in history])
+    history.append(OrderedDict([('export', filename), ('metrics', today)]))
+    report = OrderedDict([
+        ('export',  filename),
+        ('created', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('profile', profile.report()),
+        ('metrics', today),
+        ('drift',   drifted),
+        ('history', history[-QUALITY_HISTORY:]),
+    ])
+    s3_client.put_object(Bucket=bucket,
+                         Key=tmp_names['quality']['s3_key'],
+                         Body=json.dumps(report, indent=1),
+                         ContentType='application/json',
+                         ACL='private')
+    if drifted:
+        send_quality_warning(filename, drifted)
+    return report
     
 def add_object_to_S3(file_path, key, bucket, tag_dict={}, compressed=False):
     func_params = {
@@ -300,6 +622,31 @@ def add_object_to_S3(file_path, key, bucket, tag_dict={}, compressed=False):
     func_params['Body'] = data
     return s3_client.put_object(**func_params)
 
+def object_tags(key, bucket):
+    """The tags of `key` as a dict, None if there's no such object."""
+    try:
+        res = s3_client.get_object_tagging(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return dict((tag['Key'], tag['Value']) for tag in res.get('TagSet', []))
+
+def previous_export(bucket, filename):
+    """(S3-key of the clean csv of the export before `filename`, or None,
+       whether latest.csv still has to be rotated). A retry of `filename`
+       may find latest.csv rotated already (and missing), or even
+       uploaded: then the previous export is yesterday.csv, and rotating
+       again would lose it."""
+    latest = tmp_names['today']['s3_key']
+    yesterday = tmp_names['yesterday']['s3_key']
+    tags = object_tags(latest, bucket)
+    if tags is not None and tags.get('raw_object') != filename:
+        return latest, True
+    if tags is not None:
+        log.info('%s is %s already: not rotated again.', latest, filename)
+    if object_tags(yesterday, bucket) is None:
+        return None, False
+    return yesterday, False
+
 def change_object_key(from_key, to_key, bucket):
     func_params = {
         'Bucket'        : bucket,
@@ -316,49 +663,229 @@ def change_object_key(from_key, to_key, bucket):
     return s3_client.delete_object(**func_params)
     
     
-def lambda_handler(event, context):
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key'].encode('utf8'))
+def clean_export(bucket, key, context, size=None, etag=None):
+    """Clean the raw export s3://`bucket`/`key` (`size` bytes and `etag`,
+       if known).
+       Without `context` (local test) nothing is downloaded nor uploaded.
+       The files go to a scratch directory of the export."""
+    with scratch.task('clean_auction_csv') as scr:
+        _clean_export(scr, bucket, key, context, size, etag)
+
+def _clean_export(scr, bucket, key, context, size, etag=None):
     log.info('Handling key "%s" in bucket "%s".', key, bucket)
     filename = key.split('/')[-1:][0]
-    # Get today's file (raw)
+    # Room for the clean csv (about as big as the raw one)
+    scr.reserve(size)
+    clean_path = scr.path(tmp_names['today']['tmp_clean'])
+    if use_parallel(size if context else os.path.getsize(LOCAL_RAW_CSV)):
+        # The raw bytes, split up and parsed by the workers
+        if context:
+            log.info('Get %s from %s.', key, bucket)
+            with metrics.timer('download'):
+                data = s3_reader.download_buffer(s3_client, bucket, key, size,
+                                                 etag=etag)
+        else:
+            log.debug('No context: local test, no file downloaded.')
+            with open(LOCAL_RAW_CSV, 'rb') as f:
+                data = f.read()
+        filter_lot, profile = clean_rows_parallel(data, filename)
+        del data
+    else:
+        # Get today's file (raw): parsed while the rest is being downloaded
+        if context:
+            log.info('Get %s from %s.', key, bucket)
+            with metrics.timer('download_parse'):
+                with s3_reader.open_stream(s3_client, bucket, key, size,
+                                           etag=etag) as f:
+                    lot = read_export(f)
+        else:
+            log.debug('No context: local test, no file downloaded.')
+            with metrics.timer('parse'):
+                lot = csv_to_list_of_tuples(LOCAL_RAW_CSV)
+        filter_lot, profile = clean_rows(lot, filename)
+        del lot
+    merge = use_merge_diff(size)
+    if merge:
+        # Written sorted, tomorrow's diff doesn't have to sort it
+        with metrics.timer('sort'):
+            filter_lot.sort(key=auc_id_key)
     if context:
-        log.info('Get %s from %s.', key, bucket)
-        with open(tmp_names['today']['tmp'], 'wb') as f:
-            s3_client.download_fileobj(bucket, key, f)
+        with metrics.timer('quality'):
+            try:
+                publish_quality_report(bucket, filename, profile)
+            except Exception as e:
+                # The report is no reason to stop the export
+                log.exception('Quality report failed: %s', e)
     else:
-        log.debug('No context: local test, no file downloaded.')
-    lot = csv_to_list_of_tuples(tmp_names['today']['tmp'])
-    bad_lines = find_bad_lines(lot)
+        log.debug('No context: local test, no quality report: %s',
+                  json.dumps(profile.metrics()))
+    # latest.csv, unless this is a retry after it was rotated
+    previous, rotate = (previous_export(bucket, filename) if context
+                        else (None, False))
+    # Change events against the previous export
+    if context and CHANGE_EVENTS_SINK != 'none':
+        with metrics.timer('events'):
+            try:
+                count = publish_change_events(bucket, previous, filename,
+                                              filter_lot, scr, merge)
+                metrics.count('ChangeEvents', count, stage='events')
+            except Exception as e:
+                # The events are extra: no reason to stop the export
+                log.exception('Change events failed: %s', e)
+    rotate_and_upload(bucket, filename, filter_lot, clean_path, context,
+                      rotate)
+    if context and clean_history.is_available():
+        add_to_history(bucket, filename, filter_lot, scr)
+
+def clean_rows(lot, filename):
+    """Clean, filter and deduplicate the rows of raw export `filename`.
+       Returns the rows and their DataProfile."""
+    with metrics.timer('parse'):
+        bad_lines = find_bad_lines(lot)
+    metrics.count('Rows', len(lot), stage='parse')
+    metrics.count('BadLines', len(bad_lines), stage='parse')
     if bad_lines:
         send_bad_lines_warning(filename, bad_lines)
-        lot = remove_bad_lines(lot, bad_lines)
-    clean_lot = clean_list_of_tuples(lot)
+    profile = new_data_profile()
+    profile.bad_lines = len(bad_lines)
+    with metrics.timer('clean'):
+        clean_lot = clean_list_of_tuples(lot, profile, skip=bad_lines)
     log.debug('Cleaned list: %s elements', len(clean_lot))
-    filter_lot = filter_list_of_tuples(clean_lot)
+    metrics.count('DroppedRows', profile.dropped, stage='clean')
+    with metrics.timer('filter'):
+        filter_lot = filter_list_of_tuples(clean_lot)
+        filter_lot = dedup_list_of_tuples(filter_lot, profile)
     log.debug('Filtered list: %s elements (diff=%s)', len(filter_lot), len(clean_lot)-len(filter_lot))
+    metrics.count('Rows', len(filter_lot), stage='filter')
+    metrics.count('DuplicateKeys', profile.conflicts, stage='filter')
+    return filter_lot, profile
+
+def clean_chunk(suffix, row_length, data, chunk):
+    """Worker: read, clean and filter the rows of `chunk` (a Chunk of raw
+       export `data`). Returns (bad lines, clean rows as plain tuples,
+       whether each one passes the filter, DataProfile without the
+       duplicates). Indices are those of the whole file."""
+    rdr = csv.reader(io.BytesIO(data[chunk.begin:chunk.end]),
+                     delimiter=';', quotechar='"')
+    lot = read_rows(rdr, suffix)
+    bad_lines = dict((i, row) for i, row in enumerate(lot, chunk.first_index)
+                     if len(row) != row_length)
+    profile = new_data_profile(unique=False)
+    profile.bad_lines = len(bad_lines)
+    clean_lot = clean_list_of_tuples(lot, profile, skip=bad_lines,
+                                     start=chunk.first_index)
+    keep = [is_not_known(t) for t in
+            split_emails([row.cust_email for row in clean_lot])]
+    return bad_lines, [tuple(row) for row in clean_lot], keep, profile
+
+def clean_rows_parallel(data, filename, workers=None):
+    """`clean_rows` of raw export `data` (bytes): the chunks are cleaned
+       and filtered by `workers` processes (default CLEAN_WORKERS), the
+       duplicates are counted and removed here, in the order of the file."""
+    header_end = chunked_csv.next_record(data, 0, delimiter=b';')
+    first_end = chunked_csv.next_record(data, header_end, delimiter=b';')
+    rdr = csv.reader(io.BytesIO(data[:first_end]), delimiter=';', quotechar='"')
+    header = rdr.next()
+    suffix = has_suffix(header)
+    first = read_rows(rdr, suffix)
+    if not first:
+        return clean_rows(first, filename)
+    # As find_bad_lines: the first line has the correct length
+    row_length = len(first[0])
+    chunks = chunked_csv.split_records(data, header_end, CHUNK_SIZE, b';')
+    workers = min(workers or CLEAN_WORKERS, len(chunks))
+    log.info('Cleaning %s chunks in %s processes.', len(chunks), workers)
+    profile = new_data_profile()
+    bad_lines = dict()
+    clean_count = 0
+    filter_lot = list()
+    shared = dict()
+    with metrics.timer('clean'):
+        for chunk_bad, rows, keep, chunk_profile in chunked_csv.map_chunks(
+                functools.partial(clean_chunk, suffix, row_length),
+                data, chunks, workers, clean_workers):
+            bad_lines.update(chunk_bad)
+            profile.merge(chunk_profile)
+            clean_count += len(rows)
+            for values, k in zip(rows, keep):
+                values = list(values)
+                for n in SHARED_COLUMNS:
+                    values[n] = shared.setdefault(values[n], values[n])
+                row = new_record(values)
+                profile.observe_unique(row)
+                if k:
+                    filter_lot.append(row)
+    metrics.count('Rows', profile.rows + len(bad_lines), stage='parse')
+    metrics.count('BadLines', len(bad_lines), stage='parse')
+    if bad_lines:
+        log.warn('%s bad_lines lines found.' % len(bad_lines))
+        send_bad_lines_warning(filename, bad_lines)
+    log.debug('Cleaned list: %s elements', clean_count)
+    metrics.count('DroppedRows', profile.dropped, stage='clean')
+    with metrics.timer('filter'):
+        filter_lot = dedup_list_of_tuples(filter_lot, profile)
+    log.debug('Filtered list: %s elements (diff=%s)', len(filter_lot), clean_count-len(filter_lot))
+    metrics.count('Rows', len(filter_lot), stage='filter')
+    metrics.count('DuplicateKeys', profile.conflicts, stage='filter')
+    return filter_lot, profile
+
+def rotate_and_upload(bucket, filename, filter_lot, clean_path, context,
+                      rotate=True):
+    """latest.csv -> yesterday.csv (unless not `rotate`: see
+       previous_export), and `filter_lot` (via file `clean_path`) as the
+       new latest.csv."""
     # Change latest.csv on S3 to yesterday.csv
     # TODO: we could also solve this through object-versioning
-    log.info('Changing "%s" to "%s" on S3-bucket "%s".',
-                tmp_names['today']['s3_key'],
-                tmp_names['yesterday']['s3_key'],
-                bucket)
-    res = change_object_key(from_key=tmp_names['today']['s3_key'],
-                            to_key=tmp_names['yesterday']['s3_key'],
-                            bucket=bucket)
+    if rotate:
+        log.info('Changing "%s" to "%s" on S3-bucket "%s".',
+                    tmp_names['today']['s3_key'],
+                    tmp_names['yesterday']['s3_key'],
+                    bucket)
+        with metrics.timer('rotate'):
+            res = change_object_key(from_key=tmp_names['today']['s3_key'],
+                                    to_key=tmp_names['yesterday']['s3_key'],
+                                    bucket=bucket)
     # Current CSV to S3
-    log.info('Save to tmp file: %s.', tmp_names['today']['tmp_clean'])
-    lot_to_csv_file(filter_lot, tmp_names['today']['tmp_clean'])
+    log.info('Save to tmp file: %s.', clean_path)
+    with metrics.timer('write'):
+        lot_to_csv_file(filter_lot, clean_path)
     log.info('Save %s to S3.', tmp_names['today']['s3_key'])
     if context:
-        res = add_object_to_S3(tmp_names['today']['tmp_clean'],
-                               tmp_names['today']['s3_key'],
-                               bucket,
-                               tag_dict={'raw_object': filename})
+        with metrics.timer('upload'):
+            res = add_object_to_S3(clean_path,
+                                   tmp_names['today']['s3_key'],
+                                   bucket,
+                                   tag_dict={'raw_object': filename})
         log.debug(res)
     else:
         log.debug('No context: local test, no file uploaded.')
 
+def add_to_history(bucket, filename, filter_lot, scr):
+    """Add `filter_lot` to the Parquet history (errors are logged)."""
+    with metrics.timer('history'):
+        try:
+            clean_history.append_day(s3_client, bucket,
+                get_export_date(filename),
+                [row.text() + (bid_is_suspicious(row), ) for row in filter_lot],
+                HISTORY_COLUMNS, scr.path('history.parquet'),
+                export=filename)
+        except Exception as e:
+            # The history is an extra copy: no reason to stop the export
+            log.exception('Adding to the history failed: %s', e)
+
+@metrics.instrumented
+@alerts.instrumented
+def lambda_handler(event, context):
+    start_workers()
+    # S3, SNS(S3), SQS(S3) or EventBridge: every record
+    for obj in events.iter_s3_objects(event):
+        # A second delivery would send the change events again (a retry
+        # after a failure must: see previous_export)
+        with idempotency.once_object('clean_auction_csv', obj) as first:
+            if first:
+                clean_export(obj.bucket, obj.key, context, obj.size,
+                             obj.etag)
+
 def main():
     from mock_event import event
     lambda_handler(event, True)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  clean_history.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  History of the clean exports as a date-partitioned Parquet dataset:
+#
+#   clean_history/dt=YYYY-MM-DD/part-00000.parquet
+#   clean_history/_manifest.json
+#
+#  - one partition per export date: a re-run overwrites its own day
+#  - rows are sorted by partner (pa_title) and written in row groups of
+#    ROW_GROUP_SIZE rows, so readers can skip row groups on partner
+#    (min/max statistics) as well as partitions on date (the path)
+#  - the manifest lists every partition with its rows, size and partners,
+#    so a reader can prune files before opening any of them
+#
+#  Needs pyarrow (imported on first use), 0.16.0 on python2.7: the layer
+#  of requirements-history.txt. Without it nothing is written, with a
+#  warning (once per container) unless CLEAN_HISTORY=0.
+#  See history_query.py to query the dataset (DuckDB).
+#
+###############################################################################
+
+import os
+import json
+import logging
+import decimal
+from datetime import datetime
+from collections import OrderedDict
+
+from lambda_common import auction_schema
+
+log = logging.getLogger(__name__)
+
+PREFIX          = 'clean_history'
+MANIFEST_KEY    = PREFIX + '/_manifest.json'
+PART_NAME       = 'part-00000.parquet'
+ROW_GROUP_SIZE  = 10000
+PARTNER_COLUMN  = 'pa_title'
+
+# Amounts as in AuctionsRaw (auction_schema.AMOUNT). Own context: the
+# cleaner sets a precision of 2.
+PRECISION, SCALE = auction_schema.decimal_digits(auction_schema.AMOUNT)
+CENTS           = decimal.Decimal(1).scaleb(-SCALE)
+CENTS_CONTEXT   = decimal.Context(prec=18)
+
+
+_warned = list()
+
+def is_available():
+    if os.environ.get('CLEAN_HISTORY', '1') == '0':
+        return False
+    try:
+        import pyarrow
+    except ImportError:
+        if not _warned:
+            _warned.append(True)
+            log.warning('No pyarrow: nothing added to the history. Add the '
+                        'layer of requirements-history.txt, or set '
+                        'CLEAN_HISTORY=0.')
+        return False
+    return True
+
+def partition_key(day):
+    """S3 key of the partition of `day` (a date)."""
+    return '%s/dt=%s/%s' % (PREFIX, day.strftime('%Y-%m-%d'), PART_NAME)
+
+def _to_decimal(val):
+    if val is None or val == '':
+        return None
+    return decimal.Decimal(val).quantize(CENTS, context=CENTS_CONTEXT)
+
+def _to_timestamp(val):
+    # "2017-01-12T16:23:29Z" (UTC) as in the clean csv
+    return datetime.strptime(val, '%Y-%m-%dT%H:%M:%SZ') if val else None
+
+def _to_string(val):
+    return val if val != '' else None
+
+CONVERTERS = {
+    'string'    : _to_string,
+    'decimal'   : _to_decimal,
+    'timestamp' : _to_timestamp,
+    'bool'      : bool,
+}
+
+def arrow_schema(columns):
+    """`columns`: list of (name, type) with type one of CONVERTERS."""
+    import pyarrow as pa
+    types = {
+        'string'    : pa.string(),
+        'decimal'   : pa.decimal128(PRECISION, SCALE),
+        'timestamp' : pa.timestamp('s', tz='UTC'),
+        'bool'      : pa.bool_(),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+def write_parquet(lot, columns, file_path):
+    """Write `lot` (list of tuples, in the order of `columns`) to a
+       Parquet file, sorted by partner. Returns the partners."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    names = [name for name, kind in columns]
+    partner_idx = names.index(PARTNER_COLUMN)
+    lot = sorted(lot, key=lambda row: row[partner_idx] or '')
+    arrays = list()
+    schema = arrow_schema(columns)
+    for n, (name, kind) in enumerate(columns):
+        convert = CONVERTERS[kind]
+        arrays.append(pa.array([convert(row[n]) for row in lot],
+                               type=schema.field(name).type))
+    table = pa.Table.from_arrays(arrays, schema=schema)
+    pq.write_table(table, file_path, row_group_size=ROW_GROUP_SIZE,
+                   compression='snappy')
+    return sorted(set(row[partner_idx] for row in lot if row[partner_idx]))
+
+def get_manifest(s3_client, bucket):
+    try:
+        res = s3_client.get_object(Bucket=bucket, Key=MANIFEST_KEY)
+    except s3_client.exceptions.NoSuchKey:
+        return OrderedDict([('version', 1), ('partitions', OrderedDict())])
+    return json.loads(res['Body'].read(), object_pairs_hook=OrderedDict)
+
+def append_day(s3_client, bucket, day, lot, columns, tmp_path, export=None):
+    """Write `lot` as the partition of `day` (through file `tmp_path`) and
+       update the manifest. Returns the manifest entry of the partition."""
+    partners = write_parquet(lot, columns, tmp_path)
+    key = partition_key(day)
+    with open(tmp_path, 'rb') as f:
+        s3_client.upload_fileobj(f, bucket, key)
+    manifest = get_manifest(s3_client, bucket)
+    partitions = manifest['partitions']
+    dt = day.strftime('%Y-%m-%d')
+    partitions[dt] = OrderedDict([
+        ('key',         key),
+        ('rows',        len(lot)),
+        ('bytes',       os.path.getsize(tmp_path)),
+        ('partners',    partners),
+        ('export',      export),
+        ('created',     datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+    ])
+    manifest['partitions'] = OrderedDict(sorted(partitions.items()))
+    s3_client.put_object(Bucket=bucket, Key=MANIFEST_KEY,
+                         Body=json.dumps(manifest, indent=1),
+                         ContentType='application/json',
+                         ACL='private')
+    log.info('%s rows added to the history as %s.', len(lot), key)
+    return partitions[dt]
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
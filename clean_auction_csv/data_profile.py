@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  data_profile.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Data quality profile of one export, built in the same pass as the
+#  cleaning and in a fixed amount of memory (whatever the number of rows):
+#
+#   - per column: empty values, parse failures (decimals, dates)
+#   - min/max of the numeric and date columns
+#   - distinct values (HyperLogLog) and duplicates (Bloom filter) of the
+#     identifying columns (auc_id, ogm, ...)
+#
+#  Duplicate keys that were resolved (see `conflict()`) are reported too.
+#
+#  `drift()` compares today's metrics with the trailing baseline (the
+#  metrics of the previous reports) and returns those that moved too far.
+#
+###############################################################################
+
+import math
+import decimal
+from collections import OrderedDict
+# Own
+from lambda_common.bloom import BloomFilter
+from lambda_common.hyperloglog import HyperLogLog
+
+# Distinct values: HyperLogLog of 2^HLL_P bytes per column (0.8% error)
+HLL_P           = 14
+# Duplicates: Bloom filters sized for this many rows. Beyond that the
+# duplicates count gets (slowly) too high.
+DUP_CAPACITY    = 1000000
+DUP_ERROR_RATE  = 0.001
+# Row indices of dropped (unparsable) rows kept in the report
+MAX_EXAMPLES    = 50
+
+# Drift: needs at least MIN_HISTORY previous reports, a metric drifts when
+# it is more than DRIFT_SIGMAS standard deviations (plus a tolerance) away
+# from the trailing mean
+MIN_HISTORY     = 3
+DRIFT_SIGMAS    = 3.0
+RATE_TOLERANCE  = 0.01      # absolute, for *_rate metrics
+COUNT_TOLERANCE = 0.10      # relative to the mean, for counts
+
+
+class DataProfile(object):
+    """Counters of one export. `names` are the column names; `distinct`,
+       `unique` and `minmax` are the column indices to estimate distinct
+       values of, to count duplicates of and to keep the range of.
+       `formats`: {index: function} that gives the text of a min/max."""
+
+    def __init__(self, names, distinct=(), unique=(), minmax=(),
+                 dup_capacity=DUP_CAPACITY, formats=None):
+        self.names      = list(names)
+        self.rows       = 0
+        self.bad_lines  = 0
+        self.dropped    = 0
+        self.examples   = list()
+        self.nulls      = [0] * len(self.names)
+        self.errors     = [0] * len(self.names)
+        self.hlls       = [(i, HyperLogLog(HLL_P)) for i in distinct]
+        self.blooms     = [(i, BloomFilter(dup_capacity, DUP_ERROR_RATE))
+                           for i in unique]
+        self.duplicates = dict((i, 0) for i in unique)
+        self.ranges     = [(i, [None, None]) for i in minmax]
+        self.formats    = formats or dict()
+        self.conflicts  = 0
+        self.conflict_examples = list()
+
+    def observe(self, raw, clean):
+        """Count one (raw) row and its cleaned version (None if the row
+           could not be cleaned)."""
+        self.rows += 1
+        nulls = self.nulls
+        for i, val in enumerate(raw):
+            if not val:
+                nulls[i] += 1
+        if clean is None:
+            return
+        for i, hll in self.hlls:
+            if clean[i]:
+                hll.add(clean[i])
+        self.observe_unique(clean)
+        for i, rng in self.ranges:
+            val = clean[i]
+            if val is None or val == '':
+                continue
+            if rng[0] is None or val < rng[0]:
+                rng[0] = val
+            if rng[1] is None or val > rng[1]:
+                rng[1] = val
+
+    def observe_unique(self, clean):
+        """Count the duplicates of one cleaned row (done by `observe`)."""
+        for i, bloom in self.blooms:
+            val = clean[i]
+            if val:
+                if val in bloom:
+                    self.duplicates[i] += 1
+                else:
+                    bloom.add(val)
+
+    def merge(self, other):
+        """Add the counters of `other`, the profile of the rows that come
+           after these (of the same columns). Duplicates aren't merged:
+           count them with `observe_unique`, in order."""
+        self.rows       += other.rows
+        self.bad_lines  += other.bad_lines
+        self.dropped    += other.dropped
+        self.conflicts  += other.conflicts
+        self.examples   = (self.examples + other.examples)[:MAX_EXAMPLES]
+        self.conflict_examples = (self.conflict_examples +
+                                  other.conflict_examples)[:MAX_EXAMPLES]
+        for counts, others in ((self.nulls, other.nulls),
+                               (self.errors, other.errors)):
+            for i, n in enumerate(others):
+                counts[i] += n
+        for (i, hll), (_, other_hll) in zip(self.hlls, other.hlls):
+            hll.merge(other_hll)
+        for (i, rng), (_, other_rng) in zip(self.ranges, other.ranges):
+            low, high = other_rng
+            if low is not None and (rng[0] is None or low < rng[0]):
+                rng[0] = low
+            if high is not None and (rng[1] is None or high > rng[1]):
+                rng[1] = high
+
+    def parse_error(self, index, column):
+        """Row `index` (of the raw file) could not be cleaned: `column`
+           did not parse."""
+        self.errors[column] += 1
+        self.dropped += 1
+        if len(self.examples) < MAX_EXAMPLES:
+            self.examples.append((index, self.names[column]))
+
+    def conflict(self, key, value, kept, dropped):
+        """Rows `kept` and `dropped` had the same `value` for `key`."""
+        self.conflicts += 1
+        if len(self.conflict_examples) < MAX_EXAMPLES:
+            self.conflict_examples.append(OrderedDict([
+                ('key', key), ('value', value),
+                ('kept', kept), ('dropped', dropped)]))
+
+    def _rate(self, n):
+        return round(n / float(self.rows), 6) if self.rows else 0.0
+
+    def metrics(self):
+        """Flat {metric: value} of what is compared with the baseline."""
+        m = OrderedDict()
+        m['rows']           = self.rows
+        m['bad_line_rate']  = self._rate(self.bad_lines)
+        m['dropped_rate']   = self._rate(self.dropped)
+        m['conflict_rate']  = self._rate(self.conflicts)
+        for i, name in enumerate(self.names):
+            m['null_rate.' + name] = self._rate(self.nulls[i])
+            if self.errors[i]:
+                m['error_rate.' + name] = self._rate(self.errors[i])
+        for i, dups in sorted(self.duplicates.items()):
+            m['duplicate_rate.' + self.names[i]] = self._rate(dups)
+        return m
+
+    def report(self):
+        """The whole profile (JSON-serializable)."""
+        columns = OrderedDict()
+        ranges = dict(self.ranges)
+        hlls = dict(self.hlls)
+        for i, name in enumerate(self.names):
+            col = OrderedDict([
+                ('nulls',           self.nulls[i]),
+                ('parse_errors',    self.errors[i]),
+            ])
+            if i in hlls:
+                col['distinct'] = hlls[i].count()
+            if i in self.duplicates:
+                col['duplicates'] = self.duplicates[i]
+            if i in ranges:
+                fmt = self.formats.get(i)
+                col['min'], col['max'] = [
+                    fmt(v) if fmt and v is not None else
+                    str(v) if isinstance(v, decimal.Decimal) else v
+                    for v in ranges[i]]
+            columns[name] = col
+        return OrderedDict([
+            ('rows',            self.rows),
+            ('bad_lines',       self.bad_lines),
+            ('dropped',         self.dropped),
+            ('dropped_examples', self.examples),
+            ('conflicts',       self.conflicts),
+            ('conflict_examples', self.conflict_examples),
+            ('columns',         columns),
+        ])
+
+
+def drift(metrics, history, sigmas=DRIFT_SIGMAS):
+    """Compare `metrics` (dict) with `history` (list of the metrics of
+       previous reports). Returns a list of (metric, value, baseline mean,
+       allowed deviation) for every metric that drifted."""
+    if len(history) < MIN_HISTORY:
+        return []
+    drifted = list()
+    for name, value in metrics.items():
+        values = [h.get(name, 0) for h in history]
+        mean = sum(values) / float(len(values))
+        std = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+        if name.endswith('rate') or '_rate.' in name:
+            tolerance = RATE_TOLERANCE
+        else:
+            tolerance = COUNT_TOLERANCE * abs(mean)
+        allowed = sigmas * std + tolerance
+        if abs(value - mean) > allowed:
+            drifted.append((name, value, round(mean, 6), round(allowed, 6)))
+    return drifted
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  history_query.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Query the clean history (see clean_history.py) with DuckDB, locally:
+#
+#   $ python history_query.py s3://bdm-auction-exports \
+#       "SELECT pa_title, count(*), sum(high_bid) FROM clean_history
+#        GROUP BY 1 ORDER BY 3 DESC" --start 2017-05-01 --end 2017-05-31
+#
+#  The root is the bucket (s3://..., needs DuckDB's httpfs and AWS
+#  credentials in the environment) or a local copy of it. Date and partner
+#  filters are applied to the manifest first: only the files that can
+#  match are given to DuckDB, which then skips the row groups on partner
+#  with the Parquet statistics.
+#
+#  Needs duckdb (pip install duckdb). Not part of the λ deployment.
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+
+from clean_history import MANIFEST_KEY, PARTNER_COLUMN
+
+
+def _is_s3(root):
+    return root.startswith('s3://')
+
+def _join(root, key):
+    if _is_s3(root):
+        return root.rstrip('/') + '/' + key
+    return os.path.join(root, *key.split('/'))
+
+def read_manifest(root):
+    if _is_s3(root):
+        from lambda_common import aws_clients
+        bucket = root[len('s3://'):].strip('/').split('/')[0]
+        res = aws_clients.get_client('s3').get_object(Bucket=bucket,
+                                                      Key=MANIFEST_KEY)
+        return json.loads(res['Body'].read())
+    with open(_join(root, MANIFEST_KEY)) as f:
+        return json.load(f)
+
+def partition_files(root, start=None, end=None, partners=None):
+    """The files of the partitions between `start` and `end` (yyyy-mm-dd,
+       inclusive) that have rows of one of `partners`."""
+    files = list()
+    for dt, part in sorted(read_manifest(root)['partitions'].items()):
+        if start and dt < start or end and dt > end:
+            continue
+        if partners and not set(partners) & set(part['partners']):
+            continue
+        files.append(_join(root, part['key']))
+    return files
+
+def _quote(val):
+    return "'" + val.replace("'", "''") + "'"
+
+def connect(root, start=None, end=None, partners=None):
+    """A DuckDB connection with a view `clean_history` on the matching
+       partitions (with a `dt` column from the path)."""
+    import duckdb
+    con = duckdb.connect()
+    if _is_s3(root):
+        con.execute('INSTALL httpfs')
+        con.execute('LOAD httpfs')
+    files = partition_files(root, start, end, partners)
+    if not files:
+        raise ValueError('No partitions match.')
+    where = ''
+    if partners:
+        where = ' WHERE %s IN (%s)' % (
+            PARTNER_COLUMN, ', '.join(_quote(p) for p in partners))
+    con.execute(
+        'CREATE VIEW clean_history AS SELECT * FROM '
+        'read_parquet([%s], hive_partitioning=true)%s' % (
+            ', '.join(_quote(f) for f in files), where))
+    return con
+
+def query(root, sql, start=None, end=None, partners=None):
+    """Run `sql` (on the view `clean_history`). Returns (column names,
+       rows)."""
+    con = connect(root, start, end, partners)
+    try:
+        cursor = con.execute(sql)
+        return [d[0] for d in cursor.description], cursor.fetchall()
+    finally:
+        con.close()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query the clean history with DuckDB.')
+    parser.add_argument('root', help='s3://bucket or a local copy of it')
+    parser.add_argument('sql', nargs='?',
+                        default='SELECT dt, count(*) FROM clean_history '
+                                'GROUP BY dt ORDER BY dt')
+    parser.add_argument('--start', help='first date (yyyy-mm-dd)')
+    parser.add_argument('--end', help='last date (yyyy-mm-dd)')
+    parser.add_argument('--partner', action='append', dest='partners',
+                        help='only rows of this partner (repeatable)')
+    args = parser.parse_args()
+    names, rows = query(args.root, args.sql, args.start, args.end,
+                        args.partners)
+    print('\t'.join(names))
+    for row in rows:
+        print('\t'.join('' if v is None else u'%s' % (v, ) for v in row))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
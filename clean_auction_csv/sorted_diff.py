@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  sorted_diff.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Diff of two exports without either one in a dict: both sorted on the
+#  key, then merged in one pass.
+#
+#   old = sorted_diff.external_sort(rows, key, scr)     # or already sorted
+#   for kind, old_row, new_row in sorted_diff.diff(old, new, key, value):
+#       ...                                 # 'insert', 'change', 'delete'
+#
+#  external_sort() sorts runs of about SORT_BUDGET bytes in memory, spills
+#  them to csv files in the scratch directory and merges those: memory is
+#  one run plus one row per spill file, whatever the size of the export.
+#  An export that's written sorted (latest.csv in merge mode) is read as
+#  it is. clean_auction_csv only streams yesterday's export like this:
+#  today's rows are a list, sorted in place.
+#
+###############################################################################
+
+import os
+import heapq
+import logging
+# 3th party
+import unicodecsv as csv
+
+log = logging.getLogger(__name__)
+
+# Bytes of rows sorted in memory at a time (the values' length, roughly
+# a third of what they take as Python objects)
+SORT_BUDGET     = int(os.environ.get('DIFF_SORT_BUDGET', 32 * 1024 * 1024))
+
+INSERT  = 'insert'
+CHANGE  = 'change'
+DELETE  = 'delete'
+
+
+def row_size(row):
+    return sum(len(v) for v in row)
+
+def is_sorted(rows, key):
+    prev = None
+    for row in rows:
+        k = key(row)
+        if prev is not None and k < prev:
+            return False
+        prev = k
+    return True
+
+def _spill(run, path):
+    with open(path, 'wb') as f:
+        csv.writer(f, delimiter=',', quotechar='"').writerows(run)
+    return path
+
+def _read_run(path, n, key):
+    # (key, run number, row): rows themselves are never compared
+    with open(path, 'rb') as f:
+        for row in csv.reader(f, delimiter=',', quotechar='"'):
+            yield key(row), n, row
+
+def external_sort(rows, key, scr, budget=SORT_BUDGET):
+    """Yield the csv `rows` (lists of text) sorted on key(row). Runs of
+       `budget` bytes go to spill files of Scratch `scr`."""
+    run, size, paths = [], 0, []
+    for row in rows:
+        run.append(row)
+        size += row_size(row)
+        if size >= budget:
+            run.sort(key=key)
+            paths.append(_spill(run, scr.path('sort-%04d.csv' % len(paths))))
+            run, size = [], 0
+    run.sort(key=key)
+    if not paths:
+        for row in run:
+            yield row
+        return
+    log.info('Sorted in %s runs of %s bytes.', len(paths) + 1, budget)
+    last = ((key(row), len(paths), row) for row in run)
+    runs = [_read_run(path, n, key) for n, path in enumerate(paths)]
+    try:
+        for _, _, row in heapq.merge(*(runs + [last])):
+            yield row
+    finally:
+        for r in runs:
+            r.close()
+        for path in paths:
+            os.remove(path)
+
+def diff(old_rows, new_rows, key, value=None):
+    """Yield (kind, old_row, new_row) for the rows that are new (INSERT,
+       old_row None), gone (DELETE, new_row None) or of which value(row)
+       changed (CHANGE). Both sorted on key(row), a key at most once."""
+    value = value or (lambda row: row)
+    old_rows, new_rows = iter(old_rows), iter(new_rows)
+    old, new = next(old_rows, None), next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and key(old) < key(new)):
+            yield DELETE, old, None
+            old = next(old_rows, None)
+        elif old is None or key(new) < key(old):
+            yield INSERT, None, new
+            new = next(new_rows, None)
+        else:
+            if value(old) != value(new):
+                yield CHANGE, old, new
+            old, new = next(old_rows, None), next(new_rows, None)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
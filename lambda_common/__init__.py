@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+#  lambda_common
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Code shared by the λ-functions in this repo.
+#
+#  Every function directory has a `lambda_common` symlink pointing here,
+#  so the package ends up in the deployment zip (zip follows symlinks by
+#  default) and `python <function>.py` works locally as well.
+#
+###############################################################################
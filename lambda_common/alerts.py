@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  alerts.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  SNS alerts that don't hold up the handler:
+#
+#   from lambda_common import alerts
+#
+#   @metrics.instrumented
+#   @alerts.instrumented
+#   def lambda_handler(event, context):
+#       ...
+#       alerts.send(os.environ['TOPIC_ARN'], 'Invalid email', msg)
+#
+#  send() only queues; a background thread publishes (with the one SNS
+#  client of the topic's region). The decorator flushes before the handler
+#  returns: Lambda freezes the container after that.
+#
+#  Alerts with the same topic and subject within WINDOW seconds are
+#  coalesced: the first one goes out right away, the rest as one summary
+#  when the window closes. A window outlives the invocation: its summary
+#  goes out in the first invocation of the (warm) container after the
+#  window closed, and never if there's none. A local run ends with
+#  flush(final=True), which sends all summaries. At most BUDGET messages
+#  are published per invocation; what's over is dropped, and counted.
+#
+###############################################################################
+
+import os
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue                   # Python 2
+# Own
+from lambda_common import aws_clients
+from lambda_common import metrics
+
+log = logging.getLogger(__name__)
+
+# Seconds in which alerts with the same topic and subject are coalesced
+WINDOW          = float(os.environ.get('ALERT_WINDOW', 60))
+# Messages published per invocation, at most
+BUDGET          = int(os.environ.get('ALERT_BUDGET', 10))
+# Messages quoted in a summary
+MAX_SAMPLES     = 10
+# Longest wait for the publishes at a flush (s)
+FLUSH_TIMEOUT   = 10
+
+_FLUSH = object()
+
+
+def topic_region(topic_arn):
+    """Region of arn:aws:sns:<region>:<account>:<name>, or None."""
+    parts = topic_arn.split(':')
+    return parts[3] if len(parts) > 5 and parts[3] else None
+
+
+class Window(object):
+    """Alerts of one (topic, subject) since the first one went out."""
+
+    def __init__(self, closes):
+        self.closes     = closes
+        self.count      = 0
+        self.samples    = []
+
+    def add(self, msg):
+        self.count += 1
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(msg)
+
+    def summary(self, subject, window):
+        more = self.count - len(self.samples)
+        msg = '%s more alerts like "%s" in %gs:\n\n%s' % (
+            self.count, subject, window, '\n\n'.join(self.samples))
+        if more:
+            msg += '\n\n(and %s more)' % more
+        return '%s (x%s)' % (subject, self.count), msg
+
+
+class Alerter(object):
+
+    def __init__(self, window=WINDOW, budget=BUDGET):
+        self.window     = window
+        self.budget     = budget
+        self._queue     = queue.Queue()
+        self._thread    = None
+        self._lock      = threading.Lock()
+        # {(topic_arn, region_name, subject): Window}, only used by the
+        # thread
+        self._windows   = OrderedDict()
+        # The counts of this invocation, of the thread and the flush
+        self._count_lock = threading.Lock()
+        self.published  = 0
+        self.dropped    = 0
+        self.errors     = 0
+
+    def _reset(self):
+        """The counts so far, set to 0."""
+        with self._count_lock:
+            counts = (self.published, self.dropped, self.errors)
+            self.published  = 0
+            self.dropped    = 0
+            self.errors     = 0
+        return counts
+
+    def send(self, topic_arn, subject, msg, region_name=None):
+        """Queue an alert (never blocks, never raises). The region is the
+           topic's, unless `region_name` is given."""
+        self._start()
+        self._queue.put((topic_arn, region_name or topic_region(topic_arn),
+                         subject, msg))
+
+    def flush(self, timeout=FLUSH_TIMEOUT, final=False):
+        """Publish what's queued and the summaries of the closed windows,
+           wait for it (at most `timeout` s) and start a new budget. Open
+           windows stay open, unless `final` (the process ends)."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done, final))
+        if not done.wait(timeout):
+            # The thread may still be publishing: counted in the next one
+            log.warning('Alerts not flushed in %ss.', timeout)
+        published, dropped, errors = self._reset()
+        if dropped:
+            log.warning('%s alert messages over the budget of %s, dropped.',
+                        dropped, self.budget)
+        metrics.count('Published', published, stage='alerts')
+        metrics.count('Dropped', dropped, stage='alerts')
+        metrics.count('Errors', errors, stage='alerts')
+
+    def instrumented(self, handler):
+        """Decorator for a lambda_handler: flushes when it returns or
+           raises."""
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            try:
+                return handler(event, context)
+            finally:
+                self.flush()
+        return wrapper
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name='alerts')
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._timeout())
+            except queue.Empty:
+                self._close_windows(time.time())
+                continue
+            if item[0] is _FLUSH:
+                _, done, final = item
+                self._close_windows(None if final else time.time())
+                done.set()
+            else:
+                self._handle(*item)
+
+    def _timeout(self):
+        if not self._windows:
+            return None
+        first = min(w.closes for w in self._windows.values())
+        return max(0, first - time.time())
+
+    def _handle(self, topic_arn, region_name, subject, msg):
+        key = (topic_arn, region_name, subject)
+        now = time.time()
+        self._close_windows(now)
+        if key in self._windows:
+            self._windows[key].add(msg)
+        else:
+            self._windows[key] = Window(now + self.window)
+            self._publish(topic_arn, region_name, subject, msg)
+
+    def _close_windows(self, now=None):
+        """Summaries of the windows that closed by `now` (all when `now` is
+           None)."""
+        for key, window in list(self._windows.items()):
+            if now is not None and window.closes > now:
+                continue
+            del self._windows[key]
+            if window.count:
+                topic_arn, region_name, subject = key
+                self._publish(topic_arn, region_name,
+                              *window.summary(subject, self.window))
+
+    def _publish(self, topic_arn, region_name, subject, msg):
+        with self._count_lock:
+            if self.published >= self.budget:
+                self.dropped += 1
+                return
+            self.published += 1
+        try:
+            client = aws_clients.get_client('sns', region_name=region_name)
+            client.publish(
+                TopicArn    = topic_arn,
+                # SNS: at most 100 characters
+                Subject     = subject[:100],
+                Message     = msg,
+            )
+        except Exception as e:
+            with self._count_lock:
+                self.errors += 1
+            log.error('Alert "%s" not published: %s', subject, e)
+
+
+# One per container, and module-level shortcuts to it
+default = Alerter()
+send            = default.send
+flush           = default.flush
+instrumented    = default.instrumented
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  auction_schema.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  The columns of an auction export, from the raw csv to MySQL, in one
+#  place:
+#
+#   from lambda_common import auction_schema
+#
+#   auction_schema.EXPORT_COLUMNS   # raw csv: header, clean function kind
+#   auction_schema.CLEAN_HEADER     # clean csv (and AuctionsRaw) columns
+#   auction_schema.create_sql('AuctionsRaw')
+#   auction_schema.mysql_row(row)   # clean csv row -> values to insert
+#   auction_schema.migrate(cursor, 'AuctionsRaw')   # [ALTER TABLE ...]
+#
+#  clean_auction_csv maps the `clean` kinds to its functions; the loader
+#  and the Google uploader take the clean header and the MySQL types.
+#
+#  migrate() compares the table with the schema (information_schema) and
+#  adds what's missing: columns and indexes in place without locking
+#  (ALGORITHM=INPLACE, LOCK=NONE), a type that changed with a table copy
+#  that still allows reads (LOCK=SHARED). Nothing is dropped.
+#
+###############################################################################
+
+import re
+import logging
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+# `export`: header in the raw csv (None: added by the cleaner), `clean`:
+# kind of clean function, `mysql`: column type (None: not in the clean csv
+# nor in MySQL), `relevant`: a change of it puts the row in the diff
+Column = namedtuple('Column', ['name', 'export', 'clean', 'mysql', 'relevant'])
+Index = namedtuple('Index', ['name', 'columns', 'unique'])
+
+# Amounts up to 99999999.99 (DECIMAL(5,2) stopped at 999.99)
+AMOUNT = 'DECIMAL(10,2)'
+
+COLUMNS = [
+    Column('ogm',             'OGM code',               'quoted',   'VARCHAR(12)',  False),
+    Column('pa_title',        'Partner Titel',          'trim',     'VARCHAR(255)', False),
+    Column('auc_title',       'Veiling Titel',          'trim',     'VARCHAR(255)', False),
+    Column('auc_id',          'Veiling ID',             'trim',     'INTEGER',      True),
+    Column('auc_link',        'Veiling link',           'trim',     'VARCHAR(255)', False),
+    Column('high_bid',        'Hoogste bod',            'cents',    AMOUNT,         False),
+    Column('admin_cost',      'Administratiekost',      'cents',    AMOUNT,         False),
+    Column('garant_price',    'Garante prijs',          'cents',    AMOUNT,         False),
+    Column('date_high_bid',   'Datum Hoogste bod',      'datetime', 'DATETIME',     False),
+    Column('pay_date',        'Betaal datum',           'datetime', 'DATETIME',     True),
+    Column('annul_ins',       'Annuleringsverzekering', 'cents',    AMOUNT,         False),
+    Column('full_option',     'Full option',            'cents',    AMOUNT,         False),
+    Column('annul_date',      'Annulatie datum',        'datetime', 'DATETIME',     True),
+    Column('collect_date',    'Inningsdatum',           'datetime', 'DATETIME',     True),
+    Column('extra_info',      'Extra informatie',       'trim',     'TEXT',         False),
+    Column('clang_id',        'Clang ID',               'trim',     'INTEGER',      False),
+    Column('cust_fname',      'Klant Voornaam',         'title',    'VARCHAR(255)', False),
+    Column('cust_lname',      'Klant Achternaam',       'title',    'VARCHAR(255)', False),
+    Column('cust_email',      'Klant Email',            'email',    'VARCHAR(255)', False),
+    Column('cust_street',     'Klant Straat',           'title',    'VARCHAR(255)', False),
+    Column('cust_housenr',    'Klant Nummer',           'trim',     'VARCHAR(255)', False),
+    Column('cust_hnr_suff',   'Klant Toevoeging',       'trim',     'VARCHAR(255)', False),
+    Column('cust_post_code',  'Klant Postcode',         'trim',     'VARCHAR(255)', False),
+    Column('cust_town',       'Klant Gemeente',         'title',    'VARCHAR(255)', False),
+    Column('cust_phone',      'Klant Telefoon',         'trim',     'VARCHAR(255)', False),
+    Column('clang_error',     'Clang error',            'trim',     None,           False),
+    Column('bid_is_suspicious', None,                   None,       'BOOLEAN',      False),
+]
+
+PRIMARY_KEY = ('auc_id', )
+INDEXES = [
+    # 'ogm': the name MySQL gave the UNIQUE of the first CREATE TABLE
+    Index('ogm',                ('ogm', ),              True),
+    Index('ix_cust_email',      ('cust_email', ),       False),
+    Index('ix_date_high_bid',   ('date_high_bid', ),    False),
+    Index('ix_pay_date',        ('pay_date', ),         False),
+]
+
+# The raw csv, in its order
+EXPORT_COLUMNS  = [c for c in COLUMNS if c.export]
+# The clean csv and AuctionsRaw: the same columns
+CLEAN_COLUMNS   = [c for c in COLUMNS if c.mysql]
+CLEAN_HEADER    = tuple(c.name for c in CLEAN_COLUMNS)
+
+
+def _to_boolean(text):
+    # as_text of a bool: 'True'/'False'
+    return 1 if text.strip().lower() in ('true', '1') else 0
+
+def _to_datetime(text):
+    # '2017-01-12T16:23:29Z' (UTC): strict MySQL doesn't take the T and Z
+    return text.replace(u'T', u' ').rstrip(u'Z')
+
+def _to_number(text):
+    return text.strip()
+
+def _to_string(text):
+    return text
+
+def mysql_value(mysql_type):
+    """The function that makes a clean csv value (text) the value of a
+       column of `mysql_type`: '' is NULL for anything but text."""
+    t = mysql_type.split('(')[0].upper()
+    convert = {
+        'BOOLEAN'   : _to_boolean,
+        'DATETIME'  : _to_datetime,
+        'INTEGER'   : _to_number,
+        'DECIMAL'   : _to_number,
+    }.get(t)
+    if convert is None:
+        return _to_string
+    return lambda text: convert(text) if text else None
+
+MYSQL_VALUES = [mysql_value(c.mysql) for c in CLEAN_COLUMNS]
+
+def mysql_row(row):
+    """A row of the clean csv (text, CLEAN_COLUMNS) as the values to
+       insert in AuctionsRaw."""
+    return tuple(f(v) for f, v in zip(MYSQL_VALUES, row))
+
+def not_null(name):
+    return name in PRIMARY_KEY or any(
+        index.unique and name in index.columns for index in INDEXES)
+
+def column_sql(column):
+    return '`%s` %s%s' % (column.name, column.mysql,
+                          ' NOT NULL' if not_null(column.name) else '')
+
+def index_sql(index):
+    return '%sINDEX `%s` (%s)' % ('UNIQUE ' if index.unique else '', index.name,
+                                  ', '.join('`%s`' % c for c in index.columns))
+
+def create_sql(table):
+    """CREATE TABLE of `table` with all columns and indexes."""
+    fields = [column_sql(c) for c in CLEAN_COLUMNS] + \
+             ['PRIMARY KEY ( %s )' % ', '.join(PRIMARY_KEY)] + \
+             [index_sql(i) for i in INDEXES]
+    return """CREATE TABLE `{table}` (
+    {fields}
+) DEFAULT CHARSET=utf8;""".format(table=table, fields=',\n    '.join(fields))
+
+
+def normal_type(mysql_type):
+    """Type as information_schema's COLUMN_TYPE has it: 'int(11)' and
+       'INTEGER' are both 'int', BOOLEAN is 'tinyint(1)'."""
+    t = mysql_type.strip().lower()
+    t = {'integer': 'int', 'boolean': 'tinyint(1)', 'bool': 'tinyint(1)'}.get(t, t)
+    # Display widths of integers don't matter (and MySQL 8 leaves them out)
+    return re.sub(r'^(int|bigint|smallint|mediumint)\(\d+\)', r'\1', t)
+
+def decimal_digits(mysql_type):
+    """(precision, scale) of a DECIMAL type: 'DECIMAL(10,2)' is (10, 2)."""
+    m = re.match(r'^decimal\((\d+),\s*(\d+)\)$', normal_type(mysql_type))
+    if m is None:
+        raise ValueError('Not a DECIMAL(p,s): %r' % mysql_type)
+    return int(m.group(1)), int(m.group(2))
+
+def plan_migration(table, columns, indexes):
+    """ALTER TABLE statements that make `table` match the schema.
+       `columns`: {name: COLUMN_TYPE}, `indexes`: [(columns, unique)] of
+       the table as it is."""
+    adds, changes = list(), list()
+    previous = None
+    for column in CLEAN_COLUMNS:
+        if column.name not in columns:
+            adds.append('ADD COLUMN %s %s' % (column_sql(column),
+                        'AFTER `%s`' % previous if previous else 'FIRST'))
+        elif normal_type(columns[column.name]) != normal_type(column.mysql):
+            changes.append('MODIFY COLUMN %s' % column_sql(column))
+        previous = column.name
+    present = set((tuple(cols), bool(unique)) for cols, unique in indexes)
+    for index in INDEXES:
+        if (index.columns, index.unique) not in present:
+            adds.append('ADD %s' % index_sql(index))
+    statements = list()
+    if changes:
+        # A type change copies the table: reads go on, writes wait
+        statements.append('ALTER TABLE `%s` %s, ALGORITHM=COPY, LOCK=SHARED;'
+                          % (table, ', '.join(changes)))
+    if adds:
+        statements.append('ALTER TABLE `%s` %s, ALGORITHM=INPLACE, LOCK=NONE;'
+                          % (table, ', '.join(adds)))
+    return statements
+
+def describe(cursor, table):
+    """(columns, indexes) of `table` as plan_migration takes them, None if
+       there's no such table."""
+    cursor.execute("""SELECT COLUMN_NAME, COLUMN_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (table, ))
+    columns = dict(cursor.fetchall())
+    if not columns:
+        return None
+    cursor.execute("""SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX""", (table, ))
+    indexes = dict()
+    for name, non_unique, column in cursor.fetchall():
+        indexes.setdefault(name, ([], not int(non_unique)))[0].append(column)
+    return columns, list(indexes.values())
+
+def migrate(cursor, table, dry_run=False):
+    """Create `table` or bring it up to the schema. Returns the statements
+       (only those, with `dry_run`)."""
+    described = describe(cursor, table)
+    if described is None:
+        statements = [create_sql(table)]
+    else:
+        statements = plan_migration(table, *described)
+    for sql in statements:
+        if dry_run:
+            continue
+        log.info('Migrating %s: %s', table, sql)
+        cursor.execute(sql)
+    return statements
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
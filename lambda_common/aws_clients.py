@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  aws_clients.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  boto3 clients, created on first use and then kept for the life of the
+#  container (one per service/region/config).
+#
+#   from lambda_common import aws_clients
+#
+#   s3_client = aws_clients.lazy_client('s3', signature_version='s3v4')
+#   ...
+#   s3_client.get_object(...)   # <- boto3 is imported and the client made here
+#
+#  Importing boto3 and creating a client is a big part of a cold start;
+#  a function that doesn't need a client on a path, doesn't pay for it.
+#
+###############################################################################
+
+import threading
+
+_clients    = dict()
+_lock       = threading.Lock()
+
+
+def _cache_key(service, region_name, signature_version, kwargs):
+    return (service, region_name, signature_version,
+            tuple(sorted(kwargs.items())))
+
+def get_client(service, region_name=None, signature_version=None, **kwargs):
+    """Return the (one) boto3 client for `service` with these settings.
+       `kwargs` go to boto3.client() (e.g. endpoint_url)."""
+    key = _cache_key(service, region_name, signature_version, kwargs)
+    try:
+        return _clients[key]
+    except KeyError:
+        pass
+    with _lock:
+        if key not in _clients:
+            import boto3
+            if region_name:
+                kwargs['region_name'] = region_name
+            if signature_version:
+                from botocore.client import Config
+                kwargs['config'] = Config(signature_version=signature_version)
+            _clients[key] = boto3.client(service, **kwargs)
+    return _clients[key]
+
+
+class LazyClient(object):
+    """Stands in for a boto3 client: the real one is only created (through
+       `get_client`) when one of its methods is used."""
+
+    def __init__(self, service, region_name=None, signature_version=None,
+                 **kwargs):
+        self._args      = (service, region_name, signature_version)
+        self._kwargs    = kwargs
+
+    @property
+    def client(self):
+        return get_client(*self._args, **dict(self._kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __repr__(self):
+        return '<LazyClient %s>' % (self._args[0], )
+
+def lazy_client(service, region_name=None, signature_version=None, **kwargs):
+    return LazyClient(service, region_name, signature_version, **kwargs)
+
+def clear():
+    """Forget all clients (e.g. after patching boto3 in a local run)."""
+    with _lock:
+        _clients.clear()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
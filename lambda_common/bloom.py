@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bloom.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  A small, serializable Bloom filter (pure Python).
+#
+#  `item in bloom` is never False for an item that was added, and True
+#  for an item that wasn't with a probability of about `error_rate`.
+#
+###############################################################################
+
+import math
+import struct
+import hashlib
+
+# Serialized: number of bits (m), number of hashes (k), then the bits
+_HEADER = struct.Struct('>QI')
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity=None, error_rate=0.01,
+                 num_bits=None, num_hashes=None, bits=None):
+        if num_bits is None:
+            capacity = max(capacity or 1, 1)
+            num_bits = int(math.ceil(
+                -capacity * math.log(error_rate) / math.log(2) ** 2))
+            num_hashes = max(int(round(num_bits / float(capacity) * math.log(2))), 1)
+        self.num_bits   = num_bits
+        self.num_hashes = num_hashes
+        self.bits       = bits if bits is not None \
+                            else bytearray((num_bits + 7) // 8)
+
+    def _positions(self, item):
+        if not isinstance(item, bytes):
+            item = item.encode('utf8')
+        digest = hashlib.sha256(item).digest()
+        # Double hashing: k positions out of two 64-bit hashes
+        h1, h2 = struct.unpack('>QQ', digest[:16])
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return _HEADER.pack(self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        num_bits, num_hashes = _HEADER.unpack(data[:_HEADER.size])
+        return cls(num_bits=num_bits, num_hashes=num_hashes,
+                   bits=bytearray(data[_HEADER.size:]))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
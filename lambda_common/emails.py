@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  emails.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Email normalization and validation.
+#
+#   - `split_email()`: one address -> (email_cleaned, email_local,
+#       email_domain, email_tld, err_msg), cached (LRU)
+#   - `split_emails()`: the same for a whole column in one call (every
+#       distinct address is only validated once)
+#   - `clean_email()`: just the cleaned address
+#
+#  Valid addresses give the same tuple as the old `split_email` of
+#  bdm_event_lead_trigger. Invalid ones (à la 'a@b.', 'a..b@c.be') now
+#  get an err_msg. Internationalized domains are validated in their
+#  IDNA (xn--) form but returned as given.
+#
+###############################################################################
+
+import re
+try:
+    from functools import lru_cache         # Python 3
+except ImportError:
+    lru_cache = None                        # Python 2
+from collections import OrderedDict
+
+# Cache size of `split_email`: a day of leads or a column of an export
+# has far fewer distinct addresses than this
+CACHE_SIZE = 100000
+
+# RFC 5322 dot-atom (no quoted local parts: nobody uses them)
+LOCAL_RE    = re.compile(r"^[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*$")
+LABEL_RE    = re.compile(r'^[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?$')
+TLD_RE      = re.compile(r'^(?:[a-z]{2,63}|xn--[a-z0-9-]{1,59})$')
+
+ERR_NO_AT           = 'No @-character'
+ERR_MULTIPLE_AT     = 'More then one @-character'
+ERR_NO_DOMAIN       = 'No domain'
+ERR_LOCAL           = 'Invalid local part'
+ERR_DOMAIN          = 'Invalid domain'
+ERR_TLD             = 'Invalid TLD'
+ERR_TOO_LONG        = 'Address too long'
+
+
+def _lru(maxsize):
+    """functools.lru_cache on Python 3, a simple one on Python 2."""
+    if lru_cache is not None:
+        return lru_cache(maxsize=maxsize)
+    def decorator(func):
+        cache = OrderedDict()
+        def wrapper(arg):
+            try:
+                value = cache.pop(arg)
+            except KeyError:
+                value = func(arg)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[arg] = value
+            return value
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+def _idna(domain):
+    """ASCII (xn--) form of `domain`, None if it can't be encoded."""
+    try:
+        domain.encode('ascii')
+        return domain
+    except UnicodeError:
+        pass
+    try:
+        return domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+
+def _check_domain(domain):
+    """Return an error message, None if `domain` is valid."""
+    labels = domain.split('.')
+    if len(labels) < 2:
+        return ERR_NO_DOMAIN
+    if '' in labels:
+        return ERR_DOMAIN
+    ascii_domain = _idna(domain)
+    if ascii_domain is None or len(ascii_domain) > 253:
+        return ERR_DOMAIN
+    ascii_labels = ascii_domain.split('.')
+    for label in ascii_labels[:-1]:
+        if not LABEL_RE.match(label):
+            return ERR_DOMAIN
+    if not TLD_RE.match(ascii_labels[-1]):
+        return ERR_TLD
+    return None
+
+def split_email_uncached(email, strip_plus_alias=False):
+    email_cleaned   = email.strip().lower()
+    email_local     = None
+    email_domain    = None
+    email_tld       = None
+    err_msg         = None
+    parts = email_cleaned.split('@')
+    if len(parts) == 1:
+        return email_cleaned, None, None, None, ERR_NO_AT
+    elif len(parts) > 2:
+        return email_cleaned, None, None, None, ERR_MULTIPLE_AT
+    email_local, email_domain = parts
+    if strip_plus_alias:
+        email_local = email_local.split('+', 1)[0]
+        email_cleaned = '@'.join([email_local, email_domain])
+    if not LOCAL_RE.match(email_local) or len(email_local) > 64:
+        err_msg = ERR_LOCAL
+    elif len(email_cleaned) > 254:
+        err_msg = ERR_TOO_LONG
+    else:
+        err_msg = _check_domain(email_domain)
+    if not err_msg:
+        email_tld = email_domain.rsplit('.', 1)[1]
+    return email_cleaned, email_local, email_domain, email_tld, err_msg
+
+@_lru(CACHE_SIZE)
+def split_email(email):
+    """Clean and validate `email`.
+       Returns (email_cleaned, email_local, email_domain, email_tld, err_msg),
+       err_msg is None for a valid address."""
+    return split_email_uncached(email)
+
+def split_emails(emails):
+    """`split_email` for a whole column (any iterable) in one call.
+       Returns a list of tuples, in the same order."""
+    seen = dict()
+    result = list()
+    for email in emails:
+        try:
+            result.append(seen[email])
+        except KeyError:
+            seen[email] = t = split_email_uncached(email)
+            result.append(t)
+    return result
+
+def clean_email(email):
+    """The cleaned (stripped, lower case) address."""
+    return split_email(email)[0]
+
+def canonical_email(email):
+    """Cleaned address without plus-alias ('jan+promo@x.be' -> 'jan@x.be').
+       To recognize the same person, not to send mail to."""
+    return split_email_uncached(email, strip_plus_alias=True)[0]
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
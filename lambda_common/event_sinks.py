@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  event_sinks.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Write events (dicts) as compact NDJSON, in batches, to:
+#
+#   - S3:       one object per batch, <prefix>part-00000.ndjson, ...
+#   - SQS:      one message per batch (NDJSON, < 256 KB), up to 10 (and
+#               256 KB in all) per request
+#   - Kinesis:  one record per event, 500 per request, partitioned by a
+#               field of the event (e.g. the auction id)
+#
+#  `from_url()` picks one from a setting:
+#
+#   s3://bucket/prefix/     sqs://<queue url without https://>
+#   kinesis://<stream>      none
+#
+#  Failed SQS/Kinesis entries are retried (MAX_RETRIES), then raised.
+#
+###############################################################################
+
+import json
+import logging
+# Own
+from lambda_common import aws_clients
+
+log = logging.getLogger(__name__)
+
+MAX_RETRIES = 3
+
+
+def to_ndjson_lines(events):
+    """One compact JSON line (bytes, newline included) per event."""
+    for event in events:
+        yield (json.dumps(event, separators=(',', ':')) + '\n').encode('utf8')
+
+def batches(lines, max_bytes, max_count=None):
+    """Group `lines` in lists of at most `max_bytes` bytes and `max_count`
+       lines."""
+    batch, size = list(), 0
+    for line in lines:
+        if batch and (size + len(line) > max_bytes
+                      or max_count and len(batch) >= max_count):
+            yield batch
+            batch, size = list(), 0
+        batch.append(line)
+        size += len(line)
+    if batch:
+        yield batch
+
+
+class S3Sink(object):
+
+    def __init__(self, bucket, prefix, max_bytes=8 * 1024 * 1024,
+                 client=None):
+        self.bucket     = bucket
+        self.prefix     = prefix
+        self.max_bytes  = max_bytes
+        self.client     = client or aws_clients.get_client(
+                            's3', signature_version='s3v4')
+        self.keys       = list()
+
+    def put(self, events, prefix=None):
+        """Write `events`; returns the number written. `prefix` (e.g. with
+           the date) is added to the sink's prefix."""
+        count = 0
+        for batch in batches(to_ndjson_lines(events), self.max_bytes):
+            key = '%s%spart-%05d.ndjson' % (self.prefix, prefix or '',
+                                            len(self.keys))
+            self.client.put_object(Bucket=self.bucket, Key=key,
+                                   Body=b''.join(batch),
+                                   ContentType='application/x-ndjson',
+                                   ACL='private')
+            self.keys.append(key)
+            count += len(batch)
+        return count
+
+
+class SQSSink(object):
+
+    MAX_MESSAGE_BYTES   = 250 * 1024
+    MAX_BATCH           = 10
+    # The bodies of a send_message_batch, together
+    MAX_BATCH_BYTES     = 256 * 1024
+
+    def __init__(self, queue_url, client=None):
+        self.queue_url  = queue_url
+        self.client     = client or aws_clients.get_client('sqs')
+
+    def _send(self, entries):
+        for attempt in range(MAX_RETRIES + 1):
+            res = self.client.send_message_batch(QueueUrl=self.queue_url,
+                                                 Entries=entries)
+            failed = set(f['Id'] for f in res.get('Failed', []))
+            if not failed:
+                return
+            entries = [e for e in entries if e['Id'] in failed]
+            log.warn('%s SQS messages failed, retrying.', len(entries))
+        raise RuntimeError('%s SQS messages could not be sent.' % len(entries))
+
+    def put(self, events, prefix=None):
+        count = 0
+        bodies = (b''.join(batch) for batch in
+                  batches(to_ndjson_lines(events), self.MAX_MESSAGE_BYTES))
+        for request in batches(bodies, self.MAX_BATCH_BYTES, self.MAX_BATCH):
+            self._send([{'Id': str(i), 'MessageBody': body.decode('utf8')}
+                        for i, body in enumerate(request)])
+            count += sum(body.count(b'\n') for body in request)
+        return count
+
+
+class KinesisSink(object):
+
+    MAX_RECORDS         = 500
+    MAX_REQUEST_BYTES   = 5 * 1024 * 1024
+
+    def __init__(self, stream, partition_key='id', client=None):
+        self.stream         = stream
+        self.partition_key  = partition_key
+        self.client         = client or aws_clients.get_client('kinesis')
+
+    def _send(self, records):
+        for attempt in range(MAX_RETRIES + 1):
+            res = self.client.put_records(StreamName=self.stream,
+                                          Records=records)
+            if not res.get('FailedRecordCount'):
+                return
+            records = [r for r, result in zip(records, res['Records'])
+                       if result.get('ErrorCode')]
+            log.warn('%s Kinesis records failed, retrying.', len(records))
+        raise RuntimeError('%s Kinesis records could not be put.' % len(records))
+
+    def put(self, events, prefix=None):
+        count, records, size = 0, list(), 0
+        for event in events:
+            data = json.dumps(event, separators=(',', ':')).encode('utf8')
+            key = str(event.get(self.partition_key, count))
+            if records and (len(records) == self.MAX_RECORDS or
+                            size + len(data) + len(key) > self.MAX_REQUEST_BYTES):
+                self._send(records)
+                records, size = list(), 0
+            records.append({'Data': data, 'PartitionKey': key})
+            size += len(data) + len(key)
+            count += 1
+        if records:
+            self._send(records)
+        return count
+
+
+class NoSink(object):
+
+    def put(self, events, prefix=None):
+        return sum(1 for _ in events)
+
+
+def from_url(url, partition_key='id'):
+    """Sink for a setting like s3://bucket/prefix/, sqs://queue-url,
+       kinesis://stream or none."""
+    if not url or url == 'none':
+        return NoSink()
+    scheme, _, rest = url.partition('://')
+    if scheme == 's3':
+        bucket, _, prefix = rest.partition('/')
+        return S3Sink(bucket, prefix)
+    if scheme == 'sqs':
+        return SQSSink('https://' + rest)
+    if scheme == 'kinesis':
+        return KinesisSink(rest, partition_key)
+    raise ValueError('Unknown event sink: %s' % url)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  events.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Decoding of the events that trigger the functions.
+#
+#  `iter_s3_objects(event)` yields an `S3Object` (bucket, key, version,
+#  size, etag) for EVERY record in:
+#
+#   - S3 notifications
+#   - SNS-wrapped S3 notifications (S3 -> SNS fan-out -> λ)
+#   - SQS-wrapped S3 notifications (S3 -> SQS -> λ, or S3 -> SNS -> SQS)
+#   - EventBridge "Object Created" events
+#
+#  Every (JSON) message is parsed only once.
+#
+###############################################################################
+
+import json
+from collections import namedtuple
+PY_3 = False
+try:
+    from urllib.parse import unquote_plus   # Python 3
+    PY_3 = True
+except ImportError:
+    from urllib import unquote_plus         # Python 2
+
+S3Object = namedtuple('S3Object', 'bucket key version size etag event_name')
+
+
+def unquote_key(quoted):
+    """Keys in S3 notifications are URL-encoded ('+' for a space)."""
+    if PY_3:
+        return unquote_plus(quoted, encoding='utf8')
+    else:
+        return unquote_plus(quoted.encode('utf8'))
+
+def _s3_object(record):
+    """S3Object from an S3 notification record."""
+    s3 = record['s3']
+    obj = s3['object']
+    return S3Object(
+        bucket      = s3['bucket']['name'],
+        key         = unquote_key(obj['key']),
+        version     = obj.get('versionId'),
+        size        = obj.get('size'),
+        etag        = obj.get('eTag'),
+        event_name  = record.get('eventName'),
+    )
+
+def _eventbridge_object(event):
+    detail = event['detail']
+    obj = detail['object']
+    key = obj['key']
+    if not PY_3:
+        key = key.encode('utf8')
+    return S3Object(
+        bucket      = detail['bucket']['name'],
+        key         = key,
+        version     = obj.get('version-id'),
+        size        = obj.get('size'),
+        etag        = obj.get('etag'),
+        event_name  = event.get('detail-type'),
+    )
+
+def _iter_message(message):
+    """Objects in a (parsed) message: an S3 notification, an SNS envelope
+       (SNS -> SQS) or an EventBridge event."""
+    if 'Records' in message:
+        for record in message['Records']:
+            for obj in _iter_record(record):
+                yield obj
+    elif message.get('Type') == 'Notification' and 'Message' in message:
+        for obj in _iter_message(json.loads(message['Message'])):
+            yield obj
+    elif message.get('source') == 'aws.s3' and 'detail' in message:
+        yield _eventbridge_object(message)
+    # Anything else (e.g. the s3:TestEvent) has no objects
+
+def _iter_record(record):
+    source = record.get('EventSource') or record.get('eventSource')
+    if 's3' in record and source in ('aws:s3', None):
+        yield _s3_object(record)
+    elif source == 'aws:sns':
+        for obj in _iter_message(json.loads(record['Sns']['Message'])):
+            yield obj
+    elif source == 'aws:sqs':
+        for obj in _iter_message(json.loads(record['body'])):
+            yield obj
+
+def iter_s3_objects(event):
+    """Yield an S3Object for every object in `event` (all records)."""
+    return _iter_message(event)
+
+def s3_objects(event):
+    """`iter_s3_objects` as a list."""
+    return list(iter_s3_objects(event))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  hyperloglog.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  HyperLogLog: estimates the number of distinct items in a fixed amount
+#  of memory (2^p bytes), pure Python.
+#
+#  The standard error is about 1.04 / sqrt(2^p): 1.6% for p=12 (4 KB).
+#
+###############################################################################
+
+import math
+import struct
+import hashlib
+
+
+class HyperLogLog(object):
+
+    def __init__(self, p=12, registers=None):
+        if not 4 <= p <= 16:
+            raise ValueError('p must be between 4 and 16')
+        self.p          = p
+        self.m          = 1 << p
+        self.registers  = registers if registers is not None \
+                            else bytearray(self.m)
+        if self.m >= 128:
+            self.alpha  = 0.7213 / (1 + 1.079 / self.m)
+        else:
+            self.alpha  = {16: 0.673, 32: 0.697, 64: 0.709}[self.m]
+
+    def add(self, item):
+        if not isinstance(item, bytes):
+            item = item.encode('utf8')
+        x = struct.unpack('>Q', hashlib.sha1(item).digest()[:8])[0]
+        j = x & (self.m - 1)
+        w = x >> self.p
+        # Position of the first 1-bit in the remaining 64-p bits
+        rank = 64 - self.p - w.bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def count(self):
+        """Estimated number of distinct items added."""
+        estimate = self.alpha * self.m * self.m / \
+            sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * self.m:
+            # Small range: linear counting on the empty registers
+            zeros = self.registers.count(b'\x00')
+            if zeros:
+                return int(round(self.m * math.log(self.m / float(zeros))))
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def merge(self, other):
+        """Union (in place) with another HyperLogLog of the same p."""
+        if other.p != self.p:
+            raise ValueError('Cannot merge HyperLogLogs of different p')
+        for j, r in enumerate(other.registers):
+            if r > self.registers[j]:
+                self.registers[j] = r
+
+    def to_bytes(self):
+        return struct.pack('>B', self.p) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        p = struct.unpack('>B', data[:1])[0]
+        return cls(p=p, registers=bytearray(data[1:]))
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  idempotency.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Process every S3 object once, although S3 and SNS deliver at least
+#  once:
+#
+#   from lambda_common import idempotency
+#
+#   for obj in events.iter_s3_objects(event):
+#       with idempotency.once_object('clean_auction_csv', obj) as first:
+#           if not first:
+#               continue        # a duplicate delivery: done already
+#           clean_export(obj.bucket, obj.key, context, obj.size)
+#
+#  Before the work, one conditional write claims (function, bucket, key,
+#  version or ETag): IN_PROGRESS with a lease. When the block ends the
+#  record becomes COMPLETED (kept TTL seconds); on an exception it's
+#  removed, so a retry can claim it again. A claim succeeds when there's
+#  no record or its lease/TTL is over (a crashed invocation).
+#
+#  IDEMPOTENCY_STORE picks the store:
+#
+#   dynamodb://<table>  a table with string hash key `id` (and TTL on
+#                       `expires`)
+#   file:///<path>      a JSON file, for local runs and tests
+#   none                every delivery is processed (the default)
+#
+###############################################################################
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+# Own
+from lambda_common import aws_clients
+from lambda_common import metrics
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENCY_STORE   = os.environ.get('IDEMPOTENCY_STORE') or 'none'
+# Completed records are kept this long (s)
+TTL                 = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+# A claim that's neither completed nor released is taken over after this
+# (s): longer than the function's timeout
+LEASE               = int(os.environ.get('IDEMPOTENCY_LEASE', 15 * 60))
+
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETED   = 'COMPLETED'
+
+
+def object_id(obj):
+    """Identity of an S3Object (lambda_common.events), or None when the
+       event has neither version nor ETag."""
+    version = obj.version or obj.etag
+    if not version:
+        return None
+    return '%s/%s@%s' % (obj.bucket, obj.key, version)
+
+def _is_conditional_failure(e):
+    code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+    return code == 'ConditionalCheckFailedException'
+
+
+class DynamoDBStore(object):
+
+    def __init__(self, table, client=None):
+        self.table  = table
+        self.client = client or aws_clients.get_client('dynamodb')
+
+    def claim(self, item_id, owner, expires, now):
+        try:
+            self.client.put_item(
+                TableName                   = self.table,
+                Item                        = {
+                    'id'        : {'S': item_id},
+                    'state'     : {'S': IN_PROGRESS},
+                    'owner'     : {'S': owner},
+                    'expires'   : {'N': str(expires)},
+                },
+                ConditionExpression         = 'attribute_not_exists(#id) '
+                                              'OR #expires < :now',
+                ExpressionAttributeNames    = {'#id': 'id',
+                                               '#expires': 'expires'},
+                ExpressionAttributeValues   = {':now': {'N': str(now)}},
+            )
+            return True
+        except Exception as e:
+            if _is_conditional_failure(e):
+                return False
+            raise
+
+    def complete(self, item_id, owner, expires):
+        try:
+            self.client.update_item(
+                TableName                   = self.table,
+                Key                         = {'id': {'S': item_id}},
+                UpdateExpression            = 'SET #state = :done, '
+                                              '#expires = :expires',
+                ConditionExpression         = '#owner = :owner',
+                ExpressionAttributeNames    = {'#state': 'state',
+                                               '#expires': 'expires',
+                                               '#owner': 'owner'},
+                ExpressionAttributeValues   = {
+                    ':done'     : {'S': COMPLETED},
+                    ':expires'  : {'N': str(expires)},
+                    ':owner'    : {'S': owner},
+                },
+            )
+            return True
+        except Exception as e:
+            if _is_conditional_failure(e):
+                return False
+            raise
+
+    def release(self, item_id, owner):
+        try:
+            self.client.delete_item(
+                TableName                   = self.table,
+                Key                         = {'id': {'S': item_id}},
+                ConditionExpression         = '#owner = :owner',
+                ExpressionAttributeNames    = {'#owner': 'owner'},
+                ExpressionAttributeValues   = {':owner': {'S': owner}},
+            )
+        except Exception as e:
+            if not _is_conditional_failure(e):
+                raise
+
+
+class FileStore(object):
+    """The same conditions on a JSON file (one process at a time)."""
+
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _save(self, items):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(items, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def claim(self, item_id, owner, expires, now):
+        with self._lock:
+            items = self._load()
+            item = items.get(item_id)
+            if item and item['expires'] >= now:
+                return False
+            items[item_id] = {'state': IN_PROGRESS, 'owner': owner,
+                              'expires': expires}
+            self._save(items)
+            return True
+
+    def complete(self, item_id, owner, expires):
+        with self._lock:
+            items = self._load()
+            item = items.get(item_id)
+            if not item or item['owner'] != owner:
+                return False
+            item.update(state=COMPLETED, expires=expires)
+            self._save(items)
+            return True
+
+    def release(self, item_id, owner):
+        with self._lock:
+            items = self._load()
+            if items.get(item_id, {}).get('owner') == owner:
+                del items[item_id]
+                self._save(items)
+
+
+class NoStore(object):
+
+    def claim(self, item_id, owner, expires, now):
+        return True
+
+    def complete(self, item_id, owner, expires):
+        return True
+
+    def release(self, item_id, owner):
+        pass
+
+
+def from_url(url):
+    """Store for a setting like dynamodb://table, file:///path or none."""
+    if not url or url == 'none':
+        return NoStore()
+    scheme, _, rest = url.partition('://')
+    if scheme == 'dynamodb':
+        return DynamoDBStore(rest)
+    if scheme == 'file':
+        return FileStore(rest)
+    raise ValueError('Unknown idempotency store: %s' % url)
+
+_store = None
+
+def get_store():
+    """The store of IDEMPOTENCY_STORE (one per container)."""
+    global _store
+    if _store is None:
+        _store = from_url(IDEMPOTENCY_STORE)
+    return _store
+
+
+@contextmanager
+def once(scope, item_id, store=None, lease=LEASE, ttl=TTL):
+    """Yields True for the first delivery of `item_id` in `scope` (e.g. the
+       function name), False for a duplicate. An `item_id` of None is
+       always processed."""
+    store = store or get_store()
+    if item_id is None:
+        yield True
+        return
+    item_id = '%s:%s' % (scope, item_id)
+    owner = uuid.uuid4().hex
+    now = int(time.time())
+    if not store.claim(item_id, owner, now + lease, now):
+        log.info('Duplicate delivery, skipped: %s', item_id)
+        metrics.count('Duplicates', stage='idempotency')
+        yield False
+        return
+    try:
+        yield True
+    except BaseException:
+        # Not done: a retry may claim it
+        store.release(item_id, owner)
+        raise
+    if not store.complete(item_id, owner, int(time.time()) + ttl):
+        log.warning('Lease of %s ran out before it was done.', item_id)
+
+def once_object(scope, obj, store=None):
+    """`once` for an S3Object."""
+    return once(scope, object_id(obj), store)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  kms_secrets.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Lazy, cached decryption of KMS-encrypted environment variables.
+#
+#   - one KMS client per container (created on first use)
+#   - secrets are only decrypted when they are asked for, and then kept
+#     for the life of the container
+#   - `prefetch()` decrypts several secrets concurrently
+#   - the plaintext is kept in memory only: a key to a copy on disk
+#     would have to come from KMS too, or it isn't protected by KMS
+#
+###############################################################################
+
+import os
+import logging
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+# Own
+from lambda_common import aws_clients
+
+log = logging.getLogger(__name__)
+
+_cache      = dict()
+
+
+def get_kms_client():
+    """Return the (one) KMS client of this container."""
+    return aws_clients.get_client('kms')
+
+def _decrypt(env_var):
+    return get_kms_client().decrypt(
+        CiphertextBlob=b64decode(os.environ[env_var]))['Plaintext']
+
+def decrypt(env_var):
+    """Return the decrypted value of the KMS-encrypted `env_var`.
+       Only the first call (per container) goes to KMS."""
+    try:
+        return _cache[env_var]
+    except KeyError:
+        plaintext = _decrypt(env_var)
+        _cache[env_var] = plaintext
+        return plaintext
+
+def prefetch(*env_vars):
+    """Decrypt all `env_vars` that aren't cached yet, concurrently.
+       Returns a dict {env_var: plaintext}."""
+    missing = [v for v in env_vars if v not in _cache]
+    if len(missing) > 1:
+        # Create the client before the threads do
+        get_kms_client()
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            for env_var, plaintext in zip(missing,
+                                          executor.map(_decrypt, missing)):
+                _cache[env_var] = plaintext
+    return dict((v, decrypt(v)) for v in env_vars)
+
+def override(env_var, plaintext):
+    """Use `plaintext` for `env_var` without asking KMS (local runs)."""
+    _cache[env_var] = plaintext
+
+def clear():
+    """Forget all cached secrets (memory only)."""
+    _cache.clear()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
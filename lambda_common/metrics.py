@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Per-stage timing, memory and counters, written once per invocation as
+#  CloudWatch Embedded Metric Format (EMF): one JSON line per stage on
+#  stdout, with dimensions FunctionName and Stage. CloudWatch turns these
+#  log lines into metrics; no API calls needed.
+#
+#   from lambda_common import metrics
+#
+#   @metrics.instrumented
+#   def lambda_handler(event, context):
+#       with metrics.timer('download'):
+#           ...
+#       metrics.count('rows', len(lot), stage='parse')
+#
+#  Only measures at stage level (a few clock and /proc reads per stage),
+#  never per row.
+#
+###############################################################################
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+NAMESPACE   = os.environ.get('METRICS_NAMESPACE', 'BDM/Lambda')
+# Set METRICS_DISABLED=1 to not measure nor print anything (e.g. local
+# runs, or to measure the overhead)
+DISABLED    = bool(os.environ.get('METRICS_DISABLED'))
+
+_PAGE_SIZE  = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss_mb():
+    """Current resident set size (MB), peak RSS if /proc isn't there."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 1048576.0
+    except (IOError, OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Metrics(object):
+
+    def __init__(self, namespace=NAMESPACE, function_name=None):
+        self.namespace      = namespace
+        self.function_name  = function_name or os.environ.get(
+            'AWS_LAMBDA_FUNCTION_NAME', 'local')
+        # {stage: OrderedDict({metric name: [value, unit]})}
+        self.stages         = OrderedDict()
+        # Stages can run in threads (e.g. concurrent sinks)
+        self._lock          = threading.Lock()
+
+    def put(self, name, value, unit='None', stage='handler', aggregate=True):
+        """Record a metric. Values of the same stage and name are summed
+           (aggregate) or replaced."""
+        if DISABLED:
+            return
+        with self._lock:
+            metrics = self.stages.setdefault(stage, OrderedDict())
+            if aggregate and name in metrics:
+                metrics[name][0] += value
+            else:
+                metrics[name] = [value, unit]
+
+    def count(self, name, value=1, stage='handler'):
+        self.put(name, value, 'Count', stage)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the block: Duration (ms) and RSS (MB) at its end."""
+        if DISABLED:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.put('Duration', (time.time() - start) * 1000.0,
+                     'Milliseconds', stage)
+            self.put('RSS', rss_mb(), 'Megabytes', stage, aggregate=False)
+
+    def timed(self, stage):
+        """Decorator version of `timer`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def documents(self):
+        """The EMF documents (dicts) of what's recorded so far."""
+        timestamp = int(time.time() * 1000)
+        docs = list()
+        for stage, metrics in self.stages.items():
+            doc = OrderedDict([
+                ('_aws', {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['FunctionName', 'Stage']],
+                        'Metrics': [{'Name': name, 'Unit': unit}
+                                    for name, (value, unit) in metrics.items()],
+                    }],
+                }),
+                ('FunctionName', self.function_name),
+                ('Stage', stage),
+            ])
+            for name, (value, unit) in metrics.items():
+                doc[name] = round(value, 3) if isinstance(value, float) else value
+            docs.append(doc)
+        return docs
+
+    def flush(self, stream=None):
+        """Write all recorded metrics (one line per stage) and reset."""
+        self.put('PeakRSS', peak_rss_mb(), 'Megabytes', 'handler',
+                 aggregate=False)
+        stream = stream or sys.stdout
+        for doc in self.documents():
+            stream.write(json.dumps(doc) + '\n')
+        stream.flush()
+        self.stages = OrderedDict()
+
+    def instrumented(self, handler):
+        """Decorator for a lambda_handler: times it (stage 'handler') and
+           flushes the metrics when it returns or raises."""
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if context is not None and hasattr(context, 'function_name'):
+                self.function_name = context.function_name
+            try:
+                with self.timer('handler'):
+                    return handler(event, context)
+            finally:
+                self.flush()
+        return wrapper
+
+
+# One per container, and module-level shortcuts to it
+default = Metrics()
+put             = default.put
+count           = default.count
+timer           = default.timer
+timed           = default.timed
+flush           = default.flush
+instrumented    = default.instrumented
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  mysql_conn.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  One MySQL connection per container, that survives idle periods and
+#  RDS fail-overs:
+#
+#   - connects lazily (on first use)
+#   - before use, a connection that has been idle for a while is checked
+#     with a cheap `ping(reconnect=True)`, bounded by `ping_timeout`
+#   - `run()` retries a unit of work (on a fresh connection) when the
+#     connection got lost while running it. Only for idempotent work!
+#   - `MYSQL_PROXY_HOST` (if set) routes all connections through a pooler
+#     (RDS Proxy, ProxySQL, ...) instead of straight to `host`
+#   - `stats` keeps connect time and the number of (re)connects
+#
+###############################################################################
+
+import os
+import time
+import logging
+# 3th party
+import pymysql
+from pymysql.err import OperationalError, InterfaceError
+
+log = logging.getLogger(__name__)
+
+# MySQL client error codes that mean "the connection is gone"
+#   2003: Can't connect, 2006: Server has gone away,
+#   2013: Lost connection during query, 2055: Lost connection (system error),
+#   4031: Disconnected for inactivity (sent by MySQL 8.0.24+)
+CONN_LOST_ERRORS = (2003, 2006, 2013, 2055, 4031)
+
+
+def is_connection_lost(e):
+    """Did exception `e` happen because the connection got lost?"""
+    if isinstance(e, InterfaceError):
+        # pymysql raises InterfaceError on a closed connection
+        return True
+    return isinstance(e, OperationalError) and bool(e.args) \
+        and e.args[0] in CONN_LOST_ERRORS
+
+
+class ConnectionManager(object):
+    """Lazy, self-healing MySQL connection.
+
+       `password` can be a string or a callable (e.g. a KMS-decrypt): it is
+       only evaluated when connecting."""
+
+    def __init__(self, host, user, password, db, port=3306, charset='utf8',
+                 connect_timeout=5, ping_after=60, ping_timeout=2,
+                 max_retries=2, proxy_host=None, **connect_kwargs):
+        self.host               = host
+        self.port               = port
+        self.user               = user
+        self.password           = password
+        self.db                 = db
+        self.charset            = charset
+        self.connect_timeout    = connect_timeout
+        # Only ping when the connection was idle for more than `ping_after`
+        # seconds: a warm container handling a burst doesn't ping at all
+        self.ping_after         = ping_after
+        self.ping_timeout       = ping_timeout
+        self.max_retries        = max_retries
+        self.proxy_host         = proxy_host or os.environ.get('MYSQL_PROXY_HOST')
+        self.connect_kwargs     = connect_kwargs
+        self._conn              = None
+        self._last_used         = 0
+        self.stats = {
+            'connects'          : 0,
+            'reconnects'        : 0,
+            'retries'           : 0,
+            'connect_time'      : 0.0,
+            'last_connect_time' : 0.0,
+        }
+
+    def _connect(self):
+        password = self.password() if callable(self.password) else self.password
+        start = time.time()
+        conn = pymysql.connect(self.proxy_host or self.host,
+            port=self.port,
+            user=self.user,
+            passwd=password,
+            db=self.db,
+            charset=self.charset,
+            connect_timeout=self.connect_timeout,
+            **self.connect_kwargs)
+        elapsed = time.time() - start
+        self.stats['connects'] += 1
+        self.stats['connect_time'] += elapsed
+        self.stats['last_connect_time'] = elapsed
+        log.info('Connected to MySQL on %s in %.1f ms.',
+                 self.proxy_host or self.host, elapsed * 1000)
+        return conn
+
+    def _is_healthy(self, conn):
+        """Ping (and reconnect if needed) within `ping_timeout` seconds."""
+        sock = getattr(conn, '_sock', None)
+        timeout = sock.gettimeout() if sock is not None else None
+        try:
+            if sock is not None:
+                sock.settimeout(self.ping_timeout)
+            conn.ping(reconnect=True)
+        except Exception as e:
+            log.warn('MySQL ping failed: %s', e)
+            return False
+        finally:
+            if sock is not None:
+                sock.settimeout(timeout)
+        if getattr(conn, '_sock', None) is not sock:
+            # ping() had to reconnect
+            self.stats['reconnects'] += 1
+        return True
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def reconnect(self):
+        self.close()
+        self.stats['reconnects'] += 1
+        self._conn = self._connect()
+        return self._conn
+
+    def connection(self):
+        """Return a connection that is (very likely) alive."""
+        now = time.time()
+        if self._conn is None:
+            self._conn = self._connect()
+        elif now - self._last_used > self.ping_after:
+            if not self._is_healthy(self._conn):
+                self.reconnect()
+        self._last_used = now
+        return self._conn
+
+    def cursor(self, *args, **kwargs):
+        return self.connection().cursor(*args, **kwargs)
+
+    def commit(self):
+        self.connection().commit()
+
+    def report(self, metrics, stage='db'):
+        """Put the stats since the last report into `metrics` (see
+           lambda_common.metrics) and reset them."""
+        metrics.count('Connects', self.stats['connects'], stage=stage)
+        metrics.count('Reconnects', self.stats['reconnects'], stage=stage)
+        metrics.count('Retries', self.stats['retries'], stage=stage)
+        metrics.put('ConnectTime', self.stats['connect_time'] * 1000.0,
+                    'Milliseconds', stage=stage)
+        for name in ('connects', 'reconnects', 'retries'):
+            self.stats[name] = 0
+        self.stats['connect_time'] = 0.0
+
+    def _rollback(self, conn):
+        try:
+            conn.rollback()
+        except Exception as e:
+            # Lost as well: the server rolled back
+            log.warn('MySQL rollback failed: %s', e)
+
+    def run(self, func, idempotent=False):
+        """Run `func(cursor)` and commit. Returns what `func` returns.
+
+           If the connection gets lost and the work is `idempotent`, the
+           whole unit of work is run again on a new connection (at most
+           `max_retries` times). Nothing was committed, so that's safe.
+           Any other error rolls the unit of work back: the next one
+           doesn't commit half of it."""
+        attempt = 0
+        while True:
+            conn = self.connection()
+            try:
+                with conn.cursor() as cursor:
+                    result = func(cursor)
+                conn.commit()
+                return result
+            except (OperationalError, InterfaceError) as e:
+                if not (idempotent and is_connection_lost(e)) \
+                        or attempt >= self.max_retries:
+                    self._rollback(conn)
+                    raise
+                attempt += 1
+                self.stats['retries'] += 1
+                log.warn('MySQL connection lost (%s): retry %s of %s.',
+                         e, attempt, self.max_retries)
+                self.reconnect()
+            except Exception:
+                self._rollback(conn)
+                raise
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  s3_reader.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Downloads of (big) S3 objects with concurrent byte-range GETs:
+#
+#   from lambda_common import s3_reader
+#
+#   # All of it, into a file (any order, positional writes)...
+#   with open(path, 'wb') as f:
+#       s3_reader.download(s3_client, bucket, key, f, size=obj.size)
+#
+#   # ...into one buffer...
+#   data = s3_reader.download_buffer(s3_client, bucket, key)
+#
+#   # ...or streaming: the first ranges are parsed while later ones are
+#   # still being downloaded
+#   with s3_reader.open_stream(s3_client, bucket, key) as f:
+#       for row in csv.reader(f):
+#           ...
+#
+#  One GET stream from S3 tops out far below what a Lambda can take in;
+#  RANGE_SIZE ranges over MAX_WORKERS connections don't. Objects smaller
+#  than MIN_PARALLEL are fetched with a single GET.
+#
+#  Every range is of the same version of the object: pass the `etag` of
+#  the event (with its `size`), or it's taken from a HEAD. If the object
+#  is replaced halfway, the next range fails (412) with ObjectChanged
+#  instead of mixing two versions.
+#
+###############################################################################
+
+import io
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+RANGE_SIZE      = int(os.environ.get('S3_RANGE_SIZE', 8 * 1024 * 1024))
+MAX_WORKERS     = int(os.environ.get('S3_MAX_WORKERS', 8))
+MIN_PARALLEL    = 2 * RANGE_SIZE
+# Attempts per range (a dropped connection halfway a body)
+RETRIES         = 3
+COPY_BUFFER     = 1024 * 1024
+
+
+class ObjectChanged(IOError):
+    """The object isn't the version (ETag) the download started with."""
+    pass
+
+
+def object_size(client, bucket, key):
+    return client.head_object(Bucket=bucket, Key=key)['ContentLength']
+
+def object_version(client, bucket, key):
+    """(size, ETag) of the object."""
+    res = client.head_object(Bucket=bucket, Key=key)
+    return res['ContentLength'], res['ETag']
+
+def _if_match(etag):
+    # The ETag of an S3 event comes without the quotes
+    return {'IfMatch': '"%s"' % etag.strip('"')} if etag else {}
+
+def _is_changed(e):
+    response = getattr(e, 'response', {})
+    return (response.get('Error', {}).get('Code') == 'PreconditionFailed' or
+            response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 412)
+
+def get_object(client, bucket, key, etag=None):
+    """The GET response of the whole object (of version `etag`)."""
+    try:
+        return client.get_object(Bucket=bucket, Key=key, **_if_match(etag))
+    except Exception as e:
+        if _is_changed(e):
+            raise ObjectChanged('s3://%s/%s is no longer %s.'
+                                % (bucket, key, etag))
+        raise
+
+def byte_ranges(size, range_size=RANGE_SIZE):
+    """[(start, end)] (end inclusive, as in the Range header)."""
+    return [(start, min(start + range_size, size) - 1)
+            for start in range(0, size, range_size)]
+
+def get_range(client, bucket, key, start, end, retries=RETRIES, etag=None):
+    """The bytes start..end (inclusive) of the object (of version `etag`:
+       ObjectChanged if it was replaced)."""
+    for attempt in range(1, retries + 1):
+        try:
+            res = client.get_object(Bucket=bucket, Key=key,
+                                    Range='bytes=%s-%s' % (start, end),
+                                    **_if_match(etag))
+            data = res['Body'].read()
+            if len(data) != end - start + 1:
+                raise IOError('Range %s-%s of s3://%s/%s: got %s bytes.'
+                              % (start, end, bucket, key, len(data)))
+            return data
+        except Exception as e:
+            if _is_changed(e):
+                raise ObjectChanged('s3://%s/%s is no longer %s.'
+                                    % (bucket, key, etag))
+            # A ClientError (403, 404, ...) won't go away
+            if attempt == retries or hasattr(e, 'response'):
+                raise
+            log.warning('Retrying range %s-%s of %s (%s).', start, end, key, e)
+
+def _workers(ranges, max_workers):
+    return max(1, min(max_workers, len(ranges)))
+
+def _version(client, bucket, key, size, etag):
+    """(size, etag) to download: from a HEAD, unless the caller (the
+       event) knows both. A single GET doesn't need the ETag."""
+    if size is None or (etag is None and size >= MIN_PARALLEL):
+        return object_version(client, bucket, key)
+    return size, etag
+
+def download(client, bucket, key, f, size=None, range_size=RANGE_SIZE,
+             max_workers=MAX_WORKERS, etag=None):
+    """Write the object to file object `f` (seekable, at position 0).
+       Returns the size."""
+    size, etag = _version(client, bucket, key, size, etag)
+    if size < MIN_PARALLEL:
+        body = get_object(client, bucket, key, etag)['Body']
+        for chunk in iter(lambda: body.read(COPY_BUFFER), b''):
+            f.write(chunk)
+        return size
+    ranges = byte_ranges(size, range_size)
+    lock = threading.Lock()
+    def fetch(r):
+        data = get_range(client, bucket, key, *r, etag=etag)
+        with lock:
+            f.seek(r[0])
+            f.write(data)
+    with ThreadPoolExecutor(_workers(ranges, max_workers)) as executor:
+        # list(): re-raise the first error
+        list(executor.map(fetch, ranges))
+    f.seek(size)
+    log.debug('%s bytes of %s in %s ranges.', size, key, len(ranges))
+    return size
+
+def download_buffer(client, bucket, key, size=None, range_size=RANGE_SIZE,
+                    max_workers=MAX_WORKERS, etag=None):
+    """The whole object as one bytearray (allocated once)."""
+    size, etag = _version(client, bucket, key, size, etag)
+    if size < MIN_PARALLEL:
+        return bytearray(get_object(client, bucket, key, etag)['Body'].read())
+    buf = bytearray(size)
+    ranges = byte_ranges(size, range_size)
+    def fetch(r):
+        buf[r[0]:r[1] + 1] = get_range(client, bucket, key, *r, etag=etag)
+    with ThreadPoolExecutor(_workers(ranges, max_workers)) as executor:
+        list(executor.map(fetch, ranges))
+    return buf
+
+def iter_ranges(client, bucket, key, size=None, range_size=RANGE_SIZE,
+                max_workers=MAX_WORKERS, window=None, etag=None):
+    """Yield the object's bytes range by range, in order. Up to `window`
+       (default 2 * max_workers) ranges are downloaded ahead: memory
+       stays at about window * range_size, whatever the size."""
+    size, etag = _version(client, bucket, key, size, etag)
+    if size < MIN_PARALLEL:
+        body = get_object(client, bucket, key, etag)['Body']
+        for chunk in iter(lambda: body.read(range_size), b''):
+            yield chunk
+        return
+    ranges = deque(byte_ranges(size, range_size))
+    window = window or 2 * max_workers
+    executor = ThreadPoolExecutor(_workers(ranges, max_workers))
+    pending = deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < window:
+                start, end = ranges.popleft()
+                pending.append(executor.submit(get_range, client, bucket, key,
+                                               start, end, etag=etag))
+            yield pending.popleft().result()
+    finally:
+        # Stopped early (or an error): don't download the rest
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class RangeStream(io.RawIOBase):
+    """Read-only file object over `iter_ranges`."""
+
+    def __init__(self, chunks):
+        self._chunks    = chunks
+        self._chunk     = b''
+        self._offset    = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset >= len(self._chunk):
+            try:
+                self._chunk = next(self._chunks)
+            except StopIteration:
+                return 0
+            self._offset = 0
+        n = min(len(b), len(self._chunk) - self._offset)
+        b[:n] = self._chunk[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            # Ends the downloads of a generator stopped early
+            getattr(self._chunks, 'close', lambda: None)()
+        super(RangeStream, self).close()
+
+def open_stream(client, bucket, key, size=None, range_size=RANGE_SIZE,
+                max_workers=MAX_WORKERS, window=None, etag=None):
+    """Buffered (binary) file object that reads the object as it arrives:
+       line iteration (csv.reader) works."""
+    chunks = iter_ranges(client, bucket, key, size, range_size, max_workers,
+                         window, etag)
+    return io.BufferedReader(RangeStream(chunks), buffer_size=COPY_BUFFER)
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
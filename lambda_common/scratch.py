@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  scratch.py
+#
+#  Copyleft 2017 Mali Media Group
+#  <http://malimedia.be>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+#
+#  Scratch space per task (an S3 object, a record, ...) instead of fixed
+#  /tmp paths:
+#
+#   from lambda_common import scratch
+#
+#   with scratch.task('clean') as scr:
+#       scr.reserve(obj.size)               # enough room in /tmp?
+#       path = scr.path('today.csv')        # a file in its own directory
+#       with scr.spooled(obj.size) as f:    # in memory below SPOOL_MAX
+#           s3_client.download_fileobj(bucket, key, f)
+#   # the directory and everything in it are gone here
+#
+#  - every task gets its own directory (under SCRATCH_ROOT), so several
+#    tasks in one container never share a file
+#  - the directory is removed when the task ends, also on an exception
+#  - directories left behind (a killed invocation) are swept at the start
+#    of a task when they're older than STALE_AFTER seconds
+#  - `reserve()` checks the free space before writing: NoScratchSpace
+#    instead of a full /tmp halfway a download
+#
+###############################################################################
+
+import os
+import time
+import errno
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+SCRATCH_ROOT    = os.environ.get('SCRATCH_ROOT',
+                                 os.path.join(tempfile.gettempdir(), 'scratch'))
+# Files up to this size stay in memory (SpooledTemporaryFile)
+SPOOL_MAX       = int(os.environ.get('SCRATCH_SPOOL_MAX', 8 * 1024 * 1024))
+# Keep at least this much free after a reservation
+MIN_FREE        = 16 * 1024 * 1024
+STALE_AFTER     = 15 * 60
+
+
+class NoScratchSpace(IOError):
+    pass
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def sweep(root=None, stale_after=STALE_AFTER):
+    """Remove task directories older than `stale_after` seconds."""
+    root = root or SCRATCH_ROOT
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return 0
+    removed = 0
+    limit = time.time() - stale_after
+    for name in names:
+        path = os.path.join(root, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+    if removed:
+        log.info('Removed %s stale scratch directories.', removed)
+    return removed
+
+
+class Scratch(object):
+    """The scratch directory of one task."""
+
+    def __init__(self, name='task', root=None, spool_max=SPOOL_MAX):
+        self.root       = root or SCRATCH_ROOT
+        self.spool_max  = spool_max
+        try:
+            os.makedirs(self.root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.dir        = tempfile.mkdtemp(prefix=name + '-', dir=self.root)
+        self.reserved   = 0
+
+    def path(self, name):
+        """Path of file `name` in this task's directory."""
+        return os.path.join(self.dir, name)
+
+    def reserve(self, nbytes):
+        """Make sure `nbytes` (more) can be written. Raises NoScratchSpace."""
+        if not nbytes:
+            return
+        free = free_bytes(self.dir)
+        if free - self.reserved - nbytes < MIN_FREE:
+            raise NoScratchSpace('Need %s bytes in %s, %s free (%s reserved).'
+                                 % (nbytes, self.dir, free, self.reserved))
+        self.reserved += nbytes
+
+    def spooled(self, size=None, mode='w+b'):
+        """A file that stays in memory up to `spool_max` bytes, then moves
+           to this task's directory. With a known `size` above that, the
+           space is reserved first."""
+        if size and size > self.spool_max:
+            self.reserve(size)
+        return tempfile.SpooledTemporaryFile(max_size=self.spool_max,
+                                             mode=mode, dir=self.dir)
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.reserved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+
+@contextmanager
+def task(name='task', root=None, spool_max=SPOOL_MAX):
+    """A Scratch for the block, removed afterwards. Sweeps stale ones
+       first."""
+    sweep(root)
+    scr = Scratch(name, root, spool_max)
+    try:
+        yield scr
+    finally:
+        scr.cleanup()
+
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4